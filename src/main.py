@@ -1,16 +1,30 @@
 #!/usr/bin/python3
 
 import argparse
+import sys
 from pit.commands import (
     cmd_cat_file,
+    cmd_add,
     init,
     commit,
     cmd_hash_object,
     cmd_ls_tree,
+    cmd_diff_tree,
     cmd_checkout,
     cmd_show_ref,
+    cmd_pack_refs,
+    cmd_update_ref,
     cmd_tag,
     cmd_rev_parse,
+    cmd_rev_list,
+    cmd_log,
+    cmd_merge_base,
+    cmd_commit_graph,
+    cmd_fsck,
+    cmd_repack,
+    cmd_gc,
+    cmd_status,
+    cmd_fsmonitor_daemon,
 )
 
 
@@ -28,6 +42,16 @@ def init_parser(subparsers) -> None:
         help="Path to .pit folder to create")
 
 
+def add_parser(subparsers) -> None:
+    argsp = subparsers.add_parser(
+        "add",
+        help="Add file contents to the index")
+
+    argsp.add_argument("path",
+                       nargs="+",
+                       help="Files to add")
+
+
 def cat_file_parser(subparsers) -> None:
     """Subparser for cat-file command """
     cat_file_parser = subparsers.add_parser(
@@ -35,15 +59,47 @@ def cat_file_parser(subparsers) -> None:
         help="Display contents of an object"
     )
 
+    cat_file_parser.add_argument(
+        "-t",
+        dest="show_type",
+        action="store_true",
+        help="Show the object type instead of its content")
+
+    cat_file_parser.add_argument(
+        "-s",
+        dest="show_size",
+        action="store_true",
+        help="Show the object size instead of its content")
+
+    cat_file_parser.add_argument(
+        "--batch",
+        dest="batch",
+        action="store_true",
+        help="Print type, size and content of each object named on stdin")
+
+    cat_file_parser.add_argument(
+        "--batch-check",
+        dest="batch_check",
+        action="store_true",
+        help="Print type and size of each object named on stdin")
+
+    cat_file_parser.add_argument(
+        "--buffer",
+        dest="buffer",
+        action="store_true",
+        help="With --batch, don't flush the output after each object")
+
     cat_file_parser.add_argument(
         "type",
         metavar="type",
-        choices=["blob", "commit", "tag", "tree"],
-        help="type to display")
+        nargs="?",
+        help="type to display (blob, commit, tag or tree), "
+             "or the object with -t and -s")
 
     cat_file_parser.add_argument(
         "object",
         metavar="object",
+        nargs="?",
         help="Object to display")
 
 
@@ -67,8 +123,20 @@ def hash_object_parser(subparsers) -> None:
         action="store_true",
         help="Actually write the object into the database")
 
+    argsp.add_argument(
+        "--stdin-paths",
+        action="store_true",
+        help="Read file names from stdin, one per line")
+
+    argsp.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=None,
+        help="Number of threads hashing and compressing files")
+
     argsp.add_argument(
         "path",
+        nargs="*",
         help="Read object from <file>"
     )
 
@@ -85,23 +153,96 @@ def ls_tree_parser(subparsers) -> None:
                        help="A tree-ish object.")
 
 
+def diff_tree_parser(subparsers) -> None:
+    argsp = subparsers.add_parser(
+        "diff-tree", help="Compare the content and mode of two trees.")
+    argsp.add_argument("-r",
+                       dest="recursive",
+                       action="store_true",
+                       help="Recurse into sub-trees")
+
+    argsp.add_argument("--name-only",
+                       action="store_true",
+                       help="Show only the names of the changed paths")
+
+    argsp.add_argument("--name-status",
+                       action="store_true",
+                       help="Show only the names and status of the "
+                       "changed paths")
+
+    argsp.add_argument("tree",
+                       nargs="+",
+                       help="Two tree-ish objects, or a commit to compare "
+                       "with its first parent.")
+
+
 def checkout_parser(subparsers) -> None:
     argsp = subparsers.add_parser(
-        "checkout", help="Checkout a commit inside a directory")
+        "checkout", help="Switch to a commit, or check it out inside a "
+        "directory")
     argsp.add_argument("commit",
                        help="The commit or tree to checkout.")
 
     argsp.add_argument("path",
-                       help="The empty path to checkout on.")
+                       nargs="?",
+                       help="The empty path to checkout on.  Without it, "
+                       "the worktree is switched to commit.")
+
+    argsp.add_argument("-f", "--force",
+                       action="store_true",
+                       help="Throw away local changes in the way")
+
+    argsp.add_argument("-j", "--jobs",
+                       type=int,
+                       default=None,
+                       help="Number of threads writing files")
 
 
-def showref_parser(subparsers) = > None:
+def showref_parser(subparsers) -> None:
     argsp = subparsers.add_parser(
         "show-ref", help="Show all references")
 
 
-def tag_parser(subparsers) = > None:
-    argsp = argsubparsers.add_parser(
+def pack_refs_parser(subparsers) -> None:
+    argsp = subparsers.add_parser(
+        "pack-refs", help="Pack refs into packed-refs")
+    argsp.add_argument("--all",
+                       action="store_true",
+                       help="Pack every ref, not only tags")
+
+    argsp.add_argument("--no-prune",
+                       action="store_true",
+                       help="Keep the loose refs packed")
+
+
+def update_ref_parser(subparsers) -> None:
+    argsp = subparsers.add_parser(
+        "update-ref", help="Update refs, checking their old value")
+    argsp.add_argument("-d",
+                       dest="delete",
+                       action="store_true",
+                       help="Delete the ref")
+
+    argsp.add_argument("--stdin",
+                       action="store_true",
+                       help="Read updates from stdin, one per line (create "
+                       "<ref> <new>, update <ref> <new> [<old>], delete "
+                       "<ref> [<old>], verify <ref> [<old>]) and apply "
+                       "them all or none")
+
+    argsp.add_argument("--packed",
+                       action="store_true",
+                       help="Write the refs to packed-refs")
+
+    argsp.add_argument("args",
+                       nargs="*",
+                       metavar="ref [new] [old]",
+                       help="The ref, its new value and the value it must "
+                       "have")
+
+
+def tag_parser(subparsers) -> None:
+    argsp = subparsers.add_parser(
         "tag",
         help="List and create tags")
 
@@ -120,6 +261,79 @@ def tag_parser(subparsers) = > None:
                        help="The object the new tag will point to")
 
 
+def walk_arguments(argsp) -> None:
+    """Options of the commands walking history."""
+    argsp.add_argument("-n", "--max-count",
+                       type=int,
+                       default=None,
+                       help="Show at most this many commits")
+
+    argsp.add_argument("--first-parent",
+                       action="store_true",
+                       help="Follow only the first parent of merges")
+
+    argsp.add_argument("--topo-order",
+                       action="store_true",
+                       help="Show no parent before all its children")
+
+
+def rev_list_parser(subparsers) -> None:
+    argsp = subparsers.add_parser(
+        "rev-list", help="List commits in reverse chronological order",
+        usage="%(prog)s [options] revisions... [-- paths...]")
+    argsp.add_argument("revisions",
+                       nargs="+",
+                       help="Commits to start from: A, ^A to exclude A "
+                       "and what it reaches, or A..B")
+    walk_arguments(argsp)
+
+
+def log_parser(subparsers) -> None:
+    argsp = subparsers.add_parser(
+        "log", help="Show commit logs",
+        usage="%(prog)s [options] [revisions...] [-- paths...]")
+    argsp.add_argument("revisions",
+                       nargs="*",
+                       help="Commits to start from (HEAD by default): A, "
+                       "^A to exclude A and what it reaches, or A..B")
+    walk_arguments(argsp)
+
+    argsp.add_argument("--oneline",
+                       action="store_true",
+                       help="Show each commit on one line")
+
+
+def merge_base_parser(subparsers) -> None:
+    argsp = subparsers.add_parser(
+        "merge-base", help="Find the best common ancestor of two commits")
+    argsp.add_argument("--all",
+                       action="store_true",
+                       help="Show all the best common ancestors")
+
+    argsp.add_argument("--is-ancestor",
+                       action="store_true",
+                       help="Exit with 0 if commit1 is an ancestor of "
+                       "commit2, 1 otherwise")
+
+    argsp.add_argument("commit1")
+    argsp.add_argument("commit2")
+
+
+def commit_graph_parser(subparsers) -> None:
+    argsp = subparsers.add_parser(
+        "commit-graph", help="Write the commit-graph file")
+    argsp.add_argument("action",
+                       choices=["write"],
+                       help="write: store the commits reachable from the "
+                       "refs in objects/info/commit-graph")
+
+    argsp.add_argument("--changed-paths",
+                       action="store_true",
+                       default=None,
+                       help="Store changed-path Bloom filters, for log "
+                       "limited to paths (kept if the graph has them)")
+
+
 def rev_parse_parser(subparsers):
     argsp = subparsers.add_parser(
         "rev-parse",
@@ -136,20 +350,121 @@ def rev_parse_parser(subparsers):
                        help="The name to parse")
 
 
+def add_pack_options(argsp) -> None:
+    argsp.add_argument("--window",
+                       type=int,
+                       default=10,
+                       help="Number of objects to consider as delta bases")
+
+    argsp.add_argument("--depth",
+                       type=int,
+                       default=50,
+                       help="Maximum delta chain length")
+
+
+def fsck_parser(subparsers) -> None:
+    argsp = subparsers.add_parser(
+        "fsck",
+        help="Verify the objects and their connectivity")
+
+    argsp.add_argument("-j", "--jobs",
+                       type=int,
+                       default=None,
+                       help="Number of processes checking objects")
+
+    argsp.add_argument("--progress",
+                       action=argparse.BooleanOptionalAction,
+                       default=None,
+                       help="Report progress on stderr (by default when "
+                       "it is a terminal)")
+
+
+def repack_parser(subparsers) -> None:
+    argsp = subparsers.add_parser(
+        "repack",
+        help="Pack reachable objects into a single pack")
+
+    argsp.add_argument("-d",
+                       dest="delete",
+                       action="store_true",
+                       help="Remove redundant packs and loose objects")
+
+    add_pack_options(argsp)
+
+
+def gc_parser(subparsers) -> None:
+    argsp = subparsers.add_parser(
+        "gc",
+        help="Repack the repository and prune packed loose objects")
+
+    add_pack_options(argsp)
+
+
+def status_parser(subparsers) -> None:
+    argsp = subparsers.add_parser(
+        "status",
+        help="Show the working tree status")
+
+    argsp.add_argument("--no-untracked",
+                       dest="no_untracked",
+                       action="store_true",
+                       help="Don't look for untracked files")
+
+    argsp.add_argument("-j", "--jobs",
+                       type=int,
+                       default=None,
+                       help="Number of threads hashing modified files")
+
+
+def fsmonitor_daemon_parser(subparsers) -> None:
+    argsp = subparsers.add_parser(
+        "fsmonitor-daemon",
+        help="Watch the worktree for changes, for status "
+             "(set pit.fsmonitor to use it)")
+
+    argsp.add_argument("--stop",
+                       action="store_true",
+                       help="Stop the daemon running for the repository")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Custom Git-like CLI tool")
     subparsers = parser.add_subparsers(dest="command", help="Subcommands")
 
     init_parser(subparsers)
+    add_parser(subparsers)
     cat_file_parser(subparsers)
     hash_object_parser(subparsers)
     ls_tree_parser(subparsers)
+    diff_tree_parser(subparsers)
     checkout_parser(subparsers)
     rev_parse_parser(subparsers)
-
-    args = parser.parse_args()
+    showref_parser(subparsers)
+    pack_refs_parser(subparsers)
+    update_ref_parser(subparsers)
+    rev_list_parser(subparsers)
+    log_parser(subparsers)
+    merge_base_parser(subparsers)
+    commit_graph_parser(subparsers)
+    fsck_parser(subparsers)
+    repack_parser(subparsers)
+    gc_parser(subparsers)
+    status_parser(subparsers)
+    fsmonitor_daemon_parser(subparsers)
+
+    # Paths limiting log and rev-list come after "--".  The other
+    # commands leave "--" to argparse.
+    argv = sys.argv[1:]
+    paths = []
+    if argv[:1] in (["log"], ["rev-list"]) and "--" in argv:
+        i = argv.index("--")
+        argv, paths = argv[:i], argv[i + 1:]
+    args = parser.parse_args(argv)
+    args.paths = paths
 
     match args.command:
+        case "add":
+            return cmd_add(args)
         case "cat-file":
             return cmd_cat_file(args)
         case "checkout":
@@ -158,16 +473,40 @@ def main():
             return commit()
         case "show-ref":
             return cmd_show_ref(args)
+        case "pack-refs":
+            return cmd_pack_refs(args)
+        case "update-ref":
+            return cmd_update_ref(args)
         case "hash-object":
             return cmd_hash_object(args)
         case "init":
             return init(args.path)
         case "ls-tree":
             return cmd_ls_tree(args)
+        case "diff-tree":
+            return cmd_diff_tree(args)
         case "rev-parse":
             return cmd_rev_parse(args)
+        case "rev-list":
+            return cmd_rev_list(args)
+        case "log":
+            return cmd_log(args)
+        case "merge-base":
+            return cmd_merge_base(args)
+        case "commit-graph":
+            return cmd_commit_graph(args)
+        case "fsck":
+            return cmd_fsck(args)
         case "tag":
             return cmd_tag(args)
+        case "repack":
+            return cmd_repack(args)
+        case "gc":
+            return cmd_gc(args)
+        case "status":
+            return cmd_status(args)
+        case "fsmonitor-daemon":
+            return cmd_fsmonitor_daemon(args)
         case _:
             parser.print_help()
     return 0
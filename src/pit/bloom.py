@@ -0,0 +1,122 @@
+from pit.repo import Repository
+from pit.diff import tree_diff
+
+# Changed-path Bloom filters, git's BIDX and BDAT commit-graph chunks:
+# for each commit, a Bloom filter of the paths changed since its first
+# parent, along with their leading directories.  If the filter doesn't
+# have a path, the commit didn't touch it and its tree can be left
+# alone; if it does, it may have.
+
+BLOOM_HASH_VERSION = 1
+BLOOM_NUM_HASHES = 7
+BLOOM_BITS_PER_ENTRY = 10
+# Commits changing more paths get a filter with all bits set
+BLOOM_MAX_CHANGED_PATHS = 512
+BLOOM_LARGE_FILTER = b'\xff'
+
+BLOOM_SEED0 = 0x293ae76f
+BLOOM_SEED1 = 0x7e646e2c
+
+_C1 = 0xcc9e2d51
+_C2 = 0x1b873593
+_MASK = 0xFFFFFFFF
+
+
+def _rotl(x: int, r: int) -> int:
+    return ((x << r) | (x >> (32 - r))) & _MASK
+
+
+def murmur3_seeded(seed: int, data: bytes, version=BLOOM_HASH_VERSION) -> int:
+    """The 32 bits murmur3 hash of data.
+
+    Version 1 is what git computes on platforms where char is signed:
+    bytes above 0x7f are sign-extended.  Version 2 fixes that."""
+    if version == 1:
+        byte = [b | 0xFFFFFF00 if b & 0x80 else b for b in data]
+    else:
+        byte = data
+    h = seed
+    n = len(data) & ~3
+    for i in range(0, n, 4):
+        k = (byte[i] | (byte[i + 1] << 8) | (byte[i + 2] << 16)
+             | (byte[i + 3] << 24)) & _MASK
+        k = (_rotl((k * _C1) & _MASK, 15) * _C2) & _MASK
+        h = (_rotl(h ^ k, 13) * 5 + 0xe6546b64) & _MASK
+
+    k = 0
+    tail = len(data) & 3
+    if tail == 3:
+        k ^= (byte[n + 2] << 16) & _MASK
+    if tail >= 2:
+        k ^= (byte[n + 1] << 8) & _MASK
+    if tail:
+        k ^= byte[n]
+        h ^= (_rotl((k * _C1) & _MASK, 15) * _C2) & _MASK
+
+    h ^= len(data)
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & _MASK
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & _MASK
+    h ^= h >> 16
+    return h
+
+
+def bloom_key(path: bytes, num_hashes=BLOOM_NUM_HASHES,
+              version=BLOOM_HASH_VERSION) -> list[int]:
+    """The hashes of path, as git computes them: double hashing on two
+    murmur3 hashes."""
+    h0 = murmur3_seeded(BLOOM_SEED0, path, version)
+    h1 = murmur3_seeded(BLOOM_SEED1, path, version)
+    return [(h0 + i * h1) & _MASK for i in range(num_hashes)]
+
+
+def bloom_path_keys(path: str, num_hashes=BLOOM_NUM_HASHES,
+                    version=BLOOM_HASH_VERSION) -> list[list[int]]:
+    """The keys of path and of its leading directories: a commit
+    changing path has them all in its filter."""
+    path = path.strip("/").encode("utf8")
+    keys = []
+    while path:
+        keys.append(bloom_key(path, num_hashes, version))
+        path = path.rpartition(b'/')[0]
+    return keys
+
+
+def bloom_contains(data, key: list[int]) -> bool:
+    """Whether the filter data may have key.  An empty filter (one git
+    didn't compute) may have anything."""
+    bits = len(data) * 8
+    if not bits:
+        return True
+    for h in key:
+        pos = h % bits
+        if not data[pos >> 3] & (1 << (pos & 7)):
+            return False
+    return True
+
+
+def bloom_filter_compute(repo: Repository, tree: str,
+                         parent_tree: str | None) -> bytes:
+    """The filter of a commit with tree, whose first parent has
+    parent_tree (None for a root commit)."""
+    paths = set()
+    for n, change in enumerate(tree_diff(repo, parent_tree, tree)):
+        if n == BLOOM_MAX_CHANGED_PATHS:
+            return BLOOM_LARGE_FILTER
+        path = change.path.encode("utf8")
+        while path and path not in paths:
+            paths.add(path)
+            path = path.rpartition(b'/')[0]
+    if len(paths) > BLOOM_MAX_CHANGED_PATHS:
+        return BLOOM_LARGE_FILTER
+
+    # At least a byte, even with no change
+    size = max(1, (len(paths) * BLOOM_BITS_PER_ENTRY + 7) // 8)
+    data = bytearray(size)
+    bits = size * 8
+    for path in paths:
+        for h in bloom_key(path):
+            pos = h % bits
+            data[pos >> 3] |= 1 << (pos & 7)
+    return bytes(data)
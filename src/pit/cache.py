@@ -0,0 +1,105 @@
+import threading
+from collections import OrderedDict
+
+# Default byte budgets of a repository's object cache.
+OBJECT_CACHE_LIMIT = 32 * 1024 * 1024
+BLOB_CACHE_LIMIT = 16 * 1024 * 1024
+
+
+class PitLRUCache:
+    """A least-recently-used cache with a budget in bytes.
+
+    Each value is stored with its size, as given by the caller.  Values
+    bigger than a quarter of the budget are not cached at all, so one
+    huge object can't flush everything else."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        # Checkout and fsck read objects from several threads.
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key) -> bool:
+        return key in self._items
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size: int) -> None:
+        if size > self.max_bytes // 4:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "count": len(self._items),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class PitObjectCache:
+    """Per-repository object cache.
+
+    Parsed trees, commits and tags are kept apart from raw blob data:
+    walks re-read the same trees over and over, and we don't want a
+    few large blobs to push them out."""
+
+    def __init__(self, object_limit=OBJECT_CACHE_LIMIT,
+                 blob_limit=BLOB_CACHE_LIMIT):
+        self.objects = PitLRUCache(object_limit)
+        self.blobs = PitLRUCache(blob_limit)
+
+    def get(self, sha: str):
+        """Return the cached parsed object or raw (fmt, data) blob for
+        sha, or None.  Lookups of an object in neither cache count as
+        misses of the objects cache."""
+        cache = self.blobs if sha in self.blobs else self.objects
+        return cache.get(sha)
+
+    def put(self, sha: str, fmt: bytes, value, size: int) -> None:
+        if fmt == b'blob':
+            self.blobs.put(sha, value, size)
+        else:
+            self.objects.put(sha, value, size)
+
+    def clear(self) -> None:
+        self.objects.clear()
+        self.blobs.clear()
+
+    def stats(self) -> dict:
+        return {
+            "objects": self.objects.stats(),
+            "blobs": self.blobs.stats(),
+        }
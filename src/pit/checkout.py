@@ -0,0 +1,305 @@
+import os
+import shutil
+import stat
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from pit.repo import Repository
+from pit.objects import (
+    PitIndex,
+    PitIndexEntry,
+    index_read,
+    index_write,
+    index_entry_from_stat,
+    object_read_stream,
+    tree_walk,
+)
+from pit.diff import tree_diff
+from pit.status import stat_matches, file_hash
+
+# Bytes of object data held by the checkout threads at once, at most.
+# Only deltified objects are held whole, the others are streamed.
+CHECKOUT_INFLIGHT = 64 * 1024 * 1024
+
+# Files written by a thread in one go: a future per file costs more
+# than small files take to write.
+CHECKOUT_BATCH = 64
+
+MODE_SYMLINK = 0o120000
+MODE_GITLINK = 0o160000
+
+
+class PitByteBudget:
+    """Bounds the bytes held by several threads at once.
+
+    acquire() blocks until the bytes fit, unless nothing is held at
+    all: one object bigger than the budget still goes through, alone."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, n: int) -> None:
+        with self._cond:
+            while self.used and self.used + n > self.limit:
+                self._cond.wait()
+            self.used += n
+
+    def release(self, n: int) -> None:
+        with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+
+def checkout_dirs(dest: str, names) -> None:
+    """Create the directories the files at names (relative to dest)
+    live in, parents first, replacing files in the way."""
+    dirs = set()
+    for name in names:
+        d = name.rpartition("/")[0]
+        while d and d not in dirs:
+            dirs.add(d)
+            d = d.rpartition("/")[0]
+    for d in sorted(dirs):
+        path = os.path.join(dest, d)
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            if not os.path.isdir(path):
+                os.unlink(path)
+                os.mkdir(path)
+
+
+def _create(path: str, create):
+    """Run create(path), replacing whatever is at path."""
+    try:
+        return create(path)
+    except FileExistsError:
+        os.unlink(path)
+        return create(path)
+
+
+def checkout_blob(repo: Repository, dest: str, name: str, mode: int,
+                  sha: str, budget: PitByteBudget) -> PitIndexEntry:
+    """Write the object sha at name, below dest, and return its index
+    entry."""
+    path = os.path.join(dest, name)
+    if mode == MODE_GITLINK:
+        # Submodules are left empty
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            pass
+        return PitIndexEntry(mode_type=0b1110, mode_perms=0, sha=sha,
+                             name=name)
+
+    found = object_read_stream(repo, sha)
+    if found is None:
+        raise Exception("No such object {0} for {1}".format(sha, name))
+    _, size, chunks = found
+    # Reading starts with the first chunk
+    held = min(size, budget.limit)
+    budget.acquire(held)
+    try:
+        if mode == MODE_SYMLINK:
+            target = os.fsdecode(b''.join(chunks))
+            _create(path, lambda p: os.symlink(target, p))
+            st = os.lstat(path)
+        else:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+            perms = 0o777 if mode & 0o100 else 0o666
+            fd = _create(path, lambda p: os.open(p, flags, perms))
+            try:
+                for chunk in chunks:
+                    view = memoryview(chunk)
+                    while view:
+                        view = view[os.write(fd, view):]
+                st = os.fstat(fd)
+            finally:
+                os.close(fd)
+    finally:
+        budget.release(held)
+    return index_entry_from_stat(name, st, sha)
+
+
+def checkout_items(repo: Repository, dest: str, items: list, workers=None,
+                   max_inflight=CHECKOUT_INFLIGHT) -> list[PitIndexEntry]:
+    """Write items, (name, mode, sha) triples, below dest on a thread
+    pool, their directories existing already.  Returns their index
+    entries, in the same order."""
+    budget = PitByteBudget(max_inflight)
+
+    def batch(start: int) -> list[PitIndexEntry]:
+        return [checkout_blob(repo, dest, *item, budget)
+                for item in items[start:start + CHECKOUT_BATCH]]
+
+    ret = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for entries in pool.map(batch,
+                                range(0, len(items), CHECKOUT_BATCH)):
+            ret += entries
+    return ret
+
+
+def checkout_tree(repo: Repository, tree: str, dest: str, workers=None,
+                  max_inflight=CHECKOUT_INFLIGHT) -> list[PitIndexEntry]:
+    """Write the tree sha to the directory dest.
+
+    The tree is walked once to list the files, then directories are
+    created and files written in parallel.  Returns the index entries
+    of the files, with their stat data."""
+    items = [(name, int(mode, 8), sha)
+             for name, mode, sha in tree_walk(repo, tree)]
+    checkout_dirs(dest, (name for name, _, _ in items))
+    return checkout_items(repo, dest, items, workers, max_inflight)
+
+
+def _index_lookup(index: PitIndex, names: list[bytes], name: bytes):
+    """The entries of index for name, all stages."""
+    i = bisect_left(names, name)
+    ret = []
+    while i < len(names) and names[i] == name:
+        ret.append(index.entries[i])
+        i += 1
+    return ret
+
+
+def _untracked_below(worktree: str, path: str, tracked: set) -> bool:
+    """Whether there are files below the directory path that aren't in
+    tracked."""
+    for root, _, files in os.walk(os.path.join(worktree, path)):
+        rel = os.path.relpath(root, worktree).replace(os.sep, "/")
+        if any(os.fsencode(rel + "/" + f) not in tracked for f in files):
+            return True
+    return False
+
+
+def _blocking_file(worktree: str, path: str) -> str:
+    """The parent directory of path that isn't one."""
+    parts = path.split("/")
+    for i in range(1, len(parts)):
+        d = "/".join(parts[:i])
+        if not os.path.isdir(os.path.join(worktree, d)):
+            return d
+    return path
+
+
+def checkout_check(repo: Repository, index: PitIndex, changes) -> None:
+    """Make sure applying changes, PitTreeChanges, loses nothing: the paths changed have
+    to be unmodified in the index and the worktree, and not be taken
+    by untracked files.  Raises an Exception listing the culprits."""
+    names = [e.raw_name for e in index.entries]
+    racy_ns = index.source[2] if index.source else None
+    worktree = str(repo.worktree)
+    leaving = {os.fsencode(c.path) for c in changes if c.old_sha}
+    modified = []
+    untracked = []
+
+    for c in changes:
+        path = c.path
+        old = (c.old_mode, c.old_sha) if c.old_sha else None
+        new = (c.new_mode, c.new_sha) if c.new_sha else None
+        entries = _index_lookup(index, names, os.fsencode(path))
+        if any(e.flag_stage for e in entries):
+            raise Exception("{0}: needs merge".format(path))
+        entry = entries[0] if entries else None
+        staged = (entry.fields[6], entry.sha) if entry else None
+        if staged != old and staged != new:
+            modified.append(path)
+            continue
+        try:
+            st = os.lstat(os.path.join(worktree, path))
+        except FileNotFoundError:
+            continue
+        except NotADirectoryError:
+            # A file where a directory is to be
+            blocking = _blocking_file(worktree, path)
+            if os.fsencode(blocking) not in leaving:
+                untracked.append(blocking)
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            if new is not None and new[0] != MODE_GITLINK and \
+                    _untracked_below(worktree, path, leaving):
+                untracked.append(path)
+        elif entry is None:
+            if new is not None and \
+                    file_hash(os.path.join(worktree, path), st) != new[1]:
+                untracked.append(path)
+        elif entry.mode_type != 0b1110 and \
+                not stat_matches(entry, st, racy_ns) and \
+                file_hash(os.path.join(worktree, path), st) != entry.sha:
+            modified.append(path)
+
+    if modified:
+        raise Exception(
+            "Your local changes to the following files would be "
+            "overwritten by checkout:\n\t{0}\nPlease commit your "
+            "changes before you switch branches.".format(
+                "\n\t".join(modified)))
+    if untracked:
+        raise Exception(
+            "The following untracked working tree files would be "
+            "overwritten by checkout:\n\t{0}\nPlease move or remove "
+            "them before you switch branches.".format(
+                "\n\t".join(untracked)))
+
+
+def checkout_switch(repo: Repository, old: str | None, new: str,
+                    force=False, workers=None) -> int:
+    """Move the worktree and the index from the tree old (HEAD's, None
+    if there's none yet) to the tree new.
+
+    Only the files tree_diff() finds different are touched, and only
+    their index entries updated: this costs what the diff costs, not
+    what the trees weigh.  Unless force, local changes to those files
+    make it fail before anything is done.  Returns the number of files
+    changed."""
+    changes = list(tree_diff(repo, old, new))
+    index = index_read(repo)
+    if not force:
+        checkout_check(repo, index, changes)
+
+    worktree = str(repo.worktree)
+    # Files going away, deepest first, then their emptied directories
+    dirs = set()
+    for c in sorted(changes, key=lambda c: c.path, reverse=True):
+        if c.new_sha is not None:
+            continue
+        path = c.path
+        full = os.path.join(worktree, path)
+        try:
+            if os.path.isdir(full) and not os.path.islink(full):
+                os.rmdir(full)
+            else:
+                os.unlink(full)
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        except OSError:
+            # A submodule with something in it: left alone, like git
+            pass
+        d = path.rpartition("/")[0]
+        while d and d not in dirs:
+            dirs.add(d)
+            d = d.rpartition("/")[0]
+    for d in sorted(dirs, reverse=True):
+        try:
+            os.rmdir(os.path.join(worktree, d))
+        except OSError:
+            pass
+
+    items = [(c.path, c.new_mode, c.new_sha)
+             for c in changes if c.new_sha is not None]
+    # Directories where files are to be
+    for path, _, _ in items:
+        full = os.path.join(worktree, path)
+        if os.path.isdir(full) and not os.path.islink(full):
+            shutil.rmtree(full)
+    checkout_dirs(worktree, (path for path, _, _ in items))
+    entries = checkout_items(repo, worktree, items, workers)
+
+    changed = {os.fsencode(c.path) for c in changes}
+    index.entries = [e for e in index.entries
+                     if e.raw_name not in changed] + entries
+    index_write(repo, index)
+    return len(changes)
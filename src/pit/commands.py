@@ -1,26 +1,66 @@
+import io
 import os
 import sys
 from pathlib import Path
 import logging
 from typing import List
-from collections import OrderedDict
-from pit.utils import (
+from pit.refs import (
+    ZERO_SHA,
+    REF_LOCK_TIMEOUT,
+    PitRefTransaction,
+    ref_dict,
     ref_list,
+    ref_read,
+    ref_resolve,
+    refs_pack,
 )
+from pit.lockfile import PitLockFile
 from pit.repo import (
     repo_create,
     repo_find,
     repo_file,
+    repo_dir,
     Repository,
 )
 from pit.objects import (
+    HASH_RE,
     object_read,
+    object_read_raw,
+    object_read_header,
+    object_read_stream,
     object_find,
+    object_resolve,
     object_hash,
+    object_hash_stream,
+    hash_many,
+    hash_iter,
     object_write,
+    object_reachable,
+    index_read,
+    index_write,
+    index_entry_from_stat,
+    PitIndex,
     PitTree,
     PitTag,
 )
+from pit.status import status
+from pit.checkout import checkout_tree, checkout_switch
+from pit.diff import tree_diff
+from pit.revision import (
+    rev_parse_revisions,
+    rev_walk,
+    log_format,
+    commit_is_ancestor,
+    merge_bases,
+)
+from pit.commitgraph import commit_graph_write
+from pit.fsck import fsck
+from pit.fsmonitor import PitFSMonitorDaemon, fsmonitor_daemon_stop
+from pit.pack import (
+    PitPackEntry,
+    pack_list,
+    pack_write,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -31,33 +71,62 @@ def cmd_ls_tree(args):
 
 
 def ls_tree(repo: Repository, ref: str, recursive=None, prefix=""):
-    import os
     sha = object_find(repo, ref, fmt=b"tree")
     obj: PitTree = object_read(repo, sha)
-    for item in obj.items:
-        if len(item.mode) == 5:
-            item_type = item.mode[0:1]
-        else:
-            item_type = item.mode[0:2]
-
-        match item_type:  # Determine the type.
-            case b'04': item_type = "tree"
+    for mode, name, binsha in obj.entries():
+        match mode[0:2]:  # Determine the type.
+            case b'40': item_type = "tree"
             case b'10': item_type = "blob"  # A regular file.
             # A symlink. Blob contents is link target.
             case b'12': item_type = "blob"
             case b'16': item_type = "commit"  # A submodule
-            case _: raise Exception(f"Weird tree leaf mode {item.mode}")
+            case _: raise Exception(f"Weird tree leaf mode {mode}")
 
+        path = prefix + name.decode("utf8")
         if not (recursive and item_type == 'tree'):  # This is a leaf
             print("{0} {1} {2}\t{3}".format(
-                "0" * (6 - len(item.mode)) + item.mode.decode("ascii"),
+                mode.decode("ascii").rjust(6, "0"),
                 # Git's ls-tree displays the type
                 # of the object pointed to.  We can do that too :)
                 item_type,
-                item.sha,
-                os.path.join(prefix, item.path)))
+                binsha.hex(),
+                path))
         else:  # This is a branch, recurse
-            ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
+            ls_tree(repo, binsha.hex(), recursive, path + "/")
+
+
+def cmd_diff_tree(args) -> int:
+    repo = repo_find()
+    if len(args.tree) > 2:
+        raise Exception("diff-tree compares two trees, not {0}".format(
+            len(args.tree)))
+    if len(args.tree) == 2:
+        a = object_find(repo, args.tree[0], fmt=b'tree')
+        b = object_find(repo, args.tree[1], fmt=b'tree')
+    else:
+        # A commit, against its first parent
+        sha = object_find(repo, args.tree[0], fmt=b'commit')
+        commit = object_read(repo, sha)
+        if not commit.parents:
+            return 0
+        print(sha)
+        a = object_find(repo, commit.parents[0], fmt=b'tree')
+        b = commit.tree
+    diff_tree(repo, a, b, args.recursive, args.name_only, args.name_status)
+    return 0
+
+
+def diff_tree(repo: Repository, a: str, b: str, recursive=False,
+              name_only=False, name_status=False) -> None:
+    for c in tree_diff(repo, a, b, recursive):
+        if name_only:
+            print(c.path)
+        elif name_status:
+            print("{0}\t{1}".format(c.status, c.path))
+        else:
+            print(":{0:06o} {1:06o} {2} {3} {4}\t{5}".format(
+                c.old_mode, c.new_mode, c.old_sha or "0" * 40,
+                c.new_sha or "0" * 40, c.status, c.path))
 
 
 def cmd_hash_object(args) -> int:
@@ -66,21 +135,107 @@ def cmd_hash_object(args) -> int:
     else:
         repo = None
 
-    with open(args.path, "rb") as fd:
-        sha = object_hash(fd, args.type.encode(), repo)
-        sys.stdout.buffer.write(sha + "\n")
-        sys.stdout.flush()
+    paths = args.path
+    if args.stdin_paths:
+        if paths:
+            raise Exception("Can't specify files with --stdin-paths")
+        paths = (line.rstrip("\n") for line in sys.stdin)
+
+    def hash_other(path):
+        with open(path, "rb") as fd:
+            return object_hash(fd, args.type.encode(), repo)
+
+    if args.type != "blob":
+        shas = map(hash_other, paths)
+    elif args.stdin_paths:
+        shas = hash_iter(repo, paths, write=args.write, workers=args.jobs)
+    else:
+        shas = hash_many(repo, paths, write=args.write, workers=args.jobs)
+    for sha in shas:
+        sys.stdout.write(sha + "\n")
+        # Each SHA goes out as soon as it's known, for callers feeding
+        # paths one at a time
+        if args.stdin_paths:
+            sys.stdout.flush()
+    sys.stdout.flush()
     return 0
 
 
 def cmd_cat_file(args) -> int:
     repo = repo_find()
+    if args.batch or args.batch_check:
+        if args.type is not None:
+            raise Exception("--batch takes no arguments")
+        return cat_file_batch(repo, sys.stdin.buffer, sys.stdout.buffer,
+                              contents=args.batch, flush=not args.buffer)
+    # With -t or -s, the only positional argument is the object
+    if args.show_type or args.show_size:
+        if args.object is not None:
+            raise Exception("Too many arguments")
+        return cat_file_header(repo, args.type, show_size=args.show_size)
+    if args.type is None or args.object is None:
+        raise Exception("Missing object")
+    if args.type not in ("blob", "commit", "tag", "tree"):
+        raise Exception("Unknown type {0}".format(args.type))
     return cat_file(repo, args.object, fmt=args.type.encode())
 
 
 def cat_file(repo, obj, fmt=None) -> int:
-    obj = object_read(repo, object_find(repo, obj, fmt=fmt))
-    sys.stdout.buffer.write(obj.serialize())
+    # Stream the raw content: blobs can be much bigger than memory
+    _, _, chunks = object_read_stream(repo, object_find(repo, obj, fmt=fmt))
+    for chunk in chunks:
+        sys.stdout.buffer.write(chunk)
+    sys.stdout.flush()
+    return 0
+
+
+def cat_file_header(repo, obj, show_size=False) -> int:
+    """Print the type (or size) of obj without reading its content."""
+    fmt, size = object_read_header(repo, object_find(repo, obj))
+    print(size if show_size else fmt.decode("ascii"))
+    return 0
+
+
+def cat_file_batch(repo, inp, out, contents=True, flush=True) -> int:
+    """Read object names from inp, one per line, and write a
+    "<sha> <type> <size>" line for each to out, followed by the content
+    and a newline if contents.  Everything goes through the same repo,
+    so its caches and mapped packs are reused from one object to the
+    next."""
+    hex_chars = set(b"0123456789abcdef")
+    for line in inp:
+        name = line.strip()
+        if not name:
+            continue
+
+        # Full SHAs are by far the common case: skip the resolver
+        if len(name) == 40 and hex_chars.issuperset(name):
+            candidates = [name.decode("ascii")]
+        else:
+            candidates = object_resolve(repo, name.decode("utf8")) or []
+
+        header = None
+        if len(candidates) == 1:
+            sha = candidates[0]
+            header = object_read_header(repo, sha)
+
+        if len(candidates) > 1:
+            out.write(name + b" ambiguous\n")
+        elif header is None:
+            out.write(name + b" missing\n")
+        else:
+            fmt, size = header
+            out.write("{0} {1} {2}\n".format(
+                sha, fmt.decode("ascii"), size).encode("ascii"))
+            if contents:
+                _, _, chunks = object_read_stream(repo, sha)
+                for chunk in chunks:
+                    out.write(chunk)
+                out.write(b"\n")
+
+        if flush:
+            out.flush()
+    out.flush()
     return 0
 
 
@@ -89,8 +244,61 @@ def init(path: str | Path) -> int:
     return 0
 
 
+def cmd_add(args) -> int:
+    return add(files=args.path)
+
+
 def add(cwd: str | Path | None = None, files: List[str] = []):
-    raise NotImplementedError("Add not implemented")
+    """Stage files (directories are walked) in the index of the
+    repository containing cwd."""
+    repo = repo_find(cwd or ".")
+    worktree = os.path.realpath(repo.worktree)
+
+    paths = []
+    for f in files:
+        # Not resolved: a symlink is staged as itself
+        f = os.path.abspath(os.path.join(cwd or ".", f))
+        if os.path.isdir(f) and not os.path.islink(f):
+            for root, dirs, names in os.walk(f):
+                if ".git" in dirs:
+                    dirs.remove(".git")
+                paths.extend(os.path.join(root, n) for n in names)
+                # Symlinks to directories are listed, not walked
+                paths.extend(os.path.join(root, d) for d in dirs
+                             if os.path.islink(os.path.join(root, d)))
+        elif os.path.lexists(f):
+            paths.append(f)
+        else:
+            raise Exception("Pathspec {0} did not match any files".format(f))
+
+    index = index_read(repo)
+    by_name = {e.raw_name: i for i, e in enumerate(index.entries)}
+    for path in paths:
+        # Only the directory is resolved, for the worktree to be found
+        real = os.path.join(os.path.realpath(os.path.dirname(path)),
+                            os.path.basename(path))
+        name = os.path.relpath(real, worktree).replace(os.sep, "/")
+        if name.startswith("../"):
+            raise Exception("{0} is outside repository".format(path))
+
+        st = os.lstat(path)
+        if os.path.islink(path):
+            target = io.BytesIO(os.fsencode(os.readlink(path)))
+            sha = object_hash_stream(target, b'blob', repo)
+        else:
+            with open(path, "rb") as fd:
+                sha = object_hash_stream(fd, b'blob', repo)
+
+        entry = index_entry_from_stat(name, st, sha)
+        i = by_name.get(entry.raw_name)
+        if i is None:
+            by_name[entry.raw_name] = len(index.entries)
+            index.entries.append(entry)
+        elif index.entries[i].fields != entry.fields:
+            index.entries[i] = entry
+
+    index_write(repo, index)
+    return 0
 
 
 def commit(cwd: str | Path | None = None):
@@ -100,42 +308,87 @@ def commit(cwd: str | Path | None = None):
 def cmd_checkout(args):
     repo = repo_find()
 
-    obj = object_read(repo, object_find(repo, args.commit))
+    if args.path is None:
+        return checkout_switch_head(repo, args.commit, force=args.force,
+                                    workers=args.jobs)
 
-    # If the object is a commit, we grab its tree
-    if obj.fmt == b'commit':
-        obj = object_read(repo, obj.kvlm[b'tree'].decode("ascii"))
+    # Follows tags and commits down to the tree
+    tree = object_find(repo, args.commit, fmt=b'tree')
+    path = os.path.realpath(args.path)
+    # The worktree itself, as long as there's nothing but .git in it:
+    # then the index is written as well.
+    worktree = path == os.path.realpath(repo.worktree)
 
     # Verify that path is an empty directory
-    if os.path.exists(args.path):
-        if not os.path.isdir(args.path):
-            raise Exception("Not a directory {0}!".format(args.path))
-        if os.listdir(args.path):
-            raise Exception("Not empty {0}!".format(args.path))
+    if os.path.exists(path):
+        if not os.path.isdir(path):
+            raise Exception("Not a directory {0}!".format(path))
+        if set(os.listdir(path)) - ({".git"} if worktree else set()):
+            raise Exception("Not empty {0}!".format(path))
     else:
-        os.makedirs(args.path)
+        os.makedirs(path)
 
-    tree_checkout(repo, obj, os.path.realpath(args.path))
+    entries = checkout_tree(repo, tree, path, workers=args.jobs)
+    if worktree:
+        index_write(repo, PitIndex(entries=entries))
 
 
-def tree_checkout(repo: Repository, tree: PitTree, path: str | Path):
-    for item in tree.items:
-        obj = object_read(repo, item.sha)
-        dest = os.path.join(path, item.path)
+def checkout_switch_head(repo: Repository, name: str, force=False,
+                         workers=None) -> int:
+    """Switch the worktree, the index and HEAD to name: a branch, which
+    HEAD then points to, or any commit, HEAD being detached."""
+    commit = object_find(repo, name, fmt=b'commit')
+    old = object_find(repo, "HEAD", fmt=b'tree') \
+        if ref_resolve(repo, "HEAD") else None
+    checkout_switch(repo, old, object_find(repo, commit, fmt=b'tree'),
+                    force=force, workers=workers)
 
-        if obj.fmt == b'tree':
-            os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
-            # TODO: Support symlinks (identified by mode 12****)
-            with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+    if ref_read(repo, "refs/heads/" + name) is not None:
+        head = "ref: refs/heads/{0}\n".format(name)
+    else:
+        head = commit + "\n"
+    with PitLockFile(repo_file(repo, "HEAD"),
+                     timeout=REF_LOCK_TIMEOUT) as lock:
+        lock.write(head.encode("utf8"))
+        lock.commit()
+    return 0
+
+
+def cmd_status(args) -> int:
+    repo = repo_find()
+    st = status(repo, untracked=not args.no_untracked, workers=args.jobs)
+
+    # Short format: staged and unstaged state, then the path
+    for path in sorted(set(st.staged) | set(st.unstaged)):
+        print("{0}{1} {2}".format(st.staged.get(path, " "),
+                                  st.unstaged.get(path, " "), path))
+    for path in st.untracked:
+        print("?? {0}".format(path))
+    return 0
+
+
+def cmd_fsmonitor_daemon(args) -> int:
+    repo = repo_find()
+    if args.stop:
+        if not fsmonitor_daemon_stop(repo):
+            print("fsmonitor-daemon is not running", file=sys.stderr)
+            return 1
+        return 0
+    # Runs until stopped
+    PitFSMonitorDaemon(repo).serve()
+    return 0
 
 
 def cmd_show_ref(args):
     repo = repo_find()
-    refs = ref_list(repo)
-    show_ref(repo, refs, prefix="refs")
+    for name, sha in ref_dict(repo).items():
+        print("{0} {1}".format(sha, name))
+
+
+def cmd_pack_refs(args) -> int:
+    repo = repo_find()
+    refs_pack(repo, all_refs=args.all, prune=not args.no_prune)
+    return 0
 
 
 def show_ref(repo, refs, with_hash=True, prefix=""):
@@ -169,8 +422,8 @@ def tag_create(repo, name, ref, create_tag_object=False):
 
     if create_tag_object:
         # create tag object (commit)
-        tag = PitTag(repo)
-        tag.kvlm = OrderedDict()
+        tag = PitTag()
+        tag.kvlm = dict()
         tag.kvlm[b'object'] = sha.encode()
         tag.kvlm[b'type'] = b'commit'
         tag.kvlm[b'tag'] = name.encode()
@@ -178,8 +431,8 @@ def tag_create(repo, name, ref, create_tag_object=False):
         # Notice you can fix this after commit, read on!
         tag.kvlm[b'tagger'] = b'Pitter <pit@example.com>'
         # …and a tag message!
-        tag.kvlm[None] = b"A tag generated by pit, which won't let you customize the message!"
-        tag_sha = object_write(tag)
+        tag.kvlm[None] = b"A tag generated by pit, which won't let you customize the message!\n"
+        tag_sha = object_write(tag, repo)
         # create reference
         ref_create(repo, "tags/" + name, tag_sha)
     else:
@@ -188,8 +441,60 @@ def tag_create(repo, name, ref, create_tag_object=False):
 
 
 def ref_create(repo, ref_name, sha):
-    with open(repo_file(repo, "refs/" + ref_name), 'w') as fp:
-        fp.write(sha + "\n")
+    tx = PitRefTransaction(repo)
+    tx.create("refs/" + ref_name, sha)
+    tx.commit()
+
+
+def cmd_update_ref(args) -> int:
+    repo = repo_find()
+    tx = PitRefTransaction(repo, packed=args.packed)
+    if args.stdin:
+        for line in sys.stdin:
+            update_ref_queue(repo, tx, line.split())
+    elif args.delete:
+        update_ref_queue(repo, tx, ["delete", *args.args])
+    else:
+        update_ref_queue(repo, tx, ["update", *args.args])
+    tx.commit()
+    return 0
+
+
+def update_ref_queue(repo: Repository, tx: PitRefTransaction,
+                     words: list[str]) -> None:
+    """Add to tx the update of words, git update-ref --stdin style:
+    "create <ref> <new>", "update <ref> <new> [<old>]",
+    "delete <ref> [<old>]" or "verify <ref> [<old>]"."""
+    def value(name):
+        # Full SHAs are taken as they are, as git does
+        if len(name) == 40 and HASH_RE.match(name):
+            return name.lower()
+        found = object_resolve(repo, name)
+        if not found or len(found) > 1:
+            print("fatal: {0}: not a valid SHA1".format(name),
+                  file=sys.stderr)
+            sys.exit(128)
+        return found[0]
+
+    if not words:
+        return
+    command, *rest = words
+    counts = {"create": (2, 2), "update": (2, 3), "delete": (1, 2),
+              "verify": (1, 2)}
+    if command not in counts:
+        raise Exception("unknown command: {0}".format(command))
+    if not counts[command][0] <= len(rest) <= counts[command][1]:
+        raise Exception("{0}: wrong number of arguments".format(command))
+    name = rest[0]
+    if command == "create":
+        tx.create(name, value(rest[1]))
+    elif command == "update":
+        tx.update(name, value(rest[1]),
+                  value(rest[2]) if len(rest) > 2 else None)
+    elif command == "delete":
+        tx.delete(name, value(rest[1]) if len(rest) > 1 else None)
+    else:
+        tx.verify(name, value(rest[1]) if len(rest) > 1 else ZERO_SHA)
 
 
 def cmd_rev_parse(args):
@@ -201,3 +506,141 @@ def cmd_rev_parse(args):
     repo = repo_find()
 
     print(object_find(repo, args.name, fmt, follow=True))
+
+
+def cmd_rev_list(args) -> int:
+    repo = repo_find()
+    include, exclude = rev_parse_revisions(repo, args.revisions)
+    for sha in rev_walk(repo, include, exclude, max_count=args.max_count,
+                        first_parent=args.first_parent,
+                        topo_order=args.topo_order,
+                        paths=getattr(args, "paths", None)):
+        print(sha)
+    return 0
+
+
+def cmd_log(args) -> int:
+    repo = repo_find()
+    include, exclude = rev_parse_revisions(repo, args.revisions)
+    walk = rev_walk(repo, include, exclude, max_count=args.max_count,
+                    first_parent=args.first_parent,
+                    topo_order=args.topo_order,
+                    paths=getattr(args, "paths", None))
+    for i, sha in enumerate(walk):
+        # Commits are shown as they are found
+        if i and not args.oneline:
+            print()
+        print(log_format(repo, sha, object_read(repo, sha),
+                         oneline=args.oneline))
+    return 0
+
+
+def cmd_merge_base(args) -> int:
+    repo = repo_find()
+    a, b = rev_parse_revisions(repo, [args.commit1, args.commit2])[0]
+    # Answered with the exit status, like git
+    if args.is_ancestor:
+        sys.exit(0 if commit_is_ancestor(repo, a, b) else 1)
+    bases = merge_bases(repo, a, b)
+    if not bases:
+        sys.exit(1)
+    for sha in bases if args.all else bases[:1]:
+        print(sha)
+    return 0
+
+
+def cmd_commit_graph(args) -> int:
+    repo = repo_find()
+    match args.action:
+        case "write":
+            count = commit_graph_write(repo, ref_roots(repo),
+                                       changed_paths=args.changed_paths)
+            logger.info("Wrote %d commits to the commit-graph", count)
+    return 0
+
+
+def ref_roots(repo: Repository) -> list[str]:
+    """The SHAs every ref (and HEAD) points to."""
+    roots = []
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        roots.append(head)
+    for sha in ref_dict(repo).values():
+        if sha not in roots:
+            roots.append(sha)
+    return roots
+
+
+def cmd_fsck(args) -> int:
+    repo = repo_find()
+    progress = args.progress
+    if progress is None:
+        progress = sys.stderr.isatty()
+    report = fsck(repo, workers=args.jobs, progress=progress)
+    for error in report.errors:
+        print("error: {0}".format(error), file=sys.stderr)
+    for sha, fmt in sorted(report.missing.items()):
+        print("missing {0} {1}".format(fmt.decode("ascii"), sha))
+    for sha, fmt in sorted(report.dangling.items()):
+        print("dangling {0} {1}".format(fmt.decode("ascii"), sha))
+    # Dangling objects are no error, like git
+    if report.errors or report.missing:
+        sys.exit(1)
+    return 0
+
+
+def cmd_repack(args):
+    repo = repo_find()
+    repack(repo, window=args.window, depth=args.depth, delete=args.delete)
+
+
+def cmd_gc(args):
+    repo = repo_find()
+    repack(repo, window=args.window, depth=args.depth, delete=True)
+
+
+def repack(repo: Repository, window=10, depth=50, delete=False):
+    """Pack every object reachable from the refs into a single pack.
+
+    If delete, also remove the packs made redundant by the new one and
+    the loose copies of the packed objects."""
+    entries = [PitPackEntry(sha, fmt, path)
+               for sha, fmt, path in object_reachable(repo, ref_roots(repo))]
+    if not entries:
+        return None
+
+    # Objects nobody references anymore are only dropped along with a
+    # pack if the new pack has everything else.
+    packed = set(e.sha for e in entries)
+    redundant = [pack.path for pack in pack_list(repo)
+                 if all(sha.hex() in packed
+                        for sha in pack.index.iter_shas())]
+
+    path = pack_write(repo, entries, lambda sha: object_read_raw(repo, sha),
+                      window=window, depth=depth)
+
+    if delete:
+        for pack_path in redundant:
+            if pack_path != path:
+                os.remove(pack_path.with_suffix(".idx"))
+                os.remove(pack_path)
+        prune_packed(repo, packed)
+
+    logger.info("Packed %d objects into %s", len(entries), path)
+    return path
+
+
+def prune_packed(repo: Repository, shas):
+    """Remove the loose copies of shas."""
+    objects = repo_dir(repo, "objects")
+    dirs = set()
+    for sha in shas:
+        path = objects / sha[0:2] / sha[2:]
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        dirs.add(path.parent)
+    for d in dirs:
+        if not os.listdir(d):
+            os.rmdir(d)
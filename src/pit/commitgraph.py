@@ -0,0 +1,317 @@
+import hashlib
+import itertools
+import mmap
+import os
+import struct
+from pathlib import Path
+from pit.repo import Repository, repo_file
+from pit.lockfile import PitLockFile
+from pit.objects import object_read
+from pit.bloom import (
+    BLOOM_HASH_VERSION,
+    BLOOM_NUM_HASHES,
+    BLOOM_BITS_PER_ENTRY,
+    bloom_filter_compute,
+)
+
+# The commit-graph file (objects/info/commit-graph) holds, for every
+# commit it knows, its tree, its parents, its date and its generation
+# number, in fixed-width records: walking history with it reads no
+# object at all.  The generation of a commit is 1 for root commits, 1
+# more than the largest of its parents' otherwise: a commit can't reach
+# another one with a generation as large as its own.
+
+GRAPH_SIGNATURE = b'CGPH'
+GRAPH_VERSION = 1
+GRAPH_HASH_SHA1 = 1
+
+CHUNK_FANOUT = b'OIDF'
+CHUNK_OIDS = b'OIDL'
+CHUNK_DATA = b'CDAT'
+CHUNK_EXTRA_EDGES = b'EDGE'
+# Changed-path Bloom filters (see pit.bloom): their end offsets in BDAT,
+# then a header (hash version, number of hashes, bits per entry) and the
+# filters
+CHUNK_BLOOM_INDEXES = b'BIDX'
+CHUNK_BLOOM_DATA = b'BDAT'
+BLOOM_HEADER = struct.Struct(">LLL")
+
+# Tree, first and second parent, then generation and date
+GRAPH_DATA = struct.Struct(">20sLLLL")
+GRAPH_PARENT_NONE = 0x70000000
+# A second "parent" with this bit set is an index in the EDGE chunk,
+# where the parents from the second one on are listed, the last one
+# with this bit set.
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+GENERATION_MAX = 0x3FFFFFFF
+
+# The generation of commits the graph doesn't know
+GENERATION_INFINITY = 0xFFFFFFFF
+
+
+class PitCommitGraph:
+    """A memory-mapped commit-graph file.
+
+    Layout: an 8 bytes header (signature, version, hash version, number
+    of chunks, number of base graphs), a table of chunks (4 bytes id, 8
+    bytes offset, ending with a zero id), the chunks, and the SHA-1 of
+    all that."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[0:4] != GRAPH_SIGNATURE:
+            raise Exception("Not a commit-graph: {0}".format(path))
+        if self.map[4] != GRAPH_VERSION or self.map[5] != GRAPH_HASH_SHA1:
+            raise Exception("Unsupported commit-graph version {0}".format(
+                self.map[4]))
+        if self.map[7]:
+            raise Exception("Split commit-graphs are not supported")
+
+        self.chunks = {}
+        count = self.map[6]
+        for i in range(count):
+            chunk_id, start = struct.unpack_from(">4sQ", self.map, 8 + 12 * i)
+            end = struct.unpack_from(">Q", self.map, 8 + 12 * (i + 1) + 4)[0]
+            self.chunks[chunk_id] = (start, end)
+        for chunk_id in (CHUNK_FANOUT, CHUNK_OIDS, CHUNK_DATA):
+            if chunk_id not in self.chunks:
+                raise Exception("commit-graph {0} has no {1} chunk".format(
+                    path, chunk_id.decode()))
+
+        self.fanout = struct.unpack_from(
+            ">256L", self.map, self.chunks[CHUNK_FANOUT][0])
+        self.count = self.fanout[255]
+        self.oids = self.chunks[CHUNK_OIDS][0]
+        self.data = self.chunks[CHUNK_DATA][0]
+        self.edges = self.chunks.get(CHUNK_EXTRA_EDGES, (0, 0))[0]
+
+        # (hash version, number of hashes, bits per entry) of the Bloom
+        # filters, None if there are none
+        self.bloom_settings = None
+        if CHUNK_BLOOM_INDEXES in self.chunks and \
+                CHUNK_BLOOM_DATA in self.chunks:
+            start = self.chunks[CHUNK_BLOOM_DATA][0]
+            settings = BLOOM_HEADER.unpack_from(self.map, start)
+            if settings[0] in (1, 2):
+                self.bloom_settings = settings
+                self.bloom_indexes = self.chunks[CHUNK_BLOOM_INDEXES][0]
+                self.bloom_data = start + BLOOM_HEADER.size
+
+    def close(self) -> None:
+        self.map.close()
+
+    def oid(self, pos: int) -> bytes:
+        start = self.oids + 20 * pos
+        return self.map[start:start + 20]
+
+    def position(self, binsha: bytes) -> int | None:
+        """The position of binsha in the graph, if it's there."""
+        first = binsha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        m = self.map
+        base = self.oids
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = m[base + 20 * mid:base + 20 * mid + 20]
+            if found < binsha:
+                lo = mid + 1
+            elif found > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def record(self, pos: int) -> tuple:
+        """(tree, parent positions, generation, date) of the commit at
+        pos."""
+        tree, p1, p2, gen, date = GRAPH_DATA.unpack_from(
+            self.map, self.data + GRAPH_DATA.size * pos)
+        parents = []
+        if p1 != GRAPH_PARENT_NONE:
+            parents.append(p1)
+        if p2 & GRAPH_EXTRA_EDGES and p2 != GRAPH_PARENT_NONE:
+            i = self.edges + 4 * (p2 & ~GRAPH_EXTRA_EDGES)
+            while True:
+                edge = int.from_bytes(self.map[i:i + 4], "big")
+                parents.append(edge & ~GRAPH_LAST_EDGE)
+                if edge & GRAPH_LAST_EDGE:
+                    break
+                i += 4
+        elif p2 != GRAPH_PARENT_NONE:
+            parents.append(p2)
+        return tree, parents, gen >> 2, ((gen & 3) << 32) | date
+
+    def lookup(self, sha: str) -> tuple | None:
+        """(parents, date, generation) of the commit sha, or None if the
+        graph doesn't have it."""
+        pos = self.position(bytes.fromhex(sha))
+        if pos is None:
+            return None
+        _, parents, gen, date = self.record(pos)
+        return [self.oid(p).hex() for p in parents], date, gen
+
+    def lookup_tree(self, sha: str) -> str | None:
+        """The tree of the commit sha, or None if the graph doesn't have
+        it."""
+        pos = self.position(bytes.fromhex(sha))
+        if pos is None:
+            return None
+        start = self.data + GRAPH_DATA.size * pos
+        return self.map[start:start + 20].hex()
+
+    def bloom_filter(self, sha: str) -> bytes | None:
+        """The changed-path Bloom filter of the commit sha, or None if
+        the graph doesn't have one."""
+        if self.bloom_settings is None:
+            return None
+        pos = self.position(bytes.fromhex(sha))
+        if pos is None:
+            return None
+        end = struct.unpack_from(">L", self.map,
+                                 self.bloom_indexes + 4 * pos)[0]
+        start = struct.unpack_from(
+            ">L", self.map, self.bloom_indexes + 4 * pos - 4)[0] if pos else 0
+        return self.map[self.bloom_data + start:self.bloom_data + end]
+
+
+def commit_graph_get(repo: Repository) -> PitCommitGraph | None:
+    """The commit-graph of repo, (re)loaded if the file changed since
+    the last call, or None if there's none."""
+    if not repo.conf.getboolean("core", "commitgraph", fallback=True):
+        return None
+    path = os.path.join(repo.gitdir, "objects", "info", "commit-graph")
+    try:
+        st = os.stat(path)
+        signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+    except FileNotFoundError:
+        signature = None
+    if repo.commit_graph is not None and repo.commit_graph[0] == signature:
+        return repo.commit_graph[1]
+
+    if repo.commit_graph is not None and repo.commit_graph[1] is not None:
+        repo.commit_graph[1].close()
+    graph = PitCommitGraph(path) if signature else None
+    repo.commit_graph = (signature, graph)
+    return graph
+
+
+def commit_graph_write(repo: Repository, shas, changed_paths=None) -> int:
+    """Write the commit-graph of the commits reachable from shas (tags
+    are followed).  Returns the number of commits in it.
+
+    With changed_paths, the graph gets changed-path Bloom filters; None
+    means as the current graph, whose filters are reused.  Computing
+    them costs a tree diff per commit."""
+    old = commit_graph_get(repo)
+    if changed_paths is None:
+        changed_paths = old is not None and old.bloom_settings is not None
+    # Filters computed with other settings can't be reused
+    if old is not None and old.bloom_settings != (
+            BLOOM_HASH_VERSION, BLOOM_NUM_HASHES, BLOOM_BITS_PER_ENTRY):
+        old = None
+
+    # Every commit, with its tree, parents and date
+    commits = {}
+    pending = list(shas)
+    while pending:
+        sha = pending.pop()
+        if sha in commits:
+            continue
+        obj = object_read(repo, sha)
+        if obj is None:
+            raise Exception("Missing object {0}".format(sha))
+        if obj.fmt == b'tag':
+            pending.append(obj.kvlm[b'object'].decode("ascii"))
+            continue
+        if obj.fmt != b'commit':
+            continue
+        commits[sha] = (obj.tree, obj.parents, obj.committer_time)
+        pending.extend(p for p in obj.parents if p not in commits)
+
+    # Generations, parents first, without recursing
+    generation = {}
+    for sha in commits:
+        stack = [sha]
+        while stack:
+            top = stack[-1]
+            if top in generation:
+                stack.pop()
+                continue
+            missing = [p for p in commits[top][1] if p not in generation]
+            if missing:
+                stack.extend(missing)
+                continue
+            stack.pop()
+            generation[top] = min(GENERATION_MAX, 1 + max(
+                (generation[p] for p in commits[top][1]), default=0))
+
+    order = sorted(commits)
+    position = {sha: i for i, sha in enumerate(order)}
+
+    fanout = [0] * 256
+    for sha in order:
+        fanout[int(sha[:2], 16)] += 1
+    fanout = list(itertools.accumulate(fanout))
+
+    data = []
+    edges = []
+    for sha in order:
+        tree, parents, date = commits[sha]
+        links = [position[p] for p in parents]
+        p1 = links[0] if links else GRAPH_PARENT_NONE
+        if len(links) > 2:
+            p2 = GRAPH_EXTRA_EDGES | len(edges)
+            edges += links[1:]
+            edges[-1] |= GRAPH_LAST_EDGE
+        else:
+            p2 = links[1] if len(links) == 2 else GRAPH_PARENT_NONE
+        data.append(GRAPH_DATA.pack(
+            bytes.fromhex(tree), p1, p2,
+            (generation[sha] << 2) | ((date >> 32) & 3), date & 0xFFFFFFFF))
+
+    chunks = [(CHUNK_FANOUT, struct.pack(">256L", *fanout)),
+              (CHUNK_OIDS, b''.join(bytes.fromhex(sha) for sha in order)),
+              (CHUNK_DATA, b''.join(data))]
+    if edges:
+        chunks.append((CHUNK_EXTRA_EDGES, struct.pack(
+            ">{0}L".format(len(edges)), *edges)))
+    if changed_paths:
+        filters = []
+        for sha in order:
+            found = old.bloom_filter(sha) if old is not None else None
+            if found is None:
+                tree, parents = commits[sha][:2]
+                found = bloom_filter_compute(
+                    repo, tree, commits[parents[0]][0] if parents else None)
+            filters.append(found)
+        chunks.append((CHUNK_BLOOM_INDEXES, struct.pack(
+            ">{0}L".format(len(filters)),
+            *itertools.accumulate(len(f) for f in filters))))
+        chunks.append((CHUNK_BLOOM_DATA, BLOOM_HEADER.pack(
+            BLOOM_HASH_VERSION, BLOOM_NUM_HASHES, BLOOM_BITS_PER_ENTRY)
+            + b''.join(filters)))
+    _commit_graph_write_file(repo, chunks)
+    return len(order)
+
+
+def _commit_graph_write_file(repo: Repository, chunks: list) -> None:
+    parts = [GRAPH_SIGNATURE,
+             bytes([GRAPH_VERSION, GRAPH_HASH_SHA1, len(chunks), 0])]
+    offset = 8 + 12 * (len(chunks) + 1)
+    for chunk_id, content in chunks:
+        parts.append(struct.pack(">4sQ", chunk_id, offset))
+        offset += len(content)
+    parts.append(struct.pack(">4sQ", bytes(4), offset))
+    parts += [content for _, content in chunks]
+    data = b''.join(parts)
+
+    path = repo_file(repo, "objects", "info", "commit-graph", mkdir=True)
+    with PitLockFile(path) as lock:
+        lock.write(data)
+        lock.write(hashlib.sha1(data).digest())
+        lock.commit()
@@ -0,0 +1,104 @@
+import stat
+from pit.repo import Repository
+from pit.objects import object_read
+
+MODE_TREE = 0o40000
+
+
+class PitTreeChange:
+    """A path that differs between two trees.
+
+    status is "A" (added), "D" (deleted), "M" (modified: content or
+    mode) or "T" (type changed, like a file becoming a symlink).  The
+    mode and SHA of the missing side are 0 and None."""
+
+    __slots__ = ("status", "path", "old_mode", "new_mode", "old_sha",
+                 "new_sha")
+
+    def __init__(self, status: str, path: str, old_mode: int,
+                 new_mode: int, old_sha: str | None, new_sha: str | None):
+        self.status = status
+        self.path = path
+        self.old_mode = old_mode
+        self.new_mode = new_mode
+        self.old_sha = old_sha
+        self.new_sha = new_sha
+
+    def __repr__(self):
+        return "PitTreeChange({0!r}, {1!r})".format(self.status, self.path)
+
+
+def _tree_entries(repo: Repository, sha: str | None) -> list[tuple]:
+    """(sort key, name, mode, binary SHA) for the entries of the tree
+    sha, names as bytes.
+
+    Trees sort as if their name ended with "/", which is the order
+    entries are stored in."""
+    if sha is None:
+        return []
+    ret = []
+    for mode, name, binsha in object_read(repo, sha).entries():
+        mode = int(mode, 8)
+        ret.append((name + b'/' if mode == MODE_TREE else name, name, mode,
+                    binsha))
+    return ret
+
+
+def tree_diff(repo: Repository, a: str | None, b: str | None,
+              recursive=True, prefix=""):
+    """Yield a PitTreeChange for each path that differs between the
+    trees a and b, in the order git diff-tree shows them.  Either tree
+    can be None, for an empty one.
+
+    Both trees are walked together in their sorted order.  Entries with
+    the same mode and SHA on both sides are skipped: unchanged subtrees
+    are never read.  With recursive, changed subtrees are walked into
+    and only their files show up, otherwise they are changes
+    themselves."""
+    old = _tree_entries(repo, a)
+    new = _tree_entries(repo, b)
+    i = j = 0
+    while i < len(old) or j < len(new):
+        x = old[i] if i < len(old) else None
+        y = new[j] if j < len(new) else None
+        if y is None or (x is not None and x[0] < y[0]):
+            i += 1
+            y = None
+        elif x is None or y[0] < x[0]:
+            j += 1
+            x = None
+        else:
+            i += 1
+            j += 1
+            if x[2:] == y[2:]:
+                continue
+
+        path = prefix + (x or y)[1].decode("utf8")
+        if recursive and (x or y)[2] == MODE_TREE:
+            # A file and a tree with the same name don't meet here: a
+            # tree's key ends with "/"
+            yield from tree_diff(repo, x[3].hex() if x else None,
+                                 y[3].hex() if y else None, True, path + "/")
+        elif x is None:
+            yield PitTreeChange("A", path, 0, y[2], None, y[3].hex())
+        elif y is None:
+            yield PitTreeChange("D", path, x[2], 0, x[3].hex(), None)
+        else:
+            status = "M" if stat.S_IFMT(x[2]) == stat.S_IFMT(y[2]) else "T"
+            yield PitTreeChange(status, path, x[2], y[2], x[3].hex(),
+                                y[3].hex())
+
+
+def tree_entry(repo: Repository, tree: str, path: str) -> tuple | None:
+    """(mode, binary SHA) of path in the tree sha, None if it isn't
+    there.  Only the trees on the way are read."""
+    found = None
+    for name in path.split("/"):
+        if found is not None:
+            if int(found.mode, 8) != MODE_TREE:
+                return None
+            tree = found.binsha.hex()
+        found = object_read(repo, tree).find(name)
+        if found is None:
+            return None
+    return int(found.mode, 8), found.binsha
@@ -0,0 +1,75 @@
+import struct
+
+# EWAH compressed bitmaps, as used by git in the index extensions
+# (and bitmap indexes).  On disk: the number of bits, the number of
+# 64-bit words, the words, and the position of the last "running
+# length word".  A running length word says how many words of all 0s
+# or all 1s come next (bit 0 is the value, bits 1-32 the count), and
+# how many literal words follow it (bits 33-63).  Within words, bit i
+# of the bitmap is bit i % 64 of word i // 64.
+
+
+def ewah_read(data: bytes, pos: int = 0) -> tuple[list[int], int]:
+    """Read the bitmap at pos.  Returns the positions of the bits set,
+    in increasing order, and the position after the bitmap."""
+    bit_size, count = struct.unpack_from(">LL", data, pos)
+    pos += 8
+    words = struct.unpack_from(">{0}Q".format(count), data, pos)
+    pos += 8 * count + 4
+
+    ret = []
+    bit = 0
+    i = 0
+    while i < count:
+        rlw = words[i]
+        i += 1
+        run = ((rlw >> 1) & 0xFFFFFFFF) * 64
+        if rlw & 1:
+            ret.extend(range(bit, bit + run))
+        bit += run
+        for _ in range(rlw >> 33):
+            word = words[i]
+            i += 1
+            while word:
+                low = word & -word
+                ret.append(bit + low.bit_length() - 1)
+                word ^= low
+            bit += 64
+    return [b for b in ret if b < bit_size], pos
+
+
+def ewah_write(bits) -> bytes:
+    """Serialize a bitmap with the given bits set.  Like git's, it ends
+    with the last bit set.
+
+    Runs of empty words are compressed, which is what matters for the
+    sparse bitmaps of the index."""
+    literal = {}
+    bit_size = 0
+    for b in bits:
+        literal[b // 64] = literal.get(b // 64, 0) | (1 << (b % 64))
+        bit_size = max(bit_size, b + 1)
+
+    nwords = (bit_size + 63) // 64
+    words = []
+    last_rlw = 0
+    w = 0
+    while w < nwords or not words:
+        # Count the empty words, then the literal ones
+        start = w
+        while w < nwords and w not in literal and w - start < 0xFFFFFFFF:
+            w += 1
+        run = w - start
+        lits = []
+        while w < nwords and w in literal and len(lits) < 0x7FFFFFFF:
+            lits.append(literal[w])
+            w += 1
+        last_rlw = len(words)
+        words.append((len(lits) << 33) | (run << 1))
+        words.extend(lits)
+        if w >= nwords:
+            break
+
+    return (struct.pack(">LL", bit_size, len(words))
+            + struct.pack(">{0}Q".format(len(words)), *words)
+            + struct.pack(">L", last_rlw))
@@ -0,0 +1,493 @@
+import hashlib
+import os
+import sys
+import time
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pit.repo import Repository
+from pit.cache import PitLRUCache
+from pit.refs import ref_dict, ref_resolve
+from pit.pack import (
+    OBJ_BLOB,
+    OBJ_TREE,
+    PitPack,
+    TYPE_NAMES,
+    TYPE_NUMBERS,
+    pack_list,
+)
+from pit.objects import (
+    index_read,
+    kvlm_parse,
+    loose_oids,
+)
+
+# Checking every object: loose ones are inflated, packed ones read with
+# their deltas resolved, then all are hashed again and parsed.  That is
+# spread over processes, by batches: a fanout directory of loose
+# objects, or a run of consecutive entries of a pack.  Each batch sends
+# back the objects it found and what they link to, and the parent
+# process checks the links: objects reachable from the refs, the index
+# or the reflogs must exist, and those nobody links to are dangling.
+
+# Pack entries per batch
+FSCK_BATCH = 4096
+# Bytes of inflated objects a worker keeps per pack, as delta bases of
+# the entries that follow
+FSCK_BASE_CACHE = 64 * 1024 * 1024
+
+TREE_MODES = frozenset((b'40000', b'100644', b'100755', b'120000',
+                        b'160000'))
+
+
+class PitFsckBatch:
+    """What checking a batch of objects found.
+
+    objects holds a 21-byte record per valid object, its binary SHA and
+    its type number; links maps the binary SHA of each tree, commit and
+    tag to the records of the objects it links to, with the type they
+    should have.  size is the bytes read from disk."""
+
+    def __init__(self):
+        self.count = 0
+        self.size = 0
+        self.objects = bytearray()
+        self.links = {}
+        self.errors = []
+
+
+class PitFsckReport:
+    """The outcome of fsck: error messages, and the missing and dangling
+    objects as {sha: fmt}."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = []
+        self.missing = {}
+        self.dangling = {}
+
+
+class PitProgress:
+    """A progress line on a terminal, git style:
+
+        Checking objects: 45% (4500/10000), 12.00 MiB | 4.00 MiB/s
+
+    redrawn at most every interval seconds."""
+
+    def __init__(self, title: str, total: int, out=None, interval=0.5):
+        self.title = title
+        self.total = total
+        self.out = out or sys.stderr
+        self.interval = interval
+        self.count = 0
+        self.size = 0
+        self.start = time.monotonic()
+        self.shown = 0.0
+
+    def update(self, count: int, size=0) -> None:
+        self.count += count
+        self.size += size
+        now = time.monotonic()
+        if now - self.shown >= self.interval:
+            self.shown = now
+            self._show("\r")
+
+    def done(self) -> None:
+        self._show(", done.\n")
+
+    def _show(self, end: str) -> None:
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        pct = self.count * 100 // self.total if self.total else 100
+        self.out.write("\r{0}: {1:3d}% ({2}/{3}), {4:.2f} MiB | "
+                       "{5:.2f} MiB/s{6}".format(
+                           self.title, pct, self.count, self.total,
+                           self.size / 2**20, self.size / 2**20 / elapsed,
+                           end))
+        self.out.flush()
+
+
+def fsck(repo: Repository, workers=None, progress=False) -> PitFsckReport:
+    """Check the integrity of every object of repo, and that the objects
+    reachable from its refs are all there.
+
+    Batches of objects are checked on a pool of worker processes (as
+    many as CPUs by default, none with workers=1).  With progress, the
+    objects checked and the throughput are shown on stderr as batches
+    complete."""
+    report = PitFsckReport()
+    tasks, total = fsck_tasks(repo)
+    meter = PitProgress("Checking objects", total) if progress else None
+
+    types = {}
+    links = {}
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(tasks) < 2:
+        caches = {}
+        results = (_fsck_task(task, repo, caches) for task in tasks)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        # Larger tasks first, not to wait for one at the end
+        tasks.sort(key=lambda task: -task[-1])
+        results = (future.result() for future in as_completed(
+            [pool.submit(_fsck_task, task) for task in tasks]))
+    try:
+        for batch in results:
+            report.count += batch.count
+            report.errors += batch.errors
+            records = bytes(batch.objects)
+            types.update(zip((records[i:i + 20]
+                              for i in range(0, len(records), 21)),
+                             records[20::21]))
+            links.update(batch.links)
+            if meter:
+                meter.update(batch.count, batch.size)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    if meter:
+        meter.done()
+
+    fsck_connectivity(repo, report, types, links)
+    report.errors.sort()
+    return report
+
+
+def fsck_tasks(repo: Repository) -> tuple[list[tuple], int]:
+    """The batches of objects of repo to check, and how many objects
+    there are.  Tasks are tuples, their last item the bytes they'll
+    read roughly."""
+    tasks = []
+    total = 0
+    objects = os.path.join(repo.gitdir, "objects")
+    for fanout in sorted(os.listdir(objects)):
+        if len(fanout) != 2:
+            continue
+        count = len(loose_oids(repo, fanout))
+        if count:
+            tasks.append(("loose", str(repo.worktree), fanout, count * 1024))
+            total += count
+
+    for pack in pack_list(repo):
+        index = pack.index
+        total += len(index)
+        tasks.append(("pack", str(repo.worktree), str(pack.path),
+                      len(pack.map)))
+        # Entries in pack order, so delta bases come before their deltas
+        order = sorted(range(len(index)), key=index.offset_at)
+        offsets = [index.offset_at(i) for i in order]
+        offsets.append(len(pack.map) - 20)
+        for start in range(0, len(order), FSCK_BATCH):
+            stop = min(start + FSCK_BATCH, len(order))
+            tasks.append(("entries", str(repo.worktree), str(pack.path),
+                          array("I", order[start:stop]),
+                          array("Q", offsets[start:stop + 1]),
+                          offsets[stop] - offsets[start]))
+    return tasks, total
+
+
+# Repositories opened by the workers, by worktree, and the delta bases
+# they keep, by pack
+_worker_repos = {}
+_worker_bases = {}
+
+
+def _fsck_task(task: tuple, repo=None, caches=None) -> PitFsckBatch:
+    kind, worktree = task[:2]
+    if repo is None:
+        repo = _worker_repos.get(worktree)
+    if repo is None:
+        repo = _worker_repos[worktree] = Repository(worktree)
+    if caches is None:
+        caches = _worker_bases
+    batch = PitFsckBatch()
+    if kind == "loose":
+        fsck_loose(repo, task[2], batch)
+    else:
+        pack = next(p for p in pack_list(repo) if str(p.path) == task[2])
+        if kind == "pack":
+            fsck_pack_checksums(pack, batch)
+        else:
+            bases = caches.get(task[2])
+            if bases is None:
+                bases = caches[task[2]] = PitLRUCache(FSCK_BASE_CACHE)
+            fsck_pack_entries(repo, pack, task[3], task[4], bases, batch)
+    return batch
+
+
+def fsck_loose(repo: Repository, fanout: str, batch: PitFsckBatch) -> None:
+    """Check the loose objects of the fanout directory."""
+    for name in loose_oids(repo, fanout):
+        path = os.path.join(repo.gitdir, "objects", fanout, name[2:])
+        try:
+            binsha = bytes.fromhex(name)
+        except ValueError:
+            batch.errors.append("garbage found: {0}".format(path))
+            continue
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+            data = zlib.decompress(raw)
+        except (OSError, zlib.error) as e:
+            batch.errors.append("{0}: object corrupt or missing: {1}"
+                                .format(name, e))
+            continue
+        batch.count += 1
+        batch.size += len(raw)
+        y = data.find(b'\x00')
+        x = data.find(b' ', 0, y)
+        if x < 0 or not data[x + 1:y].isdigit() or \
+                int(data[x + 1:y]) != len(data) - y - 1:
+            batch.errors.append("{0}: object corrupt: bad header"
+                                .format(name))
+            continue
+        fsck_object(batch, binsha, data[:x], data[y + 1:],
+                    hashlib.sha1(data).digest())
+
+
+def fsck_pack_entries(repo: Repository, pack: PitPack, positions: array,
+                      offsets: array, bases: PitLRUCache,
+                      batch: PitFsckBatch) -> None:
+    """Check the entries of pack at positions (in index order), whose
+    offsets are offsets: the last one is where the last entry ends.
+    Entries are kept in bases, by offset, for the deltas that follow."""
+    index = pack.index
+
+    def resolve_ref(binsha: bytes):
+        for other in pack_list(repo):
+            found = other.read(binsha, resolve_ref)
+            if found:
+                return found
+        return None
+
+    for i, position in enumerate(positions):
+        binsha = index.sha_at(position)
+        offset, end = offsets[i], offsets[i + 1]
+        batch.count += 1
+        batch.size += end - offset
+        if zlib.crc32(pack.map[offset:end]) != index.crc_at(position):
+            batch.errors.append("{0}: CRC mismatch in {1} at offset {2}"
+                                .format(binsha.hex(), pack.path.name,
+                                        offset))
+            continue
+        try:
+            fmt, data = pack.read_at(offset, resolve_ref, bases)
+        except Exception as e:
+            batch.errors.append("{0}: object corrupt in {1}: {2}".format(
+                binsha.hex(), pack.path.name, e))
+            continue
+        bases.put(offset, (fmt, data), len(data))
+        digest = hashlib.sha1(b"%s %d\x00" % (fmt, len(data)))
+        digest.update(data)
+        fsck_object(batch, binsha, fmt, data, digest.digest())
+
+
+def fsck_pack_checksums(pack: PitPack, batch: PitFsckBatch) -> None:
+    """Check the trailing checksums of pack and its index."""
+    data, index = pack.map, pack.index.map
+    if hashlib.sha1(memoryview(data)[:-20]).digest() != data[-20:]:
+        batch.errors.append("{0}: pack checksum mismatch"
+                            .format(pack.path.name))
+    if index[-40:-20] != data[-20:]:
+        batch.errors.append("{0}: index doesn't match its pack"
+                            .format(pack.path.name))
+    if hashlib.sha1(memoryview(index)[:-20]).digest() != index[-20:]:
+        batch.errors.append("{0}: index checksum mismatch"
+                            .format(pack.path.name))
+
+
+def fsck_object(batch: PitFsckBatch, binsha: bytes, fmt: bytes,
+                data: bytes, digest: bytes) -> None:
+    """Check the object binsha, of type fmt and content data, which
+    hashes to digest, and record it in batch with its links."""
+    sha = binsha.hex()
+    if digest != binsha:
+        batch.errors.append("{0}: hash mismatch, content hashes to {1}"
+                            .format(sha, digest.hex()))
+        return
+    if fmt not in TYPE_NUMBERS:
+        batch.errors.append("{0}: unknown type {1}".format(
+            sha, fmt.decode("ascii", "replace")))
+        return
+    try:
+        if fmt == b'tree':
+            links = fsck_tree(data)
+        elif fmt == b'commit':
+            links = fsck_commit(data)
+        elif fmt == b'tag':
+            links = fsck_tag(data)
+        else:
+            links = None
+    except Exception as e:
+        batch.errors.append("{0} {1}: {2}".format(
+            fmt.decode("ascii"), sha, e))
+        return
+    batch.objects += binsha
+    batch.objects.append(TYPE_NUMBERS[fmt])
+    if links:
+        batch.links[binsha] = links
+
+
+def fsck_tree(data: bytes) -> bytes:
+    """Check the tree data: its modes, its names, and their order.
+    Returns its link records, gitlinks left out."""
+    links = bytearray()
+    # Names of the files, for directories of the same name
+    files = set()
+    previous = b''
+    find = data.find
+    pos = 0
+    end = len(data)
+    while pos < end:
+        space = find(b' ', pos)
+        nul = find(b'\x00', pos)
+        if nul < 0 or nul + 21 > end:
+            raise Exception("badTree: cannot be parsed")
+        mode, name = data[pos:space], data[space + 1:nul]
+        if space < 0 or space > nul or mode not in TREE_MODES:
+            raise Exception("badFilemode: contains bad file modes")
+        if not name or b'/' in name or name in (b'.', b'..'):
+            raise Exception("badName: contains bad name {0!r}"
+                            .format(name))
+        if mode == b'40000':
+            key = name + b'/'
+            if name in files:
+                raise Exception("duplicateEntries: contains duplicate "
+                                "file entries")
+            links += data[nul + 1:nul + 21]
+            links.append(OBJ_TREE)
+        else:
+            key = name
+            files.add(name)
+            if mode != b'160000':
+                # Not a submodule, whose commit lives elsewhere
+                links += data[nul + 1:nul + 21]
+                links.append(OBJ_BLOB)
+        if key <= previous:
+            raise Exception("duplicateEntries: contains duplicate file "
+                            "entries" if key == previous else
+                            "treeNotSorted: not properly sorted")
+        previous = key
+        pos = nul + 21
+    return bytes(links)
+
+
+def _fsck_sha(value: bytes, what: str) -> bytes:
+    """The binary SHA of the hex value of a what header."""
+    try:
+        if len(value) == 40 and value == value.lower():
+            return bytes.fromhex(value.decode("ascii"))
+    except ValueError:
+        pass
+    raise Exception("bad{0}Sha1: invalid '{1}' line format"
+                    .format(what.capitalize(), what))
+
+
+def _fsck_headers(kvlm: dict, required: tuple) -> None:
+    for key in required:
+        if key not in kvlm:
+            raise Exception("missing{0}: invalid format - expected '{1}' "
+                            "line".format(key.decode().capitalize(),
+                                          key.decode()))
+        if isinstance(kvlm[key], list):
+            raise Exception("multiple{0}: multiple '{1}' lines".format(
+                key.decode().capitalize(), key.decode()))
+
+
+def fsck_commit(data: bytes) -> bytes:
+    """Check the commit data has a tree, an author and a committer.
+    Returns its link records: the tree and the parents."""
+    kvlm = kvlm_parse(data)
+    _fsck_headers(kvlm, (b'tree', b'author', b'committer'))
+    links = bytearray(_fsck_sha(kvlm[b'tree'], "tree"))
+    links.append(TYPE_NUMBERS[b'tree'])
+    parents = kvlm.get(b'parent', [])
+    for parent in parents if isinstance(parents, list) else [parents]:
+        links += _fsck_sha(parent, "parent")
+        links.append(TYPE_NUMBERS[b'commit'])
+    return bytes(links)
+
+
+def fsck_tag(data: bytes) -> bytes:
+    """Check the tag data names the object it tags and its type.
+    Returns its link record."""
+    kvlm = kvlm_parse(data)
+    _fsck_headers(kvlm, (b'object', b'type', b'tag'))
+    if kvlm[b'type'] not in TYPE_NUMBERS:
+        raise Exception("badType: invalid 'type' value")
+    return _fsck_sha(kvlm[b'object'], "object") + \
+        bytes([TYPE_NUMBERS[kvlm[b'type']]])
+
+
+def fsck_roots(repo: Repository) -> dict[str, str]:
+    """What keeps objects alive: HEAD, the refs, the index and the
+    reflogs, as {sha: where it was found}."""
+    roots = {}
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        roots[head] = "HEAD"
+    for name, sha in ref_dict(repo).items():
+        roots.setdefault(sha, name)
+    for entry in index_read(repo).entries:
+        # Gitlinks point to other repositories
+        if entry.mode_type != 0b1110:
+            roots.setdefault(entry.sha, "index")
+    logs = os.path.join(repo.gitdir, "logs")
+    for root, _, files in os.walk(logs):
+        for f in files:
+            path = os.path.join(root, f)
+            name = os.path.relpath(path, logs).replace(os.sep, "/")
+            with open(path, "rb") as log:
+                for line in log:
+                    for sha in line.split(b' ', 2)[:2]:
+                        sha = sha.decode("ascii", "replace")
+                        if sha != "0" * 40:
+                            roots.setdefault(sha, name + "@{reflog}")
+    return roots
+
+
+def fsck_connectivity(repo: Repository, report: PitFsckReport,
+                      types: dict, links: dict) -> None:
+    """Walk the links from the roots of repo over the objects found,
+    types and links as fsck gathered them, and fill in the missing and
+    dangling objects of report."""
+    roots = fsck_roots(repo)
+    reachable = set()
+    pending = []
+    for sha, name in roots.items():
+        binsha = bytes.fromhex(sha)
+        if binsha in types:
+            reachable.add(binsha)
+            pending.append(binsha)
+        else:
+            report.errors.append("{0}: invalid sha1 pointer {1}"
+                                 .format(name, sha))
+
+    while pending:
+        records = links.get(pending.pop())
+        if not records:
+            continue
+        for i in range(0, len(records), 21):
+            binsha = records[i:i + 20]
+            expected = records[i + 20]
+            if binsha in reachable:
+                continue
+            found = types.get(binsha)
+            if found is None:
+                report.missing[binsha.hex()] = TYPE_NAMES[expected]
+                continue
+            if found != expected:
+                report.errors.append("{0}: is a {1}, not a {2}".format(
+                    binsha.hex(), TYPE_NAMES[found].decode(),
+                    TYPE_NAMES[expected].decode()))
+            reachable.add(binsha)
+            pending.append(binsha)
+
+    # Dangling: found unreachable, and linked to by nothing at all
+    linked = set()
+    for records in links.values():
+        linked.update(records[i:i + 20] for i in range(0, len(records), 21))
+    for binsha, type_num in types.items():
+        if binsha not in reachable and binsha not in linked:
+            report.dangling[binsha.hex()] = TYPE_NAMES[type_num]
@@ -0,0 +1,370 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import shlex
+import socket
+import struct
+import subprocess
+import uuid
+from bisect import bisect_left
+from typing import Protocol
+from pit.repo import Repository, repo_file
+from pit.objects import PitIndex
+
+# A filesystem monitor tells which paths of the worktree changed since
+# the last time it was asked: status then doesn't have to lstat the
+# others.  Each answer comes with a token, to be given back with the
+# next question; the token is kept in the index (the FSMN extension),
+# along with which entries were found unchanged.
+#
+# With pit.fsmonitor set, the daemon below ("pit fsmonitor-daemon") is
+# asked.  Otherwise core.fsmonitor can be a hook command, speaking
+# version 2 of git's fsmonitor protocol, which git can use as well.
+
+FSMONITOR_SOCKET = "pit-fsmonitor.sock"
+
+# The daemon remembers this many changes; older tokens get "everything
+# changed" as an answer.
+FSMONITOR_MAX_EVENTS = 100000
+
+
+class PitFSMonitor(Protocol):
+    def query(self, token: str | None) -> tuple:
+        """Return a new token, and the paths (relative to the worktree,
+        "/"-separated) changed since token.  The paths are None if
+        anything could have changed, in particular when token is None
+        or unknown.  The token is None if the monitor isn't
+        available."""
+        ...
+
+
+class PitHookMonitor:
+    """A monitor run as a command, like git's core.fsmonitor hooks.
+
+    The command is given the protocol version (2) and the token, and
+    prints the new token and the changed paths, all NUL-terminated.  A
+    "/" path means everything changed."""
+
+    def __init__(self, repo: Repository, command: str):
+        self.repo = repo
+        self.command = command
+
+    def query(self, token):
+        try:
+            out = subprocess.run(
+                "{0} 2 {1}".format(self.command, shlex.quote(token or "")),
+                shell=True, cwd=self.repo.worktree, check=True,
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        except (OSError, subprocess.CalledProcessError):
+            return None, None
+        new, _, rest = out.partition(b'\x00')
+        if not new:
+            return None, None
+        paths = [os.fsdecode(p) for p in rest.split(b'\x00') if p]
+        if token is None or "/" in paths:
+            paths = None
+        return new.decode("utf8"), paths
+
+
+class PitDaemonMonitor:
+    """Ask the pit fsmonitor daemon of the repository, if it runs."""
+
+    def __init__(self, repo: Repository):
+        self.repo = repo
+
+    def query(self, token):
+        try:
+            reply = _daemon_request(self.repo, (token or "") + "\n")
+        except OSError:
+            return None, None
+        new, _, rest = reply.partition(b'\x00')
+        if not new:
+            return None, None
+        paths = [os.fsdecode(p) for p in rest.split(b'\x00') if p]
+        if token is None or "/" in paths:
+            paths = None
+        return new.decode("utf8"), paths
+
+
+def _daemon_request(repo: Repository, request: str) -> bytes:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(10)
+        s.connect(str(repo_file(repo, FSMONITOR_SOCKET)))
+        s.sendall(request.encode("utf8"))
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def fsmonitor_get(repo: Repository):
+    """The monitor configured for repo, or None."""
+    if repo.conf.getboolean("pit", "fsmonitor", fallback=False):
+        return PitDaemonMonitor(repo)
+    command = repo.conf.get("core", "fsmonitor", fallback="").strip()
+    if command.lower() in ("", "true", "yes", "on", "1",
+                           "false", "no", "off", "0"):
+        # Booleans are about git's own daemon, which we can't ask
+        return None
+    return PitHookMonitor(repo, command)
+
+
+def fsmonitor_invalidate(index: PitIndex, paths) -> None:
+    """Forget that the entries at paths, or below them, are
+    unchanged."""
+    valid = index.fsmonitor_valid
+    if not valid:
+        return
+    entries = index.entries
+    names = [e.raw_name for e in entries]
+    for path in paths:
+        path = os.fsencode(path.rstrip("/"))
+        i = bisect_left(names, path)
+        while i < len(names) and names[i] == path:
+            valid.discard(entries[i])
+            i += 1
+        # Entries below path, if it's a directory.  They don't follow
+        # path directly: "a-b" and "a.c" sort between "a" and "a/".
+        i = bisect_left(names, path + b'/')
+        while i < len(names) and names[i].startswith(path + b'/'):
+            valid.discard(entries[i])
+            i += 1
+
+
+def fsmonitor_dirs(paths) -> tuple:
+    """The directories whose listing may have changed, given the
+    changed paths, as "dir/" prefixes ("" for the top of the
+    worktree).  Returns a set of prefixes, and a tuple of the prefixes
+    under which everything is to be taken as changed."""
+    parents = set()
+    subtrees = []
+    for path in paths:
+        if path.endswith("/"):
+            subtrees.append(path)
+            path = path[:-1]
+        parent = path.rpartition("/")[0]
+        parents.add(parent + "/" if parent else "")
+        # path could be a directory itself
+        parents.add(path + "/")
+    return parents, tuple(subtrees)
+
+
+# inotify, through the C library
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+INOTIFY_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO
+                | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+                | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+# wd, mask, cookie and length of the name following
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class PitInotify:
+    """Watch a directory tree with inotify (Linux only)."""
+
+    def __init__(self, top: str, skip=(".git",)):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.top = top
+        self.skip = skip
+        # Watch descriptors to paths ("" for the top, "a/b" below)
+        self.watches = {}
+
+    def watch(self, rel: str) -> list[str]:
+        """Watch rel and the directories below it.  Returns the paths
+        found there, as they may have been created before the watches
+        were set."""
+        found = []
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(self.top, rel)
+            wd = self._add_watch(self.fd, os.fsencode(path), INOTIFY_MASK)
+            if wd < 0:
+                # Gone already, or not a directory anymore
+                continue
+            self.watches[wd] = rel
+            try:
+                with os.scandir(path) as it:
+                    for e in it:
+                        name = rel + "/" + e.name if rel else e.name
+                        if not rel and e.name in self.skip:
+                            continue
+                        found.append(name)
+                        if e.is_dir(follow_symlinks=False):
+                            stack.append(name)
+            except OSError:
+                continue
+        return found
+
+    def read(self) -> list[str] | None:
+        """The paths of the pending events, or None if the kernel
+        dropped events."""
+        ret = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return ret
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+                pos += INOTIFY_EVENT.size
+                name = data[pos:pos+length].rstrip(b'\x00')
+                pos += length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                rel = self.watches.get(wd)
+                if rel is None:
+                    continue
+                if not name:
+                    # The watched directory itself
+                    if rel:
+                        ret.append(rel)
+                    continue
+                name = os.fsdecode(name)
+                if not rel and name in self.skip:
+                    continue
+                path = rel + "/" + name if rel else name
+                ret.append(path)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    ret.extend(self.watch(path))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PitFSMonitorDaemon:
+    """A small stand-in for git's fsmonitor--daemon.
+
+    It watches the worktree with inotify, and answers queries on a unix
+    socket in .git: a token and a newline in, the new token and the
+    paths changed since then, NUL-terminated, out.  "stop\\n" makes it
+    exit.
+
+    Tokens are "pit:<instance>:<event number>": those of another
+    instance of the daemon, or too old, get "/" (everything) as an
+    answer."""
+
+    def __init__(self, repo: Repository):
+        self.repo = repo
+        self.instance = uuid.uuid4().hex[:12]
+        self.seq = 0
+        # The oldest event number we still have the changes since
+        self.oldest = 0
+        self.events = []
+        self.inotify = PitInotify(str(repo.worktree))
+        self.inotify.watch("")
+        self.path = str(repo_file(self.repo, FSMONITOR_SOCKET))
+
+    def token(self) -> str:
+        return "pit:{0}:{1}".format(self.instance, self.seq)
+
+    def update(self) -> None:
+        paths = self.inotify.read()
+        if paths is None:
+            # Lost track: everything changed for everybody
+            self.events = []
+            self.oldest = self.seq = self.seq + 1
+            return
+        for path in paths:
+            self.seq += 1
+            self.events.append((self.seq, path))
+        if len(self.events) > FSMONITOR_MAX_EVENTS:
+            drop = len(self.events) - FSMONITOR_MAX_EVENTS
+            self.oldest = self.events[drop - 1][0]
+            del self.events[:drop]
+
+    def answer(self, token: str) -> bytes:
+        self.update()
+        since = None
+        parts = token.split(":")
+        if len(parts) == 3 and parts[:2] == ["pit", self.instance]:
+            try:
+                since = int(parts[2])
+            except ValueError:
+                pass
+        if since is None or since < self.oldest or since > self.seq:
+            paths = ["/"]
+        else:
+            i = bisect_left(self.events, (since + 1,))
+            paths = sorted({path for _, path in self.events[i:]})
+        return b''.join(os.fsencode(p) + b'\x00'
+                        for p in [self.token()] + paths)
+
+    def serve(self) -> None:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(16)
+        try:
+            while True:
+                ready, _, _ = select.select([server, self.inotify.fd],
+                                            [], [])
+                if self.inotify.fd in ready:
+                    self.update()
+                if server not in ready:
+                    continue
+                conn, _ = server.accept()
+                with conn:
+                    conn.settimeout(10)
+                    request = b''
+                    try:
+                        while not request.endswith(b'\n'):
+                            chunk = conn.recv(4096)
+                            if not chunk:
+                                break
+                            request += chunk
+                    except OSError:
+                        continue
+                    request = request.decode("utf8").strip()
+                    if request == "stop":
+                        return
+                    try:
+                        conn.sendall(self.answer(request))
+                    except OSError:
+                        pass
+        finally:
+            server.close()
+            self.inotify.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def fsmonitor_daemon_stop(repo: Repository) -> bool:
+    """Stop the daemon of repo.  Returns whether one was running."""
+    try:
+        _daemon_request(repo, "stop\n")
+    except OSError:
+        return False
+    return True
@@ -0,0 +1,74 @@
+import os
+import time
+from pathlib import Path
+
+
+class PitLockError(FileExistsError):
+    """The lock is held by someone else."""
+
+
+class PitLockFile:
+    """Git-style lock for updating a file atomically.
+
+    The new content is written to "<path>.lock", which is created
+    exclusively: if it already exists, someone else is updating the
+    file.  commit() renames the lock over path, rollback() (or leaving
+    the with block on an exception) removes it.
+
+        with PitLockFile(path) as lock:
+            lock.write(data)
+            lock.commit()
+
+    With a timeout (in seconds), a lock held by someone else is tried
+    again until then, backing off like git does."""
+
+    def __init__(self, path: str | Path, fsync=False, timeout=0.0):
+        self.path = Path(path)
+        self.lock_path = Path(str(path) + ".lock")
+        self.fsync = fsync
+        self.timeout = timeout
+        self.fd = None
+
+    def acquire(self) -> None:
+        deadline = time.monotonic() + self.timeout
+        delay = 0.001
+        while True:
+            try:
+                self.fd = os.open(self.lock_path,
+                                  os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                                  0o666)
+                return
+            except FileExistsError:
+                if time.monotonic() + delay > deadline:
+                    raise PitLockError(
+                        "Unable to create {0}: File exists.  Another pit "
+                        "process seems to be running.".format(
+                            self.lock_path))
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    def write(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            n = os.write(self.fd, view)
+            view = view[n:]
+
+    def commit(self) -> None:
+        if self.fsync:
+            os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.lock_path, self.path)
+
+    def rollback(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            os.remove(self.lock_path)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.rollback()
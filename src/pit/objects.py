@@ -1,17 +1,55 @@
 import zlib
 import os
+import gc
+import itertools
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkstemp
+from array import array
+from bisect import bisect_left
+import mmap
+import struct
+import hashlib
 from enum import Enum
 from typing import Protocol
-from collections import OrderedDict
-from pathlib import Path
+from collections import deque
+from contextlib import contextmanager
 from pit.repo import (
     repo_file, Repository, repo_dir
 )
 import re
-from pit.utils import (
-    ref_resolve
+from pit.refs import ref_resolve
+from pit.lockfile import PitLockFile
+from pit.ewah import ewah_read, ewah_write
+from pit.pack import (
+    pack_list,
+    pack_read,
+    pack_read_header,
+    pack_read_stream,
+    pack_prefix_lookup,
+    pack_neighbours,
+    pack_object_count,
 )
-from Math import ceil
+
+# Size of the chunks blobs are read, hashed and written in when
+# streaming, so memory use doesn't grow with the size of the blob.
+STREAM_CHUNK = 1024 * 1024
+
+# Files hashed per task by hash_many, and the size above which they are
+# streamed rather than read whole.
+HASH_BATCH = 64
+HASH_INLINE_MAX = 16 * 1024 * 1024
+# Files hash_iter has read the path of but not given the SHA of yet, at
+# most.
+HASH_INFLIGHT = 256
+
+# 4 is the minimal length for git to consider something a short hash,
+# as documented in man git-rev-parse
+HASH_RE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
+
+# Abbreviations are at least that long, like git's
+ABBREV_MIN = 7
 
 
 class ObjectType(Enum):
@@ -55,16 +93,86 @@ class PitBlob(PitObject):
 
 
 class PitCommit(PitObject):
+    """A commit.
+
+    A commit read from the repository keeps its data: kvlm, all its
+    headers and message, is only parsed when asked for.  History walks
+    only need a few headers, which tree, parents and the times read
+    straight from the data."""
+
     fmt = b'commit'
 
     def deserialize(self, data):
-        self.kvlm = kvlm_parse(data)
+        self.data = data
+        self._kvlm = None
 
     def serialize(self):
-        return kvlm_serialize(self.kvlm)
+        if self._kvlm is None:
+            return self.data
+        return kvlm_serialize(self._kvlm)
 
     def init(self):
-        self.kvlm = dict()
+        self.data = b''
+        self._kvlm = dict()
+
+    @property
+    def kvlm(self) -> dict:
+        if self._kvlm is None:
+            self._kvlm = kvlm_parse(self.data)
+        return self._kvlm
+
+    @kvlm.setter
+    def kvlm(self, kvlm: dict) -> None:
+        self._kvlm = kvlm
+
+    def header(self, key: bytes) -> list[bytes]:
+        """The values of the one-line header key, in order."""
+        if self._kvlm is not None:
+            value = self._kvlm.get(key, [])
+            return value if isinstance(value, list) else [value]
+        return kvlm_header(self.data, key)
+
+    # git writes the tree first, then the parents, at fixed offsets:
+    # like git, read them from there when they are.
+
+    @property
+    def tree(self) -> str:
+        data = self.data
+        if self._kvlm is None and data.startswith(b'tree ') and \
+                data[45:46] == b'\n':
+            return data[5:45].decode("ascii")
+        return self.header(b'tree')[0].decode("ascii")
+
+    @property
+    def parents(self) -> list[str]:
+        data = self.data
+        if self._kvlm is None and data[45:46] == b'\n':
+            ret = []
+            pos = 46
+            while data.startswith(b'parent ', pos) and \
+                    data[pos+47:pos+48] == b'\n':
+                ret.append(data[pos+7:pos+47].decode("ascii"))
+                pos += 48
+            if not data.startswith(b'parent', pos):
+                return ret
+        return [p.decode("ascii") for p in self.header(b'parent')]
+
+    def _signature_time(self, key: bytes) -> int:
+        data = self.data
+        if self._kvlm is None:
+            # The first one is in the headers, before the message
+            pos = data.find(b'\n' + key + b' ')
+            if pos >= 0:
+                return signature_time(data[pos:data.find(b'\n', pos+1)])
+        return signature_time(self.header(key)[0])
+
+    @property
+    def author_time(self) -> int:
+        return self._signature_time(b'author')
+
+    @property
+    def committer_time(self) -> int:
+        return self._signature_time(b'committer')
 
 
 class PitTag(PitCommit):
@@ -72,63 +180,333 @@ class PitTag(PitCommit):
 
 
 class PitTreeLeaf:
-    def __init__(self, mode: str, path: str | Path, sha: str):
+    """An entry of a tree.  The name and SHA are kept the way the tree
+    stores them, raw_path and binsha: path and sha decode them when
+    asked for."""
+
+    __slots__ = ("mode", "raw_path", "binsha")
+
+    def __init__(self, mode: bytes, path: str | bytes, sha: str | bytes):
         self.mode = mode
-        self.path = Path(path)
+        self.path = path
         self.sha = sha
 
+    @property
+    def path(self) -> str:
+        return self.raw_path.decode("utf8")
+
+    @path.setter
+    def path(self, value: str | bytes) -> None:
+        self.raw_path = value if isinstance(value, bytes) \
+            else str(value).encode("utf8")
+
+    @property
+    def sha(self) -> str:
+        return self.binsha.hex()
+
+    @sha.setter
+    def sha(self, value: str | bytes) -> None:
+        self.binsha = value if isinstance(value, bytes) \
+            else bytes.fromhex(value)
+
 
 class PitTree(PitObject):
+    """A tree.
+
+    A tree read from the repository keeps its data, and the offsets of
+    its entries: items, a list of PitTreeLeaf, is only made when asked
+    for.  entries() and find() read the data directly."""
+
     fmt = b'tree'
 
     def deserialize(self, data):
-        self.items = tree_parse(data)
+        self.data = data
+        self.offsets = tree_offsets(data)
+        self._items = None
 
     def serialize(self):
+        if self._items is None:
+            return self.data
         return tree_serialize(self)
 
     def init(self):
-        self.items = []
+        self.data = b''
+        self.offsets = array("I")
+        self._items = []
+
+    @property
+    def items(self) -> list[PitTreeLeaf]:
+        if self._items is None:
+            self._items = tree_parse(self.data)
+        return self._items
+
+    @items.setter
+    def items(self, items: list[PitTreeLeaf]) -> None:
+        self._items = items
+
+    def __len__(self):
+        if self._items is None:
+            return len(self.offsets)
+        return len(self._items)
+
+    def entries(self):
+        """Yield (mode, name, binary SHA) for each entry, all bytes, the
+        mode without padding (b"40000" for trees)."""
+        if self._items is not None:
+            for leaf in self._items:
+                yield leaf.mode.lstrip(), leaf.raw_path, leaf.binsha
+            return
+        data = self.data
+        find = data.find
+        for pos in self.offsets:
+            # Only trees have a five digit mode
+            x = pos + 5 if data[pos] == 0x34 else pos + 6
+            y = find(b'\x00', x)
+            yield data[pos:x], data[x+1:y], data[y+1:y+21]
+
+    def _key(self, i: int) -> bytes:
+        # The name the entry is sorted by: trees sort with a "/"
+        pos = self.offsets[i]
+        x = self.data.find(b' ', pos)
+        y = self.data.find(b'\x00', x)
+        name = self.data[x+1:y]
+        return name + b'/' if self.data[pos] == 0x34 else name
+
+    def find(self, name: str | bytes) -> PitTreeLeaf | None:
+        """The entry called name, or None: a binary search on the
+        entries, which trees keep sorted."""
+        if isinstance(name, str):
+            name = name.encode("utf8")
+        if not name or b'/' in name:
+            return None
+        if self._items is not None:
+            for leaf in self._items:
+                if leaf.raw_path == name:
+                    return leaf
+            return None
+        # A file or a tree, which sort differently
+        for key in (name, name + b'/'):
+            lo, hi = 0, len(self.offsets)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._key(mid) < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < len(self.offsets) and self._key(lo) == key:
+                return tree_parse_one(self.data, self.offsets[lo])[1]
+        return None
 
 
 class PitIndexEntry (object):
+    """An entry of the index.
+
+    Indexes can hold hundreds of thousands of entries, so an entry is
+    little more than the tuple unpacked from the file (see INDEX_ENTRY)
+    and the raw name.  Fields are decoded when accessed.
+
+    span is the (start, end) of the entry in the index file it was
+    read from, as long as it hasn't been modified since: index_write
+    copies those entries as is.  Anything assigning to fields directly
+    must reset it to None."""
+    __slots__ = ("fields", "xflags", "raw_name", "_name", "span")
+
     def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
                  mode_type=None, mode_perms=None, uid=None, gid=None,
                  fsize=None, sha=None, flag_assume_valid=None,
-                 flag_stage=None, name=None):
-        # The last time a file's metadata changed.  This is a pair
-        # (timestamp in seconds, nanoseconds)
-        self.ctime = ctime
-        # The last time a file's data changed.  This is a pair
-        # (timestamp in seconds, nanoseconds)
-        self.mtime = mtime
-        # The ID of device containing this file
-        self.dev = dev
-        # The file's inode number
-        self.ino = ino
-        # The object type, either b1000 (regular), b1010 (symlink),
-        # b1110 (gitlink).
-        self.mode_type = mode_type
-        # The object permissions, an integer.
-        self.mode_perms = mode_perms
-        # User ID of owner
-        self.uid = uid
-        # Group ID of ownner
-        self.gid = gid
-        # Size of this object, in bytes
-        self.fsize = fsize
-        # The object's SHA
-        self.sha = sha
-        self.flag_assume_valid = flag_assume_valid
-        self.flag_stage = flag_stage
-        # Name of the object (full path this time!)
-        self.name = name
+                 flag_stage=None, name=None, fields=None, raw_name=None,
+                 flag_skip_worktree=False, flag_intent_to_add=False):
+        if fields is None:
+            ctime = ctime or (0, 0)
+            mtime = mtime or (0, 0)
+            flags = ((0b1000000000000000 if flag_assume_valid else 0)
+                     | (flag_stage or 0))
+            fields = (ctime[0], ctime[1], mtime[0], mtime[1], dev or 0,
+                      ino or 0, ((mode_type or 0) << 12) | (mode_perms or 0),
+                      uid or 0, gid or 0, fsize or 0,
+                      bytes.fromhex(sha) if sha else None, flags)
+        self.fields = fields
+        # The extended flags of versions 3 and up, 0 if none
+        self.xflags = ((0b0100000000000000 if flag_skip_worktree else 0)
+                       | (0b0010000000000000 if flag_intent_to_add else 0))
+        # Name of the object (full path this time!), as utf8 bytes.
+        self.raw_name = raw_name
+        self._name = None
+        self.span = None
+        if name is not None:
+            self.name = name
+
+    def _set(self, i: int, value) -> None:
+        fields = list(self.fields)
+        fields[i] = value
+        self.fields = tuple(fields)
+        self.span = None
+
+    # The last time a file's metadata changed.  This is a pair
+    # (timestamp in seconds, nanoseconds)
+    @property
+    def ctime(self) -> tuple[int, int]:
+        return self.fields[0], self.fields[1]
+
+    @ctime.setter
+    def ctime(self, value: tuple[int, int]) -> None:
+        self.fields = tuple(value) + self.fields[2:]
+        self.span = None
+
+    # The last time a file's data changed.  This is a pair
+    # (timestamp in seconds, nanoseconds)
+    @property
+    def mtime(self) -> tuple[int, int]:
+        return self.fields[2], self.fields[3]
+
+    @mtime.setter
+    def mtime(self, value: tuple[int, int]) -> None:
+        self.fields = self.fields[:2] + tuple(value) + self.fields[4:]
+        self.span = None
+
+    # The ID of device containing this file
+    @property
+    def dev(self) -> int:
+        return self.fields[4]
+
+    @dev.setter
+    def dev(self, value: int) -> None:
+        self._set(4, value)
+
+    # The file's inode number
+    @property
+    def ino(self) -> int:
+        return self.fields[5]
+
+    @ino.setter
+    def ino(self, value: int) -> None:
+        self._set(5, value)
+
+    # The object type, either b1000 (regular), b1010 (symlink),
+    # b1110 (gitlink).
+    @property
+    def mode_type(self) -> int:
+        return self.fields[6] >> 12
+
+    @mode_type.setter
+    def mode_type(self, value: int) -> None:
+        self._set(6, (value << 12) | (self.fields[6] & 0b0000000111111111))
+
+    # The object permissions, an integer.
+    @property
+    def mode_perms(self) -> int:
+        return self.fields[6] & 0b0000000111111111
+
+    @mode_perms.setter
+    def mode_perms(self, value: int) -> None:
+        self._set(6, (self.fields[6] & ~0b0000000111111111) | value)
+
+    # User ID of owner
+    @property
+    def uid(self) -> int:
+        return self.fields[7]
+
+    @uid.setter
+    def uid(self, value: int) -> None:
+        self._set(7, value)
+
+    # Group ID of ownner
+    @property
+    def gid(self) -> int:
+        return self.fields[8]
+
+    @gid.setter
+    def gid(self, value: int) -> None:
+        self._set(8, value)
+
+    # Size of this object, in bytes
+    @property
+    def fsize(self) -> int:
+        return self.fields[9]
+
+    @fsize.setter
+    def fsize(self, value: int) -> None:
+        self._set(9, value)
+
+    # The object's SHA, as 20 raw bytes
+    @property
+    def binsha(self) -> bytes:
+        return self.fields[10]
+
+    @binsha.setter
+    def binsha(self, value: bytes) -> None:
+        self._set(10, value)
+
+    # The object's SHA, as a lowercase hex string
+    @property
+    def sha(self) -> str | None:
+        if self.fields[10] is None:
+            return None
+        return self.fields[10].hex()
+
+    @sha.setter
+    def sha(self, value: str) -> None:
+        self._set(10, bytes.fromhex(value))
+
+    @property
+    def flag_assume_valid(self) -> bool:
+        return (self.fields[11] & 0b1000000000000000) != 0
+
+    @flag_assume_valid.setter
+    def flag_assume_valid(self, value: bool) -> None:
+        flags = self.fields[11] & ~0b1000000000000000
+        self._set(11, flags | (0b1000000000000000 if value else 0))
+
+    @property
+    def flag_stage(self) -> int:
+        return self.fields[11] & 0b0011000000000000
+
+    @flag_stage.setter
+    def flag_stage(self, value: int) -> None:
+        self._set(11, (self.fields[11] & ~0b0011000000000000) | value)
+
+    def _set_xflag(self, bit: int, value: bool) -> None:
+        self.xflags = (self.xflags & ~bit) | (bit if value else 0)
+        self.span = None
+
+    # Extended flag: the file is not checked out (sparse checkout)
+    @property
+    def flag_skip_worktree(self) -> bool:
+        return (self.xflags & 0b0100000000000000) != 0
+
+    @flag_skip_worktree.setter
+    def flag_skip_worktree(self, value: bool) -> None:
+        self._set_xflag(0b0100000000000000, value)
+
+    # Extended flag: the file was added with "git add -N"
+    @property
+    def flag_intent_to_add(self) -> bool:
+        return (self.xflags & 0b0010000000000000) != 0
+
+    @flag_intent_to_add.setter
+    def flag_intent_to_add(self, value: bool) -> None:
+        self._set_xflag(0b0010000000000000, value)
+
+    @property
+    def name(self) -> str | None:
+        if self._name is None and self.raw_name is not None:
+            self._name = self.raw_name.decode("utf8")
+        return self._name
+
+    @name.setter
+    def name(self, value: str) -> None:
+        self._name = value
+        self.raw_name = value.encode("utf8")
+        self.span = None
 
 
 class PitIndex (object):
+    """The index.
+
+    Entries read from a version 2 or 3 file are only built when first
+    needed: until then, the index just keeps the data of the file and
+    where each entry starts (see index_read)."""
     version = None
-    entries = []
-    # ext = None
     # sha = None
 
     def __init__(self, version=2, entries=None):
@@ -136,117 +514,451 @@ class PitIndex (object):
             entries = list()
 
         self.version = version
-        self.entries = entries
+        self._entries = entries
+        # The data of the file read and the offsets of its entries,
+        # followed by the offset of whatever comes after them, until
+        # the entries are built.
+        self._raw = None
+        self._offsets = None
+        # Raw data of the extensions we maintain, by signature
+        self.extensions = {}
+        # The filesystem monitor token of the FSMN extension, and the
+        # entries known unchanged since then (see pit.fsmonitor).
+        self.fsmonitor_token = None
+        self._fsmonitor_valid = set()
+        # The positions of the entries the FSMN extension says may have
+        # changed, until the entries are built
+        self._fsmonitor_dirty = None
+        # index_signature of the file the entries were read from
+        self.source = None
+
+    @property
+    def entries(self) -> list:
+        if self._entries is None:
+            self._load()
+        return self._entries
+
+    @entries.setter
+    def entries(self, value: list) -> None:
+        if self._entries is None:
+            self._load()
+        self._entries = value
+
+    @property
+    def fsmonitor_valid(self) -> set:
+        if self._entries is None:
+            self._load()
+        return self._fsmonitor_valid
+
+    @fsmonitor_valid.setter
+    def fsmonitor_valid(self, value: set) -> None:
+        if self._entries is None:
+            self._load()
+        self._fsmonitor_valid = value
+
+    def _load(self) -> None:
+        entries = _index_entries(self._raw, self._offsets)
+        if self._fsmonitor_dirty is not None:
+            self._fsmonitor_valid = _index_fsmonitor_valid(
+                entries, self._fsmonitor_dirty)
+            self._fsmonitor_dirty = None
+        self._entries = entries
+        self._raw = self._offsets = None
+
+
+# The fixed-size part of an index entry: ctime and mtime (seconds,
+# nanoseconds), dev, ino, mode (the top 16 bits are unused), uid,
+# gid, size, SHA and flags.  62 bytes.  This is also the layout of
+# PitIndexEntry.fields.
+INDEX_ENTRY = struct.Struct(">10L20sH")
+
+INDEX_MODES = frozenset(t << 12 | p for t in (0b1000, 0b1010, 0b1110)
+                        for p in (0, 0o644, 0o755))
+
+# The extensions kept when writing the index, in the order git writes
+# them.  The others are caches we don't keep up to date (the cache
+# tree), or describe the file itself (EOIE, IEOT): they are dropped,
+# which git is fine with.
+INDEX_EXTENSIONS = (b"UNTR", b"FSMN")
 
 
 def index_read(repo: Repository):
     index_file = repo_file(repo, "index")
 
     # New repositories have no index!
-    if not os.path.exists(index_file):
+    if not os.path.exists(index_file) or not os.path.getsize(index_file):
         return PitIndex()
 
+    # The entries are built out of it later on, if ever
     with open(index_file, 'rb') as f:
         raw = f.read()
 
-    header = raw[:12]
-    signature = header[:4]
+    signature = raw[:4]
     assert signature == b"DIRC"  # Stands for "DirCache"
-    version = int.from_bytes(header[4:8], "big")
-    assert version == 2, "pit only supports index file version 2"
-    count = int.from_bytes(header[8:12], "big")
+    version = int.from_bytes(raw[4:8], "big")
+    assert version in (2, 3, 4), \
+        "pit only supports index file versions 2 to 4"
+    count = int.from_bytes(raw[8:12], "big")
+
+    if version == 4:
+        with _gc_paused():
+            entries, idx = _index_read_v4(raw, count)
+        index = PitIndex(version=version, entries=entries)
+    else:
+        offsets = _index_read_v2(raw, count, version)
+        idx = offsets[-1]
+        index = PitIndex(version=version)
+        index._entries = None
+        index._raw = raw
+        index._offsets = offsets
+    extensions = _index_read_extensions(raw, idx)
+
+    fsmonitor = extensions.pop(b"FSMN", None)
+    if fsmonitor is not None:
+        _index_read_fsmonitor(index, fsmonitor)
+    index.extensions = extensions
+    index.source = index_signature(index_file) + (version,)
+    return index
+
+
+def _index_read_extensions(raw, idx: int) -> dict:
+    """Read the extensions between the entries, ending at idx, and the
+    trailing checksum."""
+    ret = {}
+    end = len(raw) - 20
+    while idx < end:
+        signature = raw[idx:idx+4]
+        size = int.from_bytes(raw[idx+4:idx+8], "big")
+        idx += 8
+        if signature == b"link":
+            raise Exception("pit doesn't support split indexes")
+        if signature in INDEX_EXTENSIONS:
+            ret[signature] = raw[idx:idx+size]
+        elif not b"A" <= signature[:1] <= b"Z":
+            # Lowercase extensions are required to make sense of the
+            # index, unlike optional uppercase ones.
+            raise Exception("Unsupported index extension: {0}".format(
+                signature.decode("ascii", "replace")))
+        idx += size
+    return ret
+
+
+def _index_read_fsmonitor(index: PitIndex, data: bytes) -> None:
+    """Parse the FSMN extension: a version, the token (a timestamp in
+    version 1), and a bitmap of the entries that may have changed."""
+    version = int.from_bytes(data[:4], "big")
+    if version == 1:
+        token = str(int.from_bytes(data[4:12], "big"))
+        pos = 12
+    elif version == 2:
+        end = data.index(b'\x00', 4)
+        token = data[4:end].decode("utf8")
+        pos = end + 1
+    else:
+        # Not ours to understand: it'll be dropped on write
+        return
+    dirty, _ = ewah_read(data, pos + 4)
+    index.fsmonitor_token = token
+    if index._entries is None:
+        index._fsmonitor_dirty = dirty
+    else:
+        index.fsmonitor_valid = _index_fsmonitor_valid(index.entries, dirty)
+
+
+def _index_fsmonitor_valid(entries: list, dirty) -> set:
+    """The entries, but those at the positions in dirty."""
+    valid = set(entries)
+    for i in dirty:
+        if i < len(entries):
+            valid.discard(entries[i])
+    return valid
+
+
+def _index_fsmonitor_extension(index: PitIndex) -> bytes:
+    valid = index.fsmonitor_valid
+    dirty = [i for i, e in enumerate(index.entries) if e not in valid]
+    bitmap = ewah_write(dirty)
+    return (b"\x00\x00\x00\x02" + index.fsmonitor_token.encode("utf8")
+            + b"\x00" + len(bitmap).to_bytes(4, "big") + bitmap)
 
-    entries = list()
 
-    content = raw[12:]
-    idx = 0
+def _index_read_v2(raw: bytes, count: int, version: int) -> array:
+    """Find the entries of a version 2 or 3 index.  Returns their
+    offsets, followed by the offset of whatever comes after them."""
+    # This loop runs once per file in the worktree: keep it tight.
+    # Only the flags are read, for the length of the name.
+    offsets = array("Q", bytes(8 * (count + 1)))
+    idx = 12
     for i in range(0, count):
-        # Read creation time, as a unix timestamp (seconds since
-        # 1970-01-01 00:00:00, the "epoch")
-        ctime_s = int.from_bytes(content[idx: idx+4], "big")
-        # Read creation time, as nanoseconds after that timestamps,
-        # for extra precision.
-        ctime_ns = int.from_bytes(content[idx+4: idx+8], "big")
-        # Same for modification time: first seconds from epoch.
-        mtime_s = int.from_bytes(content[idx+8: idx+12], "big")
-        # Then extra nanoseconds
-        mtime_ns = int.from_bytes(content[idx+12: idx+16], "big")
-        # Device ID
-        dev = int.from_bytes(content[idx+16: idx+20], "big")
-        # Inode
-        ino = int.from_bytes(content[idx+20: idx+24], "big")
-        # Ignored.
-        unused = int.from_bytes(content[idx+24: idx+26], "big")
-        assert 0 == unused
-        mode = int.from_bytes(content[idx+26: idx+28], "big")
-        mode_type = mode >> 12
-        assert mode_type in [0b1000, 0b1010, 0b1110]
-        mode_perms = mode & 0b0000000111111111
-        # User ID
-        uid = int.from_bytes(content[idx+28: idx+32], "big")
-        # Group ID
-        gid = int.from_bytes(content[idx+32: idx+36], "big")
-        # Size
-        fsize = int.from_bytes(content[idx+36: idx+40], "big")
-        # SHA (object ID).  We'll store it as a lowercase hex string
-        # for consistency.
-        sha = format(int.from_bytes(content[idx+40: idx+60], "big"), "040x")
-        # Flags we're going to ignore
-        flags = int.from_bytes(content[idx+60: idx+62], "big")
-        # Parse flags
-        flag_assume_valid = (flags & 0b1000000000000000) != 0
-        flag_extended = (flags & 0b0100000000000000) != 0
-        assert not flag_extended
-        flag_stage = flags & 0b0011000000000000
+        offsets[i] = idx
+        flags = raw[idx + 60] << 8 | raw[idx + 61]
         # Length of the name.  This is stored on 12 bits, some max
         # value is 0xFFF, 4095.  Since names can occasionally go
         # beyond that length, git treats 0xFFF as meaning at least
-        # 0xFFF, and looks for the final 0x00 to find the end of the
-        # name --- at a small, and probably very rare, performance
-        # cost.
+        # 0xFFF, and looks for the final 0x00 to find the end of
+        # the name.
+        name = idx + 62
         name_length = flags & 0b0000111111111111
-
-        # We've read 62 bytes so far.
+        if flags & 0b0100000000000000:
+            # Extended flags come first, from version 3 on
+            assert version >= 3, "Extended flags in a version 2 index"
+            name += 2
+        if name_length == 0xFFF:
+            name_length = raw.index(b'\x00', name + 0xFFF) - name
+
+        # Entries are padded with 1 to 8 NULs so their length is
+        # a multiple of eight bytes.
+        idx += (name - idx + name_length + 8) & ~7
+    offsets[count] = idx
+    assert idx <= len(raw) - 20, "Truncated index"
+    return offsets
+
+
+@contextmanager
+def _gc_paused():
+    """Pause the garbage collector, which would otherwise go through
+    all the objects built so far every few hundred entries.  Entries
+    hold no reference cycles."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _index_entries(raw: bytes, offsets: array) -> list:
+    """Build the entries of a version 2 or 3 index, found by
+    _index_read_v2 in raw.  Nothing gets decoded until asked for."""
+    entries = list()
+    append = entries.append
+    unpack_from = INDEX_ENTRY.unpack_from
+    new_entry = PitIndexEntry.__new__
+    start = offsets[0]
+    with _gc_paused():
+        for end in itertools.islice(offsets, 1, None):
+            fields = unpack_from(raw, start)
+            # The object type is one of b1000 (regular), b1010
+            # (symlink), b1110 (gitlink), and the 16 high bits are
+            # unused.
+            assert fields[6] in INDEX_MODES, \
+                "Bad mode {0:o}".format(fields[6])
+            idx = start + 62
+            xflags = 0
+            if fields[11] & 0b0100000000000000:
+                xflags = int.from_bytes(raw[idx:idx + 2], "big")
+                idx += 2
+            name_length = fields[11] & 0b0000111111111111
+
+            entry = new_entry(PitIndexEntry)
+            entry.fields = fields
+            entry.xflags = xflags
+            if name_length == 0xFFF:
+                entry.raw_name = raw[idx:end].rstrip(b'\x00')
+            else:
+                entry.raw_name = raw[idx:idx + name_length]
+            entry._name = None
+            entry.span = (start, end)
+            append(entry)
+            start = end
+    return entries
+
+
+def _index_read_v4(raw, count: int):
+    """Read the entries of a version 4 index.
+
+    Entries aren't padded, and each name is stored as the number of
+    bytes to strip from the end of the previous name followed by the
+    suffix to append to what remains."""
+    entries = list()
+    append = entries.append
+    unpack_from = INDEX_ENTRY.unpack_from
+    new_entry = PitIndexEntry.__new__
+    find = raw.find
+    prev = b''
+    idx = 12
+    for i in range(0, count):
+        fields = unpack_from(raw, idx)
+        assert fields[6] in INDEX_MODES, "Bad mode {0:o}".format(fields[6])
         idx += 62
 
-        if name_length < 0xFFF:
-            assert content[idx + name_length] == 0x00
-            raw_name = content[idx:idx+name_length]
-            idx += name_length + 1
+        xflags = 0
+        if fields[11] & 0b0100000000000000:
+            xflags = int.from_bytes(raw[idx:idx + 2], "big")
+            idx += 2
+
+        # Same varint as pack OFS_DELTA offsets
+        c = raw[idx]
+        idx += 1
+        strip = c & 0x7f
+        while c & 0x80:
+            c = raw[idx]
+            idx += 1
+            strip = ((strip + 1) << 7) | (c & 0x7f)
+        end = find(b'\x00', idx)
+        name = prev[:len(prev) - strip] + raw[idx:end]
+        idx = end + 1
+
+        entry = new_entry(PitIndexEntry)
+        entry.fields = fields
+        entry.xflags = xflags
+        entry.raw_name = name
+        entry._name = None
+        # Entries can't be copied on their own: their name depends on
+        # the one before.
+        entry.span = None
+        append(entry)
+        prev = name
+
+    return entries, idx
+
+
+def index_signature(path) -> tuple:
+    """What tells us a file is still the one we read."""
+    st = os.stat(path)
+    return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+def index_entry_from_stat(name: str, st: os.stat_result,
+                          sha: str) -> PitIndexEntry:
+    """Build the index entry of a file from its stat data."""
+    import stat
+    if stat.S_ISLNK(st.st_mode):
+        mode_type, mode_perms = 0b1010, 0
+    else:
+        mode_type = 0b1000
+        mode_perms = 0o755 if st.st_mode & 0o100 else 0o644
+    # Everything is stored on 32 bits, truncated
+    m = 0xFFFFFFFF
+    return PitIndexEntry(
+        ctime=(st.st_ctime_ns // 10**9 & m, st.st_ctime_ns % 10**9),
+        mtime=(st.st_mtime_ns // 10**9 & m, st.st_mtime_ns % 10**9),
+        dev=st.st_dev & m, ino=st.st_ino & m,
+        mode_type=mode_type, mode_perms=mode_perms,
+        uid=st.st_uid & m, gid=st.st_gid & m, fsize=st.st_size & m,
+        sha=sha, name=name)
+
+
+def _index_varint(n: int) -> bytes:
+    out = bytearray([n & 0x7f])
+    n >>= 7
+    while n:
+        n -= 1
+        out.insert(0, 0x80 | (n & 0x7f))
+        n >>= 7
+    return bytes(out)
+
+
+def index_entry_pack(entry: PitIndexEntry, version=2, prev=b'') -> bytes:
+    """Serialize entry, with its padding.  Version 4 entries have no
+    padding, but their name is compressed against prev, the name of
+    the entry before."""
+    fields = entry.fields
+    name = entry.raw_name
+    xflags = entry.xflags
+    flags = ((fields[11] & 0b1011000000000000) | min(len(name), 0xFFF)
+             | (0b0100000000000000 if xflags else 0))
+    head = INDEX_ENTRY.pack(*fields[:11], flags)
+    if xflags:
+        head += xflags.to_bytes(2, "big")
+
+    if version == 4:
+        # Length of the common prefix, by bisection on slices
+        lo, hi = 0, min(len(prev), len(name))
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if prev[:mid] == name[:mid]:
+                lo = mid
+            else:
+                hi = mid - 1
+        common = lo
+        return (head + _index_varint(len(prev) - common) + name[common:]
+                + b'\x00')
+    length = len(head) + len(name)
+    return head + name + b'\x00' * (8 - length % 8)
+
+
+def index_entry_sort_key(entry: PitIndexEntry):
+    return entry.raw_name, entry.flag_stage
+
+
+def index_write(repo: Repository, index: PitIndex) -> None:
+    """Write index to .git/index, through .git/index.lock.
+
+    Entries read from the current index file and left untouched are
+    copied from it as is, in runs: only new and changed entries are
+    serialized again.  Version 4 indexes are always fully serialized,
+    as each entry's name depends on the previous one."""
+    index_file = repo_file(repo, "index")
+    index.entries.sort(key=index_entry_sort_key)
+    # Extended flags need at least version 3
+    if index.version == 2 and any(e.xflags for e in index.entries):
+        index.version = 3
+    version = index.version
+
+    with PitLockFile(index_file) as lock:
+        old = None
+        if version != 4 and index.source is not None \
+                and os.path.exists(index_file) \
+                and index_signature(index_file) + (version,) == index.source:
+            f = open(index_file, "rb")
+            old = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            f.close()
+
+        parts = [b"DIRC", version.to_bytes(4, "big"),
+                 len(index.entries).to_bytes(4, "big")]
+        if version == 4:
+            prev = b''
+            for entry in index.entries:
+                parts.append(index_entry_pack(entry, 4, prev))
+                prev = entry.raw_name
+                entry.span = None
         else:
-            print("Notice: Name is 0x{:X} bytes long.".format(name_length))
-            # This probably wasn't tested enough.  It works with a
-            # path of exactly 0xFFF bytes.  Any extra bytes broke
-            # something between git, my shell and my filesystem.
-            null_idx = content.find(b'\x00', idx + 0xFFF)
-            raw_name = content[idx: null_idx]
-            idx = null_idx + 1
-
-        # Just parse the name as utf8.
-        name = raw_name.decode("utf8")
-
-        # Data is padded on multiples of eight bytes for pointer
-        # alignment, so we skip as many bytes as we need for the next
-        # read to start at the right position.
-
-        idx = 8 * ceil(idx / 8)
-
-        # And we add this entry to our list.
-        entries.append(PitIndexEntry(ctime=(ctime_s, ctime_ns),
-                                     mtime=(mtime_s,  mtime_ns),
-                                     dev=dev,
-                                     ino=ino,
-                                     mode_type=mode_type,
-                                     mode_perms=mode_perms,
-                                     uid=uid,
-                                     gid=gid,
-                                     fsize=fsize,
-                                     sha=sha,
-                                     flag_assume_valid=flag_assume_valid,
-                                     flag_stage=flag_stage,
-                                     name=name))
-
-    return PitIndex(version=version, entries=entries)
+            _index_write_entries(index.entries, old, parts)
+        if old is not None:
+            old.close()
+        extensions = dict(index.extensions)
+        if index.fsmonitor_token is not None:
+            extensions[b"FSMN"] = _index_fsmonitor_extension(index)
+        for signature in INDEX_EXTENSIONS:
+            data = extensions.get(signature)
+            if data is not None:
+                parts += [signature, len(data).to_bytes(4, "big"), data]
+
+        data = b''.join(parts)
+        lock.write(data)
+        lock.write(hashlib.sha1(data).digest())
+        lock.commit()
+
+    index.source = index_signature(index_file) + (version,)
+
+
+def _index_write_entries(entries, old, parts) -> None:
+    pos = 12
+    # The run of untouched entries being copied from the old file
+    run_start = run_end = None
+    for entry in entries:
+        span = entry.span if old is not None else None
+        if span is not None and span[0] == run_end:
+            run_end = span[1]
+        else:
+            if run_start is not None:
+                parts.append(old[run_start:run_end])
+                run_start = None
+            if span is not None:
+                run_start, run_end = span
+            else:
+                run_end = None
+                parts.append(index_entry_pack(entry))
+        # Where the entry ends up in the new file, padded from its
+        # start
+        start = pos
+        pos = start + ((62 + (2 if entry.xflags else 0)
+                        + len(entry.raw_name) + 8) & ~7)
+        entry.span = (start, pos)
+    if run_start is not None:
+        parts.append(old[run_start:run_end])
 
 
 def tree_parse_one(raw: bytes, start=0) -> PitTreeLeaf:
@@ -262,12 +974,8 @@ def tree_parse_one(raw: bytes, start=0) -> PitTreeLeaf:
 
     # Find the NULL terminator of the path
     y = raw.find(b'\x00', x)
-    # and read the path
-    path = raw[x+1:y]
-
-    # Read the SHA and convert to a hex string
-    sha = format(int.from_bytes(raw[y+1:y+21], "big"), "040x")
-    return y+21, PitTreeLeaf(mode, path.decode("utf8"), sha)
+    # The path and the SHA are kept as they are
+    return y+21, PitTreeLeaf(mode, raw[x+1:y], raw[y+1:y+21])
 
 
 def tree_parse(raw: bytes):
@@ -281,26 +989,35 @@ def tree_parse(raw: bytes):
     return ret
 
 
-def tree_leaf_sort_key(leaf: PitTreeLeaf) -> str:
-    if leaf.mode.startswith(b"10"):
-        # file
-        return str(leaf.path)
-    else:
-        # folder
-        return str(leaf.path + "/")
+def tree_offsets(raw: bytes) -> array:
+    """The offsets of the entries of the tree data raw."""
+    ret = array("I")
+    pos = 0
+    end = len(raw)
+    find = raw.find
+    while pos < end:
+        ret.append(pos)
+        y = find(b'\x00', pos)
+        if y < 0 or y + 21 > end:
+            raise Exception("Malformed tree entry at {0}".format(pos))
+        pos = y + 21
+    return ret
+
+
+def tree_leaf_sort_key(leaf: PitTreeLeaf) -> bytes:
+    # git compares the names' bytes, trees as if they ended with "/".
+    # Symlinks and submodules sort like files.
+    if leaf.mode.lstrip() == b"40000":
+        return leaf.raw_path + b"/"
+    return leaf.raw_path
 
 
 def tree_serialize(obj: PitTree):
     obj.items.sort(key=tree_leaf_sort_key)
-    ret = b''
-    for i in obj.items:
-        ret += i.mode
-        ret += b' '
-        ret += i.path.encode("utf8")
-        ret += b'\x00'
-        sha = int(i.sha, 16)
-        ret += sha.to_bytes(20, byteorder="big")
-    return ret
+    # One join: adding to a bytes object copies it every time
+    return b''.join([b'%s %s\x00%s' % (leaf.mode.lstrip(), leaf.raw_path,
+                                       leaf.binsha)
+                     for leaf in obj.items])
 
 
 def object_resolve(repo: Repository, name: str):
@@ -314,7 +1031,6 @@ def object_resolve(repo: Repository, name: str):
     - branches
     - remote branches"""
     candidates = list()
-    hashRE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
 
     # Empty string?  Abort.
     if not name.strip():
@@ -322,23 +1038,12 @@ def object_resolve(repo: Repository, name: str):
 
     # Head is nonambiguous
     if name == "HEAD":
-        return [ref_resolve(repo, "HEAD")]
-
-    # If it's a hex string, try for a hash.
-    if hashRE.match(name):
-        # This may be a hash, either small or full.  4 seems to be the
-        # minimal length for git to consider something a short hash.
-        # This limit is documented in man git-rev-parse
-        name = name.lower()
-        prefix = name[0:2]
-        path = repo_dir(repo, "objects", prefix, mkdir=False)
-        if path:
-            rem = name[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    # Notice a string startswith() itself, so this
-                    # works for full hashes.
-                    candidates.append(prefix + f)
+        head = ref_resolve(repo, "HEAD")
+        return [head] if head else []
+
+    # If it's a hex string, try for a hash, either small or full.
+    if HASH_RE.match(name):
+        candidates += object_prefix_lookup(repo, name)
 
     # Try for references.
     as_tag = ref_resolve(repo, "refs/tags/" + name)
@@ -352,36 +1057,231 @@ def object_resolve(repo: Repository, name: str):
     return candidates
 
 
-def object_read(repo: Repository, sha: str):
-    path = repo_file(repo, "objects", sha[0:2], sha[2:])
-    if not path.exists():
-        return None
+def loose_oids(repo: Repository, fanout: str) -> list[str]:
+    """The sorted SHAs of the loose objects in objects/<fanout>.  The
+    directory is listed again only if it changed since the last call."""
+    path = os.path.join(repo.gitdir, "objects", fanout)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        repo.loose_oids.pop(fanout, None)
+        return []
+    cached = repo.loose_oids.get(fanout)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    shas = sorted(fanout + f for f in os.listdir(path) if len(f) == 38)
+    repo.loose_oids[fanout] = (mtime, shas)
+    return shas
+
+
+def object_prefix_lookup(repo: Repository, prefix: str) -> list[str]:
+    """The SHAs of the objects, loose or packed, starting with prefix (4
+    hex digits at least): binary searches in sorted lists."""
+    prefix = prefix.lower()
+    loose = loose_oids(repo, prefix[0:2])
+    ret = []
+    for sha in loose[bisect_left(loose, prefix):]:
+        if not sha.startswith(prefix):
+            break
+        ret.append(sha)
+    for sha in pack_prefix_lookup(repo, prefix):
+        if sha not in ret:
+            ret.append(sha)
+    return ret
+
+
+def abbrev_default(repo: Repository) -> int:
+    """The length of abbreviated SHAs: core.abbrev or, like git does
+    by default, enough for the number of packed objects not to collide,
+    7 at least."""
+    abbrev = repo.conf.get("core", "abbrev", fallback="auto")
+    if abbrev == "no":
+        return 40
+    if abbrev != "auto":
+        return min(40, max(4, int(abbrev)))
+    # About 2**bits objects, which collide at 2**(bits/2): 4 bits an
+    # hex digit
+    bits = pack_object_count(repo).bit_length()
+    return max(ABBREV_MIN, (bits + 1) // 2)
+
+
+def object_abbrev(repo: Repository, sha: str, length=None) -> str:
+    """The shortest prefix of sha no other object starts with, length
+    (abbrev_default() by default) hex digits at least.
+
+    Only the objects sorting right before and after sha can share a
+    longer prefix with it than the others."""
+    if length is None:
+        length = abbrev_default(repo)
+    loose = loose_oids(repo, sha[0:2])
+    i = bisect_left(loose, sha)
+    neighbours = loose[max(0, i - 1):i + 2] + pack_neighbours(repo, sha)
+    for other in neighbours:
+        if other == sha:
+            continue
+        common = 0
+        while common < 40 and other[common] == sha[common]:
+            common += 1
+        length = max(length, common + 1)
+    return sha[:min(length, 40)]
+
 
-    with open(path, "rb") as f:
+def _loose_path(repo: Repository, sha: str) -> str:
+    # Plain strings: this is on the path of every object read
+    return os.path.join(repo.gitdir, "objects", sha[0:2], sha[2:])
+
+
+def object_read_raw(repo: Repository, sha: str):
+    """Read sha from the loose objects or the packs of repo.
+
+    Returns (fmt, data) or None if the object doesn't exist."""
+    try:
+        f = open(_loose_path(repo, sha), "rb")
+    except (FileNotFoundError, NotADirectoryError):
+        return pack_read(repo, sha)
+    with f:
         data = zlib.decompress(f.read())
 
-        # get obj tye
-        x = data.find(b' ')
-        fmt = data[:x]
+    # get obj tye
+    x = data.find(b' ')
+    fmt = data[:x]
+
+    # validate obj size by finding null terminator
+    y = data.find(b'\x00', x)
+    size: int = int(data[x:y].decode("ascii"))
+    if size != len(data)-y-1:
+        raise Exception("Malformed object {0}: bad length".format(sha))
+
+    return fmt, data[y+1:]
+
+
+def _loose_header(f, d, sha: str):
+    """Inflate the header of the loose object open as f.
+
+    Returns (fmt, size, the first bytes of content inflated along)."""
+    header = b''
+    # The longest header is "commit <20 digits>\x00"
+    while b'\x00' not in header and len(header) < 32:
+        data = d.unconsumed_tail or f.read(256)
+        if not data:
+            break
+        header += d.decompress(data, 32 - len(header))
+
+    y = header.find(b'\x00')
+    x = header.find(b' ', 0, y)
+    if y < 0 or x < 0:
+        raise Exception("Malformed object {0}: bad header".format(sha))
+    return header[:x], int(header[x+1:y].decode("ascii")), header[y+1:]
+
+
+def object_read_header(repo: Repository, sha: str):
+    """Return (fmt, size) of sha without reading its content, or None
+    if the object doesn't exist.
 
-        # validate obj size by finding null terminator
-        y = data.find(b'\x00', x)
-        size: int = int(data[x:y].decode("ascii"))
-        if size != len(data)-y-1:
-            raise Exception("Malformed object {0}: bad length".format(sha))
+    Loose objects are only inflated up to the end of their header, and
+    packed ones only have their entry header read."""
+    cached = repo.cache.blobs.get(sha) if sha in repo.cache.blobs else None
+    if cached is not None:
+        return cached[0], len(cached[1])
 
-        # Pick constructor
-        match fmt:
-            case b'commit': c = PitCommit
-            case b'tree': c = PitTree
-            case b'tag': c = PitTag
-            case b'blob': c = PitBlob
-            case _:
-                raise Exception("Unknown type {0} for object {1}".format(
-                    fmt.decode("ascii"), sha))
+    try:
+        f = open(_loose_path(repo, sha), "rb")
+    except (FileNotFoundError, NotADirectoryError):
+        return pack_read_header(repo, sha)
+    with f:
+        fmt, size, _ = _loose_header(f, zlib.decompressobj(), sha)
+    return fmt, size
+
+
+def object_read(repo: Repository, sha: str):
+    """Read and parse sha, going through the repository's object cache.
+
+    Parsed trees, commits and tags are shared between callers: don't
+    modify them in place."""
+    cached = repo.cache.get(sha)
+    if isinstance(cached, tuple):
+        # Blobs are cached raw, the PitBlob wrapper is cheap
+        return PitBlob(cached[1])
+    if cached is not None:
+        return cached
+
+    raw = object_read_raw(repo, sha)
+    if raw is None:
+        return None
+    fmt, data = raw
 
-        # Call constructor and return object
-        return c(data[y+1:])
+    # Pick constructor
+    match fmt:
+        case b'commit': c = PitCommit
+        case b'tree': c = PitTree
+        case b'tag': c = PitTag
+        case b'blob': c = PitBlob
+        case _:
+            raise Exception("Unknown type {0} for object {1}".format(
+                fmt.decode("ascii"), sha))
+
+    # Call constructor and return object
+    obj = c(data)
+    repo.cache.put(sha, fmt, raw if fmt == b'blob' else obj, len(data))
+    return obj
+
+
+def _loose_stream(f, d, chunk_size: int, size: int, sha: str):
+    total = 0
+    try:
+        while True:
+            if d.unconsumed_tail:
+                out = d.decompress(d.unconsumed_tail, chunk_size)
+            elif d.eof:
+                break
+            else:
+                data = f.read(chunk_size)
+                if not data:
+                    out = d.flush()
+                    total += len(out)
+                    if out:
+                        yield out
+                    break
+                out = d.decompress(data, chunk_size)
+            if out:
+                total += len(out)
+                yield out
+    finally:
+        f.close()
+    if total != size:
+        raise Exception("Malformed object {0}: bad length".format(sha))
+
+
+def object_read_stream(repo: Repository, sha: str, chunk_size=STREAM_CHUNK):
+    """Open sha for streaming.
+
+    Returns (fmt, size, chunks) where chunks iterates over the content
+    in pieces of at most chunk_size bytes, or None if the object
+    doesn't exist."""
+    cached = repo.cache.blobs.get(sha) if sha in repo.cache.blobs else None
+    if cached is not None:
+        data = cached[1]
+        return b'blob', len(data), (data[i:i + chunk_size]
+                                    for i in range(0, len(data), chunk_size))
+
+    try:
+        f = open(_loose_path(repo, sha), "rb")
+    except (FileNotFoundError, NotADirectoryError):
+        return pack_read_stream(repo, sha, chunk_size)
+    d = zlib.decompressobj()
+    try:
+        fmt, size, head = _loose_header(f, d, sha)
+    except BaseException:
+        f.close()
+        raise
+
+    def chunks():
+        # The first bytes of content came along with the header
+        if head:
+            yield head
+        yield from _loose_stream(f, d, chunk_size, size - len(head), sha)
+
+    return fmt, size, chunks()
 
 
 def object_write(obj: PitObject, repo=None) -> str:
@@ -428,30 +1328,34 @@ def object_find(
         return sha
 
     while True:
-        obj = object_read(repo, sha)
-        #     ^^^^^^^^^^^ < this is a bit agressive: we're reading
-        # the full object just to get its type.  And we're doing
-        # that in a loop, albeit normally short.  Don't expect
-        # high performance here.
-        # TODO: Add read_obj_type?
-
-        if obj.fmt == fmt:
+        # Only peek at the type: we don't want to inflate a blob just
+        # to find out it's not the tree we're looking for.
+        header = object_read_header(repo, sha)
+        if header is None:
+            raise Exception("No such object {0}.".format(sha))
+        obj_fmt = header[0]
+
+        if obj_fmt == fmt:
             return sha
 
         if not follow:
             return None
 
         # Follow tags
-        if obj.fmt == b'tag':
-            sha = obj.kvlm[b'object'].decode("ascii")
-        elif obj.fmt == b'commit' and fmt == b'tree':
-            sha = obj.kvlm[b'tree'].decode("ascii")
+        if obj_fmt == b'tag':
+            sha = object_read(repo, sha).kvlm[b'object'].decode("ascii")
+        elif obj_fmt == b'commit' and fmt == b'tree':
+            sha = object_read(repo, sha).tree
         else:
             return None
 
 
 def object_hash(fd, fmt, repo=None):
     """ Hash object, writing it to repo if provided."""
+    if fmt == b'blob':
+        # No need to parse blobs: don't load them in memory either
+        return object_hash_stream(fd, fmt, repo)
+
     data = fd.read()
 
     # Choose constructor according to fmt argument
@@ -465,81 +1369,374 @@ def object_hash(fd, fmt, repo=None):
     return object_write(obj, repo)
 
 
-def kvlm_parse(raw: bytes, start: int = 0, dct: OrderedDict = None):
-    """Key-Value List with Message"""
-    if not dct:
-        dct = OrderedDict()
-        # You CANNOT declare the argument as dct=OrderedDict() or all
-        # call to the functions will endlessly grow the same dict.
+def object_hash_stream(fd, fmt=b'blob', repo=None, size=None,
+                       chunk_size=STREAM_CHUNK) -> str:
+    """Hash the content of fd in chunks, writing it to repo if provided.
 
-    # This function is recursive: it reads a key/value pair, then call
-    # itself back with the new position.  So we first need to know
-    # where we are: at a keyword, or already in the messageQ
-
-    # We search for the next space and the next newline.
-    space_index = raw.find(b' ', start)
-    newline_index = raw.find(b'\n', start)
-
-    # If space appears before newline, we have a keyword.  Otherwise,
-    # it's the final message, which we just read to the end of the file.
-
-    # Base case
-    # =========
-    # If newline appears first (or there's no space at all, in which
-    # case find returns -1), we assume a blank line.  A blank line
-    # means the remainder of the data is the message.  We store it in
-    # the dictionary, with None as the key, and return.
-    if (space_index < 0) or (newline_index < space_index):
-        assert newline_index == start
-        dct[None] = raw[start+1:]
-        return dct
-
-    # Recursive case
-    # ==============
-    # we read a key-value pair and recurse for the next.
-    key = raw[start:space_index]
-
-    # Find the end of the value.  Continuation lines begin with a
-    # space, so we loop until we find a "\n" not followed by a space.
-    end = start
-    while True:
-        end = raw.find(b'\n', end+1)
-        if raw[end+1] != ord(' '):
-            break
+    The header needs the size up front: if not given, it is taken from
+    fstat for regular files.  Anything else (a pipe, say) is first
+    spooled to a temporary file."""
+    import hashlib
+    import shutil
+    import stat
+    from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+
+    spool = None
+    if size is None:
+        try:
+            st = os.fstat(fd.fileno())
+            if stat.S_ISREG(st.st_mode):
+                size = st.st_size - fd.tell()
+        except (AttributeError, OSError, ValueError):
+            pass
+    if size is None:
+        spool = SpooledTemporaryFile(max_size=chunk_size)
+        shutil.copyfileobj(fd, spool, chunk_size)
+        size = spool.tell()
+        spool.seek(0)
+        fd = spool
+
+    header = fmt + b' ' + str(size).encode() + b'\x00'
+    h = hashlib.sha1(header)
+    out = None
+    if repo:
+        compressor = zlib.compressobj()
+        out = NamedTemporaryFile(dir=repo_dir(repo, "objects"), delete=False)
+        out.write(compressor.compress(header))
+
+    try:
+        total = 0
+        while True:
+            data = fd.read(chunk_size)
+            if not data:
+                break
+            total += len(data)
+            h.update(data)
+            if out:
+                out.write(compressor.compress(data))
+        if total != size:
+            raise Exception("Size changed while hashing")
+        sha = h.hexdigest()
+
+        if out:
+            out.write(compressor.flush())
+            out.close()
+            path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+            if path.exists():
+                os.remove(out.name)
+            else:
+                os.rename(out.name, path)
+    except BaseException:
+        if out:
+            out.close()
+            os.remove(out.name)
+        raise
+    finally:
+        if spool:
+            spool.close()
+
+    return sha
+
+
+class PitLooseWriter:
+    """Writes loose objects to repo from several threads.
+
+    An object is compressed and written once, however many threads
+    bring it, and not at all if repo has it already.  The fanout
+    directories are listed once, and each missing one created once."""
+
+    def __init__(self, repo: Repository):
+        self.repo = repo
+        self.objects = os.path.join(repo.gitdir, "objects")
+        # git's core.looseCompression, 1 (fastest) by default
+        self.level = repo.conf.getint(
+            "core", "loosecompression",
+            fallback=repo.conf.getint("core", "compression", fallback=1))
+        self.packs = pack_list(repo)
+        self.dirs = {d for d in os.listdir(self.objects) if len(d) == 2}
+        self.claimed = set()
+        self.lock = threading.Lock()
+
+    def _claim(self, sha: str) -> bool:
+        """Whether sha is ours to write: nobody else claimed it, and
+        repo doesn't have it."""
+        with self.lock:
+            if sha in self.claimed:
+                return False
+            self.claimed.add(sha)
+        if sha[0:2] in self.dirs and os.path.exists(
+                os.path.join(self.objects, sha[0:2], sha[2:])):
+            return False
+        binsha = bytes.fromhex(sha)
+        return not any(binsha in pack for pack in self.packs)
+
+    def write(self, sha: str, header: bytes, data: bytes) -> None:
+        if not self._claim(sha):
+            return
+        compressor = zlib.compressobj(self.level)
+        compressed = compressor.compress(header) + \
+            compressor.compress(data) + compressor.flush()
+
+        fanout = os.path.join(self.objects, sha[0:2])
+        if sha[0:2] not in self.dirs:
+            with self.lock:
+                if sha[0:2] not in self.dirs:
+                    os.makedirs(fanout, exist_ok=True)
+                    self.dirs.add(sha[0:2])
+        fd, tmp = mkstemp(dir=fanout, prefix="tmp_obj_")
+        try:
+            view = memoryview(compressed)
+            while view:
+                view = view[os.write(fd, view):]
+            os.close(fd)
+            fd = None
+            os.rename(tmp, os.path.join(fanout, sha[2:]))
+        except BaseException:
+            if fd is not None:
+                os.close(fd)
+            os.remove(tmp)
+            raise
+
+
+def _hash_file(path, writer: PitLooseWriter | None) -> str:
+    with open(path, "rb") as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if size > HASH_INLINE_MAX:
+            return object_hash_stream(fd, b'blob',
+                                      writer.repo if writer else None,
+                                      size=size)
+        data = fd.read()
+    header = b'blob %d\x00' % len(data)
+    h = hashlib.sha1(header)
+    h.update(data)
+    sha = h.hexdigest()
+    if writer:
+        writer.write(sha, header, data)
+    return sha
+
+
+def hash_many(repo: Repository | None, paths, write=True,
+              workers=None) -> list[str]:
+    """Hash the files at paths as blobs, writing them to repo if write.
+    Returns their SHAs, in the same order.
 
-    # Grab the value
-    # Also, drop the leading space on continuation lines
-    value = raw[space_index+1:end].replace(b'\n ', b'\n')
+    Files are read, hashed and compressed on a thread pool: hashlib and
+    zlib let go of the GIL on large buffers.  Files bigger than
+    HASH_INLINE_MAX are streamed."""
+    paths = list(paths)
+    writer = PitLooseWriter(repo) if write else None
 
-    # Don't overwrite existing data contents
-    if key in dct:
-        if isinstance(dct[key], list):
-            dct[key].append(value)
+    def batch(start: int) -> list[str]:
+        return [_hash_file(path, writer)
+                for path in paths[start:start + HASH_BATCH]]
+
+    ret = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for shas in pool.map(batch, range(0, len(paths), HASH_BATCH)):
+            ret += shas
+    return ret
+
+
+def hash_iter(repo: Repository | None, paths, write=True, workers=None):
+    """Like hash_many, but yield each SHA as soon as it is known, in
+    the order of paths.
+
+    paths is read as the files get hashed, by a thread of its own: it
+    can be a pipe whose next path only comes once the SHA of the last
+    one is out."""
+    writer = PitLooseWriter(repo) if write else None
+    # Futures in the order of paths, then None, or what iterating paths
+    # raised
+    pending = queue.Queue(maxsize=HASH_INFLIGHT)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def feed():
+            try:
+                for path in paths:
+                    pending.put(pool.submit(_hash_file, path, writer))
+                pending.put(None)
+            except BaseException as e:
+                pending.put(e)
+
+        threading.Thread(target=feed, daemon=True).start()
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item.result()
+
+
+def kvlm_parse(raw: bytes, start: int = 0, dct: dict = None):
+    """Key-Value List with Message
+
+    Parse the headers of a commit or a tag, then its message, stored
+    with None as the key.  Repeated keys (parent) have a list of values.
+    A value goes on over the following lines starting with a space
+    (gpgsig, mergetag): the space is dropped."""
+    if dct is None:
+        dct = dict()
+        # You CANNOT declare the argument as dct=dict() or all
+        # call to the functions will endlessly grow the same dict.
+
+    # One line, or one value over several lines, at a time
+    find = raw.find
+    size = len(raw)
+    while start < size:
+        # A blank line: the remainder of the data is the message
+        if raw[start] == 0x0a:
+            dct[None] = raw[start+1:]
+            return dct
+
+        space = find(b' ', start)
+        end = find(b'\n', start)
+        if end < 0:
+            end = size
+        if space < 0 or space > end:
+            raise Exception("Malformed header line at {0}".format(start))
+        key = raw[start:space]
+
+        multiline = False
+        while end + 1 < size and raw[end+1] == 0x20:
+            multiline = True
+            end = find(b'\n', end+1)
+            if end < 0:
+                end = size
+        value = raw[space+1:end]
+        if multiline:
+            value = value.replace(b'\n ', b'\n')
+
+        # Don't overwrite existing data contents
+        old = dct.get(key)
+        if old is None:
+            dct[key] = value
+        elif isinstance(old, list):
+            old.append(value)
         else:
-            dct[key] = [dct[key], value]
+            dct[key] = [old, value]
+        start = end + 1
+
+    # No message at all
+    dct[None] = b''
+    return dct
+
+
+def kvlm_header(raw: bytes, key: bytes) -> list[bytes]:
+    """The values of the one-line header key of the commit or tag raw,
+    without parsing the others."""
+    ret = []
+    prefix = key + b' '
+    needle = b'\n' + prefix
+    # Not in the message
+    end = raw.find(b'\n\n')
+    if end < 0:
+        end = len(raw)
+    find = raw.find
+    if raw.startswith(prefix):
+        pos = 0
     else:
-        dct[key] = value
+        pos = find(needle, 0, end)
+        if pos < 0:
+            return ret
+        pos += 1
+    while True:
+        eol = find(b'\n', pos)
+        ret.append(raw[pos+len(prefix):eol])
+        pos = find(needle, eol, end)
+        if pos < 0:
+            return ret
+        pos += 1
 
-    return kvlm_parse(raw, start=end+1, dct=dct)
 
+def signature_time(signature: bytes) -> int:
+    """The timestamp of an author or committer line, "Name <email>
+    1700000000 +0100"."""
+    return int(signature[signature.rindex(b'>')+1:].split()[0])
 
-def kvlm_serialize(kvlm: OrderedDict) -> bytes:
-    ret = b''
+
+def kvlm_serialize(kvlm: dict) -> bytes:
+    parts = []
 
     # Output fields
-    for k in kvlm.keys():
+    for k, val in kvlm.items():
         # Skip the message itself
         if k is None:
             continue
-        val = kvlm[k]
         # Normalize to a list
         if not isinstance(val, list):
             val = [val]
 
         for v in val:
-            ret += k + b' ' + (v.replace(b'\n', b'\n ')) + b'\n'
+            parts += (k, b' ', v.replace(b'\n', b'\n '), b'\n')
 
     # Append message
-    ret += b'\n' + kvlm[None] + b'\n'
+    parts += (b'\n', kvlm.get(None, b''))
+    return b''.join(parts)
 
-    return ret
+
+def object_reachable(repo: Repository, shas):
+    """Walk the objects reachable from shas.
+
+    Yields (sha, fmt, path) tuples, commits and tags first, then trees
+    and blobs in the order they're met.  path is the name of the tree
+    entry an object was found under, None for commits and tags.  Blobs
+    are never read: their type is known from the tree entry."""
+    seen = set()
+    pending = [(sha, None) for sha in reversed(list(shas))]
+    trees = []
+
+    while pending:
+        sha, path = pending.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+
+        obj = object_read(repo, sha)
+        if obj is None:
+            raise Exception("Missing object {0}".format(sha))
+        if obj.fmt == b'tree':
+            # Trees are walked breadth-first, after all commits
+            seen.discard(sha)
+            trees.append((sha, path))
+            continue
+        yield sha, obj.fmt, path
+
+        if obj.fmt == b'commit':
+            trees.append((obj.tree, ""))
+            for p in reversed(obj.parents):
+                pending.append((p, None))
+        elif obj.fmt == b'tag':
+            pending.append((obj.kvlm[b'object'].decode("ascii"), None))
+
+    trees = deque(trees)
+    while trees:
+        sha, path = trees.popleft()
+        if sha in seen:
+            continue
+        seen.add(sha)
+        tree = object_read(repo, sha)
+        if tree is None:
+            raise Exception("Missing object {0}".format(sha))
+        yield sha, b'tree', path
+        for mode, name, binsha in tree.entries():
+            sha = binsha.hex()
+            if mode == b'40000':
+                trees.append((sha, name.decode("utf8")))
+            elif mode == b'160000':
+                # A submodule: the commit lives in another repository
+                continue
+            elif sha not in seen:
+                seen.add(sha)
+                yield sha, b'blob', name.decode("utf8")
+
+
+def tree_walk(repo: Repository, sha: str, prefix=""):
+    """Yield (path, mode, sha) for every non-tree entry below the tree
+    sha, recursively.  Paths use "/" as separator, like the index."""
+    tree = object_read(repo, sha)
+    for mode, name, binsha in tree.entries():
+        path = prefix + name.decode("utf8")
+        if mode == b'40000':
+            yield from tree_walk(repo, binsha.hex(), path + "/")
+        else:
+            yield path, mode, binsha.hex()
@@ -0,0 +1,827 @@
+import os
+import mmap
+import zlib
+from pathlib import Path
+from pit.repo import (
+    Repository,
+    repo_dir,
+)
+
+# Object type numbers, as stored in the 3-bit type field of a pack
+# entry header.
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_NAMES = {
+    OBJ_COMMIT: b'commit',
+    OBJ_TREE: b'tree',
+    OBJ_BLOB: b'blob',
+    OBJ_TAG: b'tag',
+}
+
+TYPE_NUMBERS = {v: k for k, v in TYPE_NAMES.items()}
+
+IDX_SIGNATURE = b'\377tOc'
+PACK_SIGNATURE = b'PACK'
+
+# Size of the chunks of compressed data fed to zlib when inflating
+# an entry.  Entries are usually small, so we don't want to copy the
+# whole remainder of the pack out of the mmap for each of them.
+INFLATE_CHUNK = 64 * 1024
+
+
+class PitPackIndex:
+    """A memory-mapped .idx file (version 2).
+
+    Layout: 8 bytes header, 256 fanout entries (4 bytes each, the
+    cumulative count of objects whose first SHA byte is <= i), then
+    the sorted 20-byte SHAs, one CRC32 per object, one 4-byte offset
+    per object and finally the 8-byte table for offsets >= 2**31."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[0:4] != IDX_SIGNATURE:
+            raise Exception("Unsupported pack index {0}".format(path))
+        version = int.from_bytes(self.map[4:8], "big")
+        if version != 2:
+            raise Exception(
+                "Unsupported pack index version {0}".format(version))
+
+        self.fanout = [
+            int.from_bytes(self.map[8 + 4 * i:12 + 4 * i], "big")
+            for i in range(256)]
+        self.count = self.fanout[255]
+
+        self._sha_start = 8 + 256 * 4
+        self._crc_start = self._sha_start + 20 * self.count
+        self._ofs_start = self._crc_start + 4 * self.count
+        self._large_ofs_start = self._ofs_start + 4 * self.count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self) -> None:
+        self.map.close()
+
+    def sha_at(self, i: int) -> bytes:
+        """Binary SHA of the i-th object, in index order."""
+        start = self._sha_start + 20 * i
+        return self.map[start:start + 20]
+
+    def offset_at(self, i: int) -> int:
+        """Offset in the .pack of the i-th object, in index order."""
+        start = self._ofs_start + 4 * i
+        offset = int.from_bytes(self.map[start:start + 4], "big")
+        if offset & 0x80000000:
+            # MSB set: the rest is an index into the large offset table
+            start = self._large_ofs_start + 8 * (offset & 0x7fffffff)
+            offset = int.from_bytes(self.map[start:start + 8], "big")
+        return offset
+
+    def crc_at(self, i: int) -> int:
+        """CRC32 of the raw entry of the i-th object, in index order."""
+        start = self._crc_start + 4 * i
+        return int.from_bytes(self.map[start:start + 4], "big")
+
+    def _bounds(self, first_byte: int) -> tuple[int, int]:
+        lo = self.fanout[first_byte - 1] if first_byte else 0
+        return lo, self.fanout[first_byte]
+
+    def _bisect(self, key: bytes, lo: int, hi: int) -> int:
+        """Leftmost position in [lo, hi) whose SHA is >= key."""
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, binsha: bytes) -> int | None:
+        """Return the pack offset of binsha, or None."""
+        lo, hi = self._bounds(binsha[0])
+        i = self._bisect(binsha, lo, hi)
+        if i < hi and self.sha_at(i) == binsha:
+            return self.offset_at(i)
+        return None
+
+    def prefix_lookup(self, prefix: str) -> list[str]:
+        """Return the hex SHAs in this index starting with prefix."""
+        prefix = prefix.lower()
+        # Pad an odd-length prefix so it can be compared as bytes
+        key = bytes.fromhex(prefix + "0" * (len(prefix) % 2))
+        lo, hi = self._bounds(key[0])
+        ret = []
+        for i in range(self._bisect(key, lo, hi), hi):
+            sha = self.sha_at(i).hex()
+            if not sha.startswith(prefix):
+                break
+            ret.append(sha)
+        return ret
+
+    def neighbours(self, binsha: bytes) -> list[bytes]:
+        """The SHAs right before and after binsha in this index (binsha
+        itself left out), among those with the same first byte."""
+        lo, hi = self._bounds(binsha[0])
+        i = self._bisect(binsha, lo, hi)
+        ret = []
+        if i > lo:
+            ret.append(self.sha_at(i - 1))
+        if i < hi and self.sha_at(i) == binsha:
+            i += 1
+        if i < hi:
+            ret.append(self.sha_at(i))
+        return ret
+
+    def iter_shas(self):
+        for i in range(self.count):
+            yield self.sha_at(i)
+
+
+class PitPack:
+    """A memory-mapped .pack file together with its .idx."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.index = PitPackIndex(self.path.with_suffix(".idx"))
+        with open(self.path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[0:4] != PACK_SIGNATURE:
+            raise Exception("Not a pack file {0}".format(path))
+        version = int.from_bytes(self.map[4:8], "big")
+        if version not in (2, 3):
+            raise Exception("Unsupported pack version {0}".format(version))
+        count = int.from_bytes(self.map[8:12], "big")
+        if count != len(self.index):
+            raise Exception(
+                "Pack {0} and its index disagree on object count"
+                .format(path))
+
+    def close(self) -> None:
+        self.map.close()
+        self.index.close()
+
+    def __contains__(self, binsha: bytes) -> bool:
+        return self.index.find(binsha) is not None
+
+    def entry_header(self, offset: int) -> tuple[int, int, int]:
+        """Parse the entry header at offset.
+
+        Returns (type number, inflated size, offset of the data)."""
+        c = self.map[offset]
+        offset += 1
+        type_num = (c >> 4) & 0x7
+        size = c & 0x0f
+        shift = 4
+        while c & 0x80:
+            c = self.map[offset]
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return type_num, size, offset
+
+    def ofs_delta_base(self, offset: int) -> tuple[int, int]:
+        """Read the negative base offset of an OFS_DELTA entry.
+
+        Returns (absolute base offset, offset of the data)."""
+        c = self.map[offset]
+        offset += 1
+        base = c & 0x7f
+        while c & 0x80:
+            c = self.map[offset]
+            offset += 1
+            base = ((base + 1) << 7) | (c & 0x7f)
+        return base, offset
+
+    def inflate(self, offset: int, size: int) -> bytes:
+        """Inflate size bytes of zlib data starting at offset."""
+        d = zlib.decompressobj()
+        out = []
+        while not d.eof:
+            chunk = self.map[offset:offset + INFLATE_CHUNK]
+            if not chunk:
+                raise Exception(
+                    "Truncated entry in {0}".format(self.path))
+            offset += len(chunk)
+            out.append(d.decompress(chunk))
+        data = b''.join(out)
+        if len(data) != size:
+            raise Exception(
+                "Malformed entry in {0}: bad length".format(self.path))
+        return data
+
+    def read_at(self, offset: int, resolve_ref=None,
+                bases=None) -> tuple[bytes, bytes]:
+        """Read the entry at offset, resolving deltas.
+
+        resolve_ref is called with a binary SHA to fetch the base of a
+        REF_DELTA that lives outside this pack, and must return
+        (fmt, data) or None.  bases, if given, maps offsets to the
+        (fmt, data) of entries read already (a dict or a PitLRUCache):
+        walking down a delta chain stops there.  Returns (fmt, data)."""
+        # Walk down the delta chain to the base object, remembering
+        # the deltas on the way.  This is a loop rather than a
+        # recursion: chains can be as deep as git's --depth (50).
+        deltas = []
+        while True:
+            found = bases.get(offset) if bases is not None else None
+            if found is not None:
+                fmt, data = found
+                break
+            type_num, size, data_offset = self.entry_header(offset)
+            if type_num == OBJ_OFS_DELTA:
+                base, data_offset = self.ofs_delta_base(data_offset)
+                deltas.append(self.inflate(data_offset, size))
+                offset -= base
+            elif type_num == OBJ_REF_DELTA:
+                binsha = self.map[data_offset:data_offset + 20]
+                deltas.append(self.inflate(data_offset + 20, size))
+                base_offset = self.index.find(binsha)
+                if base_offset is not None:
+                    offset = base_offset
+                    continue
+                base = resolve_ref(binsha) if resolve_ref else None
+                if base is None:
+                    raise Exception(
+                        "Missing delta base {0}".format(binsha.hex()))
+                fmt, data = base
+                break
+            elif type_num in TYPE_NAMES:
+                fmt = TYPE_NAMES[type_num]
+                data = self.inflate(data_offset, size)
+                break
+            else:
+                raise Exception(
+                    "Unknown pack entry type {0} in {1}"
+                    .format(type_num, self.path))
+
+        for delta in reversed(deltas):
+            data = delta_apply(data, delta)
+        return fmt, data
+
+    def read(self, binsha: bytes, resolve_ref=None):
+        """Read binsha from this pack.  Returns (fmt, data) or None."""
+        offset = self.index.find(binsha)
+        if offset is None:
+            return None
+        return self.read_at(offset, resolve_ref)
+
+    def inflate_stream(self, offset: int, size: int, chunk_size: int):
+        """Inflate the zlib data at offset as an iterator of chunks of
+        at most chunk_size bytes."""
+        d = zlib.decompressobj()
+        total = 0
+        while not d.eof:
+            data = d.unconsumed_tail or self.map[offset:offset + chunk_size]
+            if not data:
+                raise Exception(
+                    "Truncated entry in {0}".format(self.path))
+            if not d.unconsumed_tail:
+                offset += len(data)
+            out = d.decompress(data, chunk_size)
+            if out:
+                total += len(out)
+                yield out
+        if total != size:
+            raise Exception(
+                "Malformed entry in {0}: bad length".format(self.path))
+
+    def read_stream(self, binsha: bytes, chunk_size: int, resolve_ref=None,
+                    resolve_ref_header=None):
+        """Return (fmt, size, iterator over the content) for binsha, or
+        None.  Only whole entries can be streamed: deltified ones are
+        rebuilt in memory, once the iteration starts."""
+        offset = self.index.find(binsha)
+        if offset is None:
+            return None
+        type_num, size, data_offset = self.entry_header(offset)
+        if type_num in TYPE_NAMES:
+            return (TYPE_NAMES[type_num], size,
+                    self.inflate_stream(data_offset, size, chunk_size))
+
+        fmt, size = self.read_header_at(offset, resolve_ref_header)
+
+        def chunks():
+            _, data = self.read_at(offset, resolve_ref)
+            for i in range(0, len(data), chunk_size):
+                yield data[i:i + chunk_size]
+        return fmt, size, chunks()
+
+    def inflate_head(self, offset: int, size: int) -> bytes:
+        """Inflate at most the first size bytes of the zlib data at
+        offset."""
+        d = zlib.decompressobj()
+        out = b''
+        chunk = 64
+        while len(out) < size and not d.eof:
+            data = d.unconsumed_tail or self.map[offset:offset + chunk]
+            if not data:
+                break
+            if not d.unconsumed_tail:
+                offset += len(data)
+                chunk *= 2
+            out += d.decompress(data, size - len(out))
+        return out
+
+    def read_header_at(self, offset: int, resolve_ref=None):
+        """Return (fmt, size) of the entry at offset, only inflating
+        the first bytes of a delta to read the size of its result.
+
+        resolve_ref works like for read_at, but returns (fmt, size)."""
+        type_num, size, data_offset = self.entry_header(offset)
+        if type_num in TYPE_NAMES:
+            return TYPE_NAMES[type_num], size
+
+        # The size of the result is the second varint of the delta.
+        # The type is the one of the base at the end of the chain.
+        if type_num == OBJ_OFS_DELTA:
+            _, delta_offset = self.ofs_delta_base(data_offset)
+        else:
+            delta_offset = data_offset + 20
+        head = self.inflate_head(delta_offset, 20)
+        _, pos = delta_varint(head, 0)
+        size, _ = delta_varint(head, pos)
+
+        while type_num in (OBJ_OFS_DELTA, OBJ_REF_DELTA):
+            if type_num == OBJ_OFS_DELTA:
+                base, _ = self.ofs_delta_base(data_offset)
+                offset -= base
+            else:
+                binsha = self.map[data_offset:data_offset + 20]
+                offset = self.index.find(binsha)
+                if offset is None:
+                    base = resolve_ref(binsha) if resolve_ref else None
+                    if base is None:
+                        raise Exception(
+                            "Missing delta base {0}".format(binsha.hex()))
+                    return base[0], size
+            type_num, _, data_offset = self.entry_header(offset)
+
+        if type_num not in TYPE_NAMES:
+            raise Exception(
+                "Unknown pack entry type {0} in {1}"
+                .format(type_num, self.path))
+        return TYPE_NAMES[type_num], size
+
+    def read_header(self, binsha: bytes, resolve_ref=None):
+        """Return (fmt, size) of binsha, or None."""
+        offset = self.index.find(binsha)
+        if offset is None:
+            return None
+        return self.read_header_at(offset, resolve_ref)
+
+
+def delta_varint(delta: bytes, pos: int) -> tuple[int, int]:
+    """Read a little-endian base-128 size from a delta header."""
+    value = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        value |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return value, pos
+
+
+def delta_apply(base: bytes, delta: bytes) -> bytes:
+    """Reconstruct an object from its base and a git delta."""
+    src_size, pos = delta_varint(delta, 0)
+    if src_size != len(base):
+        raise Exception("Delta base size mismatch")
+    dst_size, pos = delta_varint(delta, pos)
+
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # Copy from base.  Bits 0-3 say which offset bytes are
+            # present, bits 4-6 which size bytes are.
+            offset = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            size = 0
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out += base[offset:offset + size]
+        elif op:
+            # Insert the next op bytes literally
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise Exception("Invalid delta opcode 0")
+
+    if len(out) != dst_size:
+        raise Exception("Delta result size mismatch")
+    return bytes(out)
+
+
+def pack_list(repo: Repository) -> list[PitPack]:
+    """Return the packs of repo, (re)loading them if objects/pack
+    changed since the last call."""
+    path = repo_dir(repo, "objects", "pack")
+    if not path:
+        return []
+
+    mtime = os.stat(path).st_mtime_ns
+    if repo.packs is not None and repo.packs[0] == mtime:
+        return repo.packs[1]
+
+    if repo.packs is not None:
+        for pack in repo.packs[1]:
+            pack.close()
+
+    packs = []
+    for f in sorted(os.listdir(path)):
+        if f.endswith(".pack") and os.path.exists(
+                os.path.join(path, f[:-5] + ".idx")):
+            packs.append(PitPack(os.path.join(path, f)))
+    repo.packs = (mtime, packs)
+    return packs
+
+
+def pack_read(repo: Repository, sha: str):
+    """Read sha from the packs of repo.  Returns (fmt, data) or None."""
+    binsha = bytes.fromhex(sha)
+    packs = pack_list(repo)
+
+    def resolve_ref(base: bytes):
+        for pack in packs:
+            found = pack.read(base, resolve_ref)
+            if found:
+                return found
+        return None
+
+    return resolve_ref(binsha)
+
+
+def pack_read_header(repo: Repository, sha: str):
+    """Return (fmt, size) of sha from the packs of repo, or None."""
+    binsha = bytes.fromhex(sha)
+    packs = pack_list(repo)
+
+    def resolve_ref(base: bytes):
+        for pack in packs:
+            found = pack.read_header(base, resolve_ref)
+            if found:
+                return found
+        return None
+
+    return resolve_ref(binsha)
+
+
+def pack_read_stream(repo: Repository, sha: str, chunk_size: int):
+    """Return (fmt, size, iterator over the content) of sha from the
+    packs of repo, or None."""
+    binsha = bytes.fromhex(sha)
+    packs = pack_list(repo)
+
+    def resolve_ref(base: bytes):
+        for pack in packs:
+            found = pack.read(base, resolve_ref)
+            if found:
+                return found
+        return None
+
+    def resolve_ref_header(base: bytes):
+        for pack in packs:
+            found = pack.read_header(base, resolve_ref_header)
+            if found:
+                return found
+        return None
+
+    for pack in packs:
+        found = pack.read_stream(binsha, chunk_size, resolve_ref,
+                                 resolve_ref_header)
+        if found:
+            return found
+    return None
+
+
+def pack_prefix_lookup(repo: Repository, prefix: str) -> list[str]:
+    """Return the hex SHAs of packed objects starting with prefix."""
+    ret = set()
+    for pack in pack_list(repo):
+        ret.update(pack.index.prefix_lookup(prefix))
+    return sorted(ret)
+
+
+def pack_neighbours(repo: Repository, sha: str) -> list[str]:
+    """The hex SHAs of the packed objects closest to sha, on both sides
+    (see PitPackIndex.neighbours)."""
+    binsha = bytes.fromhex(sha)
+    ret = []
+    for pack in pack_list(repo):
+        ret += [n.hex() for n in pack.index.neighbours(binsha)]
+    return ret
+
+
+def pack_object_count(repo: Repository) -> int:
+    """The number of objects in the packs of repo, duplicates
+    included."""
+    return sum(len(pack.index) for pack in pack_list(repo))
+
+
+# Objects larger than this are stored whole: finding matches is done
+# in pure Python and would be far too slow on big binaries.
+DELTA_MAX_SIZE = 1024 * 1024
+# Size of the blocks of the base object we index to find matches.
+DELTA_BLOCK = 16
+
+
+def pack_name_hash(name: str | None) -> int:
+    """Git's path name hash, used to sort objects so that files
+    with similar names (mostly the same name in different revisions)
+    end up next to each other.  The last characters count most."""
+    h = 0
+    if not name:
+        return h
+    for c in name.encode("utf8"):
+        if c in b' \t\n\r':
+            continue
+        h = ((h >> 2) + (c << 24)) & 0xffffffff
+    return h
+
+
+def _delta_size(size: int) -> bytes:
+    out = bytearray()
+    while True:
+        c = size & 0x7f
+        size >>= 7
+        if size:
+            out.append(c | 0x80)
+        else:
+            out.append(c)
+            return bytes(out)
+
+
+def _delta_copy(offset: int, size: int) -> bytes:
+    op = 0x80
+    args = bytearray()
+    for i in range(4):
+        b = (offset >> (8 * i)) & 0xff
+        if b:
+            op |= 1 << i
+            args.append(b)
+    # A size of 0x10000 is encoded with no size bytes at all.
+    for i in range(3):
+        b = (size >> (8 * i)) & 0xff
+        if b:
+            op |= 0x10 << i
+            args.append(b)
+    return bytes([op]) + args
+
+
+def delta_create(base: bytes, target: bytes, max_size: int | None = None):
+    """Compute a git delta turning base into target.
+
+    Returns None if the delta would be larger than max_size."""
+    index = {}
+    for i in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(base[i:i + DELTA_BLOCK], i)
+
+    out = [_delta_size(len(base)), _delta_size(len(target))]
+    out_size = len(out[0]) + len(out[1])
+    insert_start = 0
+    pos = 0
+    end = len(target)
+
+    def flush_insert(stop):
+        nonlocal out_size
+        start = insert_start
+        while start < stop:
+            n = min(127, stop - start)
+            out.append(bytes([n]) + target[start:start + n])
+            out_size += n + 1
+            start += n
+
+    while pos <= end - DELTA_BLOCK:
+        offset = index.get(target[pos:pos + DELTA_BLOCK])
+        if offset is None:
+            pos += 1
+            continue
+
+        # Extend the match forward, a block at a time, then bytewise
+        size = DELTA_BLOCK
+        while (pos + size + DELTA_BLOCK <= end
+               and base[offset + size:offset + size + DELTA_BLOCK]
+               == target[pos + size:pos + size + DELTA_BLOCK]):
+            size += DELTA_BLOCK
+        while (pos + size < end and offset + size < len(base)
+               and base[offset + size] == target[pos + size]):
+            size += 1
+        # ...and backward into the pending literal bytes
+        while (pos > insert_start and offset > 0
+               and base[offset - 1] == target[pos - 1]):
+            pos -= 1
+            offset -= 1
+            size += 1
+
+        flush_insert(pos)
+        done = 0
+        while done < size:
+            n = min(0x10000, size - done)
+            op = _delta_copy(offset + done, n)
+            out.append(op)
+            out_size += len(op)
+            done += n
+        pos += size
+        insert_start = pos
+
+        if max_size is not None and out_size > max_size:
+            return None
+
+    flush_insert(end)
+    if max_size is not None and out_size > max_size:
+        return None
+    return b''.join(out)
+
+
+def _entry_header(type_num: int, size: int) -> bytes:
+    c = (type_num << 4) | (size & 0x0f)
+    size >>= 4
+    out = bytearray()
+    while size:
+        out.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    out.append(c)
+    return bytes(out)
+
+
+def _ofs_encode(offset: int) -> bytes:
+    out = bytearray([offset & 0x7f])
+    offset >>= 7
+    while offset:
+        offset -= 1
+        out.insert(0, 0x80 | (offset & 0x7f))
+        offset >>= 7
+    return bytes(out)
+
+
+class PitPackEntry:
+    """An object to be written to a pack, and its delta base if any."""
+
+    __slots__ = ("sha", "fmt", "name", "size", "base", "delta", "depth")
+
+    def __init__(self, sha: str, fmt: bytes, name: str | None = None):
+        self.sha = sha
+        self.fmt = fmt
+        self.name = name
+        self.size = 0
+        self.base = None
+        self.delta = None
+        self.depth = 0
+
+
+def pack_find_deltas(entries: list[PitPackEntry], read,
+                     window=10, depth=50) -> None:
+    """Pick a delta base for each entry, git style.
+
+    Entries are sorted by type, name hash and decreasing size, and
+    each one is compared against the `window` entries before it.  read
+    is called with a hex SHA and returns (fmt, data)."""
+    for e in entries:
+        e.size = len(read(e.sha)[1]) if e.size == 0 else e.size
+
+    order = sorted(entries, key=lambda e: (
+        e.fmt, pack_name_hash(e.name), -e.size))
+
+    candidates = []
+    for e in order:
+        data = read(e.sha)[1]
+        if len(data) <= DELTA_MAX_SIZE and window > 0:
+            # Not worth it if we can't save at least half
+            max_size = len(data) // 2 - 20
+            for base, base_data in reversed(candidates):
+                if base.fmt != e.fmt or base.depth >= depth:
+                    continue
+                if len(base_data) > DELTA_MAX_SIZE or \
+                        len(base_data) < len(data) // 32:
+                    continue
+                if max_size <= 0:
+                    break
+                delta = delta_create(base_data, data, max_size)
+                if delta is not None and len(delta) < max_size:
+                    e.base, e.delta = base, delta
+                    e.depth = base.depth + 1
+                    max_size = len(delta)
+
+        candidates.append((e, data))
+        if len(candidates) > window:
+            candidates.pop(0)
+
+
+def pack_write(repo: Repository, entries: list[PitPackEntry], read,
+               window=10, depth=50) -> Path:
+    """Write entries to a new .pack/.idx pair in objects/pack.
+
+    read is called with a hex SHA and returns (fmt, data).  Returns
+    the path of the new pack."""
+    import hashlib
+    from tempfile import NamedTemporaryFile
+
+    pack_find_deltas(entries, read, window, depth)
+
+    path = repo_dir(repo, "objects", "pack", mkdir=True)
+    offsets = {}
+    crcs = {}
+    checksum = hashlib.sha1()
+
+    with NamedTemporaryFile(dir=path, delete=False, prefix="tmp_pack_") \
+            as f:
+        def emit(b: bytes):
+            checksum.update(b)
+            f.write(b)
+
+        emit(PACK_SIGNATURE + (2).to_bytes(4, "big")
+             + len(entries).to_bytes(4, "big"))
+        offset = 12
+
+        def write_entry(e: PitPackEntry):
+            nonlocal offset
+            if e.delta is not None:
+                base_offset = offsets[e.base.sha]
+                raw = (_entry_header(OBJ_OFS_DELTA, len(e.delta))
+                       + _ofs_encode(offset - base_offset)
+                       + zlib.compress(e.delta))
+            else:
+                fmt, data = read(e.sha)
+                raw = (_entry_header(TYPE_NUMBERS[fmt], len(data))
+                       + zlib.compress(data))
+            emit(raw)
+            offsets[e.sha] = offset
+            crcs[e.sha] = zlib.crc32(raw)
+            offset += len(raw)
+
+        # Keep the caller's order (usually recency order), but bases
+        # must be written before the deltas pointing back to them.
+        for e in entries:
+            chain = []
+            while e is not None and e.sha not in offsets:
+                chain.append(e)
+                e = e.base
+            for e in reversed(chain):
+                write_entry(e)
+
+        pack_sha = checksum.digest()
+        f.write(pack_sha)
+        tmp_pack = f.name
+
+    name = "pack-" + pack_sha.hex()
+    shas = sorted(offsets)
+
+    with NamedTemporaryFile(dir=path, delete=False, prefix="tmp_idx_") as f:
+        idx = hashlib.sha1()
+
+        def emit_idx(b: bytes):
+            idx.update(b)
+            f.write(b)
+
+        emit_idx(IDX_SIGNATURE + (2).to_bytes(4, "big"))
+        fanout = [0] * 256
+        for sha in shas:
+            fanout[int(sha[0:2], 16)] += 1
+        total = 0
+        for i in range(256):
+            total += fanout[i]
+            emit_idx(total.to_bytes(4, "big"))
+        emit_idx(b''.join(bytes.fromhex(sha) for sha in shas))
+        emit_idx(b''.join(crcs[sha].to_bytes(4, "big") for sha in shas))
+        large = []
+        small = []
+        for sha in shas:
+            if offsets[sha] < 0x80000000:
+                small.append(offsets[sha].to_bytes(4, "big"))
+            else:
+                small.append((0x80000000 | len(large)).to_bytes(4, "big"))
+                large.append(offsets[sha].to_bytes(8, "big"))
+        emit_idx(b''.join(small))
+        emit_idx(b''.join(large))
+        emit_idx(pack_sha)
+        f.write(idx.digest())
+        tmp_idx = f.name
+
+    # The .idx goes last: readers ignore packs without one.
+    pack_path = path / (name + ".pack")
+    os.chmod(tmp_pack, 0o444)
+    os.chmod(tmp_idx, 0o444)
+    os.replace(tmp_pack, pack_path)
+    os.replace(tmp_idx, path / (name + ".idx"))
+    return pack_path
@@ -0,0 +1,423 @@
+import os
+import re
+from bisect import bisect_left
+from collections import OrderedDict
+from pit.repo import Repository
+from pit.lockfile import PitLockFile
+
+# Refs live in two places: loose, one file per ref below .git (a SHA or
+# "ref: <name>" for symbolic refs), and packed, in .git/packed-refs:
+#
+#   # pack-refs with: peeled fully-peeled sorted
+#   <sha> refs/heads/main
+#   <sha> refs/tags/v1.0
+#   ^<sha>
+#
+# where a "^" line gives the object the annotated tag above points to
+# (peels to).  Loose refs win over packed ones.  Both are read once
+# and kept on the repository until their file changes.
+
+PACKED_REFS_HEADER = b'# pack-refs with: peeled fully-peeled sorted \n'
+
+# Symbolic refs are followed this deep at most, like git
+SYMREF_MAX_DEPTH = 5
+
+# The value of a ref that doesn't exist, in updates
+ZERO_SHA = "0" * 40
+
+# How long to wait for a lock another writer holds: git's defaults for
+# core.filesRefLockTimeout and core.packedRefsTimeout
+REF_LOCK_TIMEOUT = 0.1
+PACKED_REFS_LOCK_TIMEOUT = 1.0
+
+# What git's check-ref-format rejects in a component
+REF_NAME_BAD = re.compile(
+    r"[\x00-\x20\x7f~^:?*\[\\]|\.\.|@\{|^\.|\.lock$|^$")
+
+
+class PitPackedRefs:
+    """The parsed packed-refs file: refs maps names to SHAs, peeled maps
+    the names of annotated tags to what they peel to."""
+
+    def __init__(self, data=b''):
+        self.refs = {}
+        self.peeled = {}
+        last = None
+        for line in data.splitlines():
+            if not line or line.startswith(b'#'):
+                continue
+            if line.startswith(b'^'):
+                if last is None:
+                    raise Exception("Peeled line without a ref in "
+                                    "packed-refs: {0!r}".format(line))
+                self.peeled[last] = line[1:41].decode("ascii")
+                continue
+            sha, _, name = line.partition(b' ')
+            if len(sha) != 40 or not name:
+                raise Exception(
+                    "Malformed packed-refs line: {0!r}".format(line))
+            last = name.decode("utf8")
+            self.refs[last] = sha.decode("ascii")
+
+    def serialize(self) -> bytes:
+        lines = [PACKED_REFS_HEADER]
+        for name in sorted(self.refs, key=lambda n: n.encode("utf8")):
+            lines.append("{0} {1}\n".format(self.refs[name], name)
+                         .encode("utf8"))
+            if name in self.peeled:
+                lines.append("^{0}\n".format(self.peeled[name])
+                             .encode("ascii"))
+        return b''.join(lines)
+
+
+def _stat_signature(path) -> tuple | None:
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def packed_refs(repo: Repository) -> PitPackedRefs:
+    """The packed refs of repo, read again only if packed-refs changed
+    since the last call."""
+    path = os.path.join(repo.gitdir, "packed-refs")
+    signature = _stat_signature(path)
+    if repo.packed_refs is not None and repo.packed_refs[0] == signature:
+        return repo.packed_refs[1]
+    if signature is None:
+        packed = PitPackedRefs()
+    else:
+        with open(path, "rb") as f:
+            packed = PitPackedRefs(f.read())
+    repo.packed_refs = (signature, packed)
+    return packed
+
+
+def ref_read_loose(repo: Repository, name: str) -> str | None:
+    """The content of the loose ref name, without its newline: a SHA or
+    "ref: <name>".  Only read if the file changed since the last call."""
+    path = os.path.join(repo.gitdir, name)
+    signature = _stat_signature(path)
+    if signature is None:
+        repo.loose_refs.pop(name, None)
+        return None
+    cached = repo.loose_refs.get(name)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    try:
+        with open(path, "r") as f:
+            data = f.read().rstrip("\n")
+    except IsADirectoryError:
+        data = None
+    repo.loose_refs[name] = (signature, data)
+    return data
+
+
+def ref_read(repo: Repository, name: str) -> str | None:
+    """The value of the ref name, loose or packed, symbolic refs not
+    followed."""
+    data = ref_read_loose(repo, name)
+    if data is not None:
+        return data
+    return packed_refs(repo).refs.get(name)
+
+
+def ref_resolve(repo: Repository, ref: str) -> str | None:
+    """The SHA ref points to, following symbolic refs, or None."""
+    for _ in range(SYMREF_MAX_DEPTH):
+        data = ref_read(repo, ref)
+        if data is None or not data.startswith("ref: "):
+            return data
+        ref = data[5:]
+    raise Exception("Symbolic refs too deep at {0}".format(ref))
+
+
+def ref_peeled(repo: Repository, ref: str) -> str | None:
+    """What the annotated tag ref peels to, if packed-refs knows."""
+    if ref_read_loose(repo, ref) is not None:
+        return None
+    return packed_refs(repo).peeled.get(ref)
+
+
+def _loose_names(repo: Repository, prefix="refs"):
+    """The names of the loose refs below prefix."""
+    for entry in os.scandir(os.path.join(repo.gitdir, prefix)):
+        name = prefix + "/" + entry.name
+        if entry.is_dir(follow_symlinks=False):
+            yield from _loose_names(repo, name)
+        elif not entry.name.endswith(".lock"):
+            yield name
+
+
+def ref_dict(repo: Repository) -> dict[str, str]:
+    """Every ref below refs/, by name, with the SHA it resolves to, sorted
+    by name like git does."""
+    refs = dict(packed_refs(repo).refs)
+    try:
+        loose = list(_loose_names(repo))
+    except FileNotFoundError:
+        loose = []
+    for name in loose:
+        sha = ref_resolve(repo, name)
+        if sha is not None:
+            refs[name] = sha
+    return {name: refs[name]
+            for name in sorted(refs, key=lambda n: n.encode("utf8"))}
+
+
+def ref_list(repo: Repository) -> OrderedDict:
+    """The refs below refs/, as nested dicts by path component: the
+    leaves are SHAs."""
+    ret = OrderedDict()
+    for name, sha in ref_dict(repo).items():
+        *dirs, leaf = name.split("/")[1:]
+        d = ret
+        for part in dirs:
+            d = d.setdefault(part, OrderedDict())
+        d[leaf] = sha
+    return ret
+
+
+def refs_pack(repo: Repository, all_refs=False, prune=True) -> int:
+    """Move loose refs to packed-refs: tags, or with all_refs every
+    ref (refs packed already stay there).  Annotated tags get their
+    peeled line.  Unless prune, the loose files are kept.  Returns the
+    number of refs packed."""
+    packed = packed_refs(repo)
+    new = PitPackedRefs()
+    new.refs = dict(packed.refs)
+    new.peeled = dict(packed.peeled)
+    moved = {}
+    for name in _loose_names(repo) if os.path.isdir(
+            os.path.join(repo.gitdir, "refs")) else ():
+        data = ref_read_loose(repo, name)
+        if data is None or data.startswith("ref: "):
+            continue
+        if not (all_refs or name.startswith("refs/tags/")):
+            continue
+        moved[name] = data
+        new.refs[name] = data
+        new.peeled.pop(name, None)
+        peeled = _peel(repo, data)
+        if peeled is not None:
+            new.peeled[name] = peeled
+
+    with PitLockFile(os.path.join(repo.gitdir, "packed-refs"),
+                     timeout=PACKED_REFS_LOCK_TIMEOUT) as lock:
+        lock.write(new.serialize())
+        lock.commit()
+
+    if prune:
+        for name, sha in moved.items():
+            # Unless it was updated meanwhile
+            if ref_read_loose(repo, name) == sha:
+                os.remove(os.path.join(repo.gitdir, name))
+                _remove_empty_parents(repo, name)
+    return len(moved)
+
+
+def _remove_empty_parents(repo: Repository, name: str) -> None:
+    """Remove the emptied directories of the ref name, up to (not
+    including) refs/<something>/."""
+    parts = name.split("/")[:-1]
+    while len(parts) > 2:
+        try:
+            os.rmdir(os.path.join(repo.gitdir, *parts))
+        except OSError:
+            return
+        parts.pop()
+
+
+def _peel(repo: Repository, sha: str) -> str | None:
+    """What the annotated tag sha peels to, down to something that isn't
+    a tag; None if sha isn't a tag."""
+    from pit.objects import object_read
+
+    obj = object_read(repo, sha)
+    peeled = sha
+    while obj is not None and obj.fmt == b'tag':
+        peeled = obj.kvlm[b'object'].decode("ascii")
+        obj = object_read(repo, peeled)
+    return peeled if peeled != sha else None
+
+
+def ref_name_check(name: str) -> None:
+    """Raise unless name is a valid name for a ref below refs/, or
+    HEAD."""
+    if name == "HEAD":
+        return
+    parts = name.split("/")
+    if len(parts) < 2 or parts[0] != "refs" or \
+            any(REF_NAME_BAD.search(part) for part in parts[1:]):
+        raise Exception("'{0}' is not a valid ref name".format(name))
+
+
+class PitRefTransaction:
+    """A batch of ref updates, applied together or not at all.
+
+        tx = PitRefTransaction(repo)
+        tx.create("refs/tags/v1.0", sha)
+        tx.update("refs/heads/main", new, old)
+        tx.commit()
+
+    An old value of None means any, ZERO_SHA that the ref must not
+    exist, and a new value of ZERO_SHA deletes the ref.  commit() locks
+    every ref, and packed-refs when refs are deleted, then checks the
+    old values: if a lock is held elsewhere or a ref moved, it raises
+    having changed nothing.  packed-refs is written first, then the
+    loose refs are renamed into place, like git does.
+
+    With packed, the refs are written to packed-refs (their loose files
+    removed): a single file to write for thousands of refs."""
+
+    def __init__(self, repo: Repository, packed=False, fsync=False):
+        self.repo = repo
+        self.packed = packed
+        self.fsync = fsync
+        # Name: (new, old), new None to only check old
+        self.updates = {}
+
+    def update(self, name: str, new: str | None, old: str | None = None):
+        # Symbolic refs (HEAD) update what they point to
+        for _ in range(SYMREF_MAX_DEPTH):
+            data = ref_read(self.repo, name)
+            if data is None or not data.startswith("ref: "):
+                break
+            name = data[5:]
+        ref_name_check(name)
+        if name in self.updates:
+            raise Exception(
+                "Multiple updates for ref '{0}' not allowed".format(name))
+        self.updates[name] = (new, old)
+
+    def create(self, name: str, new: str) -> None:
+        self.update(name, new, ZERO_SHA)
+
+    def delete(self, name: str, old: str | None = None) -> None:
+        self.update(name, ZERO_SHA, old)
+
+    def verify(self, name: str, old: str) -> None:
+        self.update(name, None, old)
+
+    def _check_conflicts(self, packed: PitPackedRefs) -> None:
+        """Raise if a ref being created is the directory of another one
+        ("refs/a" and "refs/a/b"), or the other way around."""
+        names = set(packed.refs)
+        for name in self.updates:
+            if ref_read_loose(self.repo, name) is not None:
+                names.add(name)
+        deleted = {name for name, (new, _) in self.updates.items()
+                   if new == ZERO_SHA}
+        created = sorted(name for name, (new, _) in self.updates.items()
+                         if new not in (None, ZERO_SHA))
+        existing = sorted((names | set(created)) - deleted)
+        for name in created:
+            parts = name.split("/")
+            for i in range(2, len(parts)):
+                prefix = "/".join(parts[:i])
+                # A ref deleted along is no conflict, unless its loose
+                # file is in the way of the new directory
+                if prefix in deleted and not os.path.isfile(
+                        os.path.join(self.repo.gitdir, prefix)):
+                    continue
+                if prefix in self.updates or \
+                        ref_read(self.repo, prefix) is not None:
+                    raise Exception(
+                        "cannot lock ref '{0}': '{1}' exists; cannot "
+                        "create '{0}'".format(name, prefix))
+            i = bisect_left(existing, name + "/")
+            below = existing[i] if i < len(existing) else ""
+            if not below.startswith(name + "/"):
+                below = next((n for n in _loose_names(self.repo, name)
+                              if n not in deleted), "") \
+                    if os.path.isdir(os.path.join(self.repo.gitdir, name)) \
+                    else ""
+            if below:
+                raise Exception(
+                    "cannot lock ref '{0}': '{1}' exists; cannot create "
+                    "'{0}'".format(name, below))
+
+    def commit(self) -> None:
+        repo = self.repo
+        names = sorted(self.updates)
+        self._check_conflicts(packed_refs(repo))
+        deleting = any(new == ZERO_SHA for new, _ in self.updates.values())
+        locks = {}
+        cleanup = []
+        try:
+            # Refs in order, then packed-refs, like git
+            for name in names:
+                path = os.path.join(repo.gitdir, name)
+                new = self.updates[name][0]
+                if new not in (None, ZERO_SHA) and not self.packed:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                elif not os.path.isdir(os.path.dirname(path)):
+                    # Not written as a loose file, and there's none to
+                    # guard either
+                    continue
+                locks[name] = PitLockFile(path, fsync=self.fsync,
+                                          timeout=REF_LOCK_TIMEOUT)
+                locks[name].acquire()
+            if self.packed or deleting:
+                locks[None] = PitLockFile(
+                    os.path.join(repo.gitdir, "packed-refs"),
+                    fsync=self.fsync, timeout=PACKED_REFS_LOCK_TIMEOUT)
+                locks[None].acquire()
+
+            # Nobody else can change them now
+            packed = packed_refs(repo)
+            for name in names:
+                new, old = self.updates[name]
+                current = ref_read(repo, name) or ZERO_SHA
+                if old is None or current == old:
+                    continue
+                if old == ZERO_SHA:
+                    raise Exception("cannot lock ref '{0}': reference "
+                                    "already exists".format(name))
+                if current == ZERO_SHA:
+                    raise Exception("cannot lock ref '{0}': unable to "
+                                    "resolve reference".format(name))
+                raise Exception(
+                    "cannot lock ref '{0}': is at {1} but expected {2}"
+                    .format(name, current, old))
+
+            if None in locks:
+                new_packed = PitPackedRefs()
+                new_packed.refs = dict(packed.refs)
+                new_packed.peeled = dict(packed.peeled)
+                for name in names:
+                    new = self.updates[name][0]
+                    if new is None:
+                        continue
+                    new_packed.peeled.pop(name, None)
+                    if new == ZERO_SHA:
+                        new_packed.refs.pop(name, None)
+                    elif self.packed:
+                        new_packed.refs[name] = new
+                        peeled = _peel(repo, new)
+                        if peeled is not None:
+                            new_packed.peeled[name] = peeled
+                locks[None].write(new_packed.serialize())
+                locks[None].commit()
+
+            for name in names:
+                new = self.updates[name][0]
+                if new is None:
+                    continue
+                if new == ZERO_SHA or self.packed:
+                    try:
+                        os.remove(os.path.join(repo.gitdir, name))
+                    except (FileNotFoundError, IsADirectoryError):
+                        # Or a directory for refs created below it
+                        pass
+                    cleanup.append(name)
+                else:
+                    locks[name].write((new + "\n").encode("ascii"))
+                    locks[name].commit()
+                repo.loose_refs.pop(name, None)
+        finally:
+            for lock in locks.values():
+                lock.rollback()
+        for name in cleanup:
+            _remove_empty_parents(repo, name)
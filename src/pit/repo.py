@@ -1,6 +1,7 @@
 from pathlib import Path
 from configparser import ConfigParser
 import os
+from pit.cache import PitObjectCache
 
 
 class Repository:
@@ -14,6 +15,21 @@ class Repository:
             raise Exception("Not a pit repo, %s", path)
 
         self.conf = self._read_config(force=force)
+        # Packs are loaded lazily by pit.pack.pack_list, as a
+        # (objects/pack mtime, list of PitPack) pair.
+        self.packs = None
+        # Loaded lazily by pit.commitgraph.commit_graph_get, as a
+        # (commit-graph stat, PitCommitGraph or None) pair.
+        self.commit_graph = None
+        # Sorted SHAs of the loose objects, by fanout directory, as
+        # (directory mtime, list) pairs: see pit.objects.loose_oids.
+        self.loose_oids = {}
+        # Refs, see pit.refs: packed-refs as a (stat, PitPackedRefs)
+        # pair, and loose refs by name as (stat, content) pairs.
+        self.packed_refs = None
+        self.loose_refs = {}
+        # Objects read through pit.objects.object_read
+        self.cache = PitObjectCache()
 
     def _read_config(self, force=True):
 
@@ -0,0 +1,440 @@
+import heapq
+import itertools
+from datetime import datetime, timedelta, timezone
+from pit.repo import Repository
+from pit.objects import PitCommit, object_abbrev, object_find, object_read
+from pit.commitgraph import (
+    GENERATION_INFINITY,
+    PitCommitGraph,
+    commit_graph_get,
+)
+from pit.bloom import bloom_path_keys, bloom_contains
+from pit.diff import tree_entry
+
+# Like git's revision walk: commits come out newest first (by committer
+# date) from a priority queue their parents are put into.  Commits
+# reachable from an excluded one ("^A", or A in "A..B") are
+# uninteresting.  Telling them apart needs the walk to go on until
+# only uninteresting commits are left: such walks, and topological
+# order, list all the commits before showing any.  Others stream.
+# Parents, dates and trees come from the commit-graph when it has them.
+
+# Uninteresting commits still walked once everything left is: git's
+# slop, for commits with clocks going backwards.
+WALK_SLOP = 5
+
+# Flags of the merge base walk
+PARENT1 = 1
+PARENT2 = 2
+STALE = 4
+
+
+def rev_parse_revisions(repo: Repository, names) -> tuple[list, list]:
+    """The commits to start from and the ones to exclude, for names like
+    "A", "^A" and "A..B" (HEAD if a side is empty).  No names means
+    HEAD."""
+    include = []
+    exclude = []
+    for name in names or ["HEAD"]:
+        if ".." in name:
+            a, _, b = name.partition("..")
+            exclude.append(a or "HEAD")
+            include.append(b or "HEAD")
+        elif name.startswith("^"):
+            exclude.append(name[1:])
+        else:
+            include.append(name)
+
+    def resolve(name):
+        sha = object_find(repo, name, fmt=b'commit')
+        if sha is None:
+            raise Exception("Not a commit: {0}".format(name))
+        return sha
+    return [resolve(n) for n in include], [resolve(n) for n in exclude]
+
+
+def _commit_read(repo: Repository, sha: str) -> PitCommit:
+    commit = object_read(repo, sha)
+    if commit is None or commit.fmt != b'commit':
+        raise Exception("Not a commit: {0}".format(sha))
+    return commit
+
+
+def commit_links(repo: Repository, graph: PitCommitGraph | None,
+                 sha: str) -> tuple[list[str], int, int]:
+    """(parents, committer date, generation) of the commit sha: from
+    graph (the commit-graph of repo, looked up once per walk) if it has
+    the commit, from the commit itself (and an infinite generation)
+    otherwise."""
+    if graph is not None:
+        found = graph.lookup(sha)
+        if found is not None:
+            return found
+    commit = _commit_read(repo, sha)
+    return commit.parents, commit.committer_time, GENERATION_INFINITY
+
+
+def commit_tree(repo: Repository, graph: PitCommitGraph | None,
+                sha: str) -> str:
+    """The tree of the commit sha, from graph if it has the commit."""
+    if graph is not None:
+        tree = graph.lookup_tree(sha)
+        if tree is not None:
+            return tree
+    return _commit_read(repo, sha).tree
+
+
+class PitPathLimit:
+    """The paths a walk is limited to.
+
+    With changed-path Bloom filters in the commit-graph, most commits
+    that didn't touch them are told apart without reading a tree."""
+
+    def __init__(self, repo: Repository, graph: PitCommitGraph | None,
+                 paths):
+        self.repo = repo
+        self.paths = [p.strip("/") for p in paths]
+        self.graph = graph
+        self.keys = None
+        if self.graph is not None and self.graph.bloom_settings:
+            version, num_hashes, _ = self.graph.bloom_settings
+            self.keys = [bloom_path_keys(p, num_hashes, version)
+                         for p in self.paths]
+
+    def maybe_changed(self, sha: str) -> bool:
+        """False if the commit sha surely didn't change the paths since
+        its first parent."""
+        data = self.graph.bloom_filter(sha) if self.keys else None
+        if data is None:
+            return True
+        return any(all(bloom_contains(data, k) for k in keys)
+                   for keys in self.keys)
+
+    def same(self, a: str | None, b: str) -> bool:
+        """Whether the paths are the same in the trees a and b (None for
+        an empty tree)."""
+        return all((tree_entry(self.repo, a, p) if a else None) ==
+                   tree_entry(self.repo, b, p) for p in self.paths)
+
+
+def _simplify(repo: Repository, limit: PitPathLimit, sha: str,
+              parents: list, relevant=None) -> tuple[bool, list]:
+    """Whether the commit sha changes the paths of limit, and the parents
+    to walk on: git's default history simplification.
+
+    A commit with the same paths as one of its (relevant) parents isn't
+    shown, and the walk goes on with that parent alone."""
+    tree = commit_tree(repo, limit.graph, sha)
+    if not parents:
+        return not limit.same(None, tree), parents
+    changed = False
+    for i, p in enumerate(parents):
+        if i == 0 and not limit.maybe_changed(sha):
+            same = True
+        else:
+            same = limit.same(commit_tree(repo, limit.graph, p), tree)
+        if not same:
+            changed = True
+        elif relevant is None or relevant(p):
+            return False, [p]
+    return changed, parents
+
+
+def rev_walk(repo: Repository, include, exclude=(), max_count=None,
+             first_parent=False, topo_order=False, paths=None):
+    """Yield the SHAs of the commits reachable from include but not from
+    exclude, newest first, or with topo_order, never a commit before
+    its children (and each line of history in one go).
+
+    With paths, only the commits changing them are, and history is
+    simplified like git does."""
+    if max_count is not None and max_count <= 0:
+        return
+    graph = commit_graph_get(repo)
+    limit = PitPathLimit(repo, graph, paths) if paths else None
+    if exclude or topo_order:
+        shas, parents_of, shown = _rev_walk_limited(
+            repo, graph, include, exclude, first_parent, limit)
+        if topo_order:
+            shas = _topo_sort(shas, parents_of)
+        walk = (sha for sha in shas if sha in shown)
+    else:
+        walk = _rev_walk_stream(repo, graph, include, first_parent, limit)
+    yield from itertools.islice(walk, max_count)
+
+
+def _rev_walk_stream(repo: Repository, graph: PitCommitGraph | None,
+                     include, first_parent: bool,
+                     limit: PitPathLimit | None):
+    seen = set()
+    queue = []
+    # Commits of the same date come out in the order they came in
+    order = itertools.count()
+
+    def push(sha):
+        seen.add(sha)
+        parents, date, _ = commit_links(repo, graph, sha)
+        heapq.heappush(queue, (-date, next(order), sha, parents))
+
+    for sha in include:
+        if sha not in seen:
+            push(sha)
+    while queue:
+        _, _, sha, parents = heapq.heappop(queue)
+        if first_parent:
+            parents = parents[:1]
+        shown = True
+        if limit is not None:
+            shown, parents = _simplify(repo, limit, sha, parents)
+        for p in parents:
+            if p not in seen:
+                push(p)
+        if shown:
+            yield sha
+
+
+def _rev_walk_limited(repo: Repository, graph: PitCommitGraph | None,
+                      include, exclude, first_parent,
+                      limit: PitPathLimit | None):
+    """The interesting commits, newest first, the parents walked from
+    each, and the ones to show."""
+    seen = set()
+    queue = []
+    order = itertools.count()
+    uninteresting = set()
+    # Parents of the commits taken out of the queue already
+    parents_of = {}
+    # The commits in the queue, and how many of them are interesting
+    queued = set()
+    interesting = 0
+
+    def push(sha):
+        nonlocal interesting
+        seen.add(sha)
+        parents, date, _ = commit_links(repo, graph, sha)
+        heapq.heappush(queue, (-date, next(order), sha, parents))
+        queued.add(sha)
+        if sha not in uninteresting:
+            interesting += 1
+
+    def mark_uninteresting(sha):
+        nonlocal interesting
+        # Along with what's below it, if it was walked already
+        stack = [sha]
+        while stack:
+            sha = stack.pop()
+            if sha in uninteresting:
+                continue
+            uninteresting.add(sha)
+            if sha in queued:
+                interesting -= 1
+            stack.extend(parents_of.get(sha, ()))
+
+    for sha in exclude:
+        uninteresting.add(sha)
+        if sha not in seen:
+            push(sha)
+    for sha in include:
+        if sha not in seen:
+            push(sha)
+
+    ret = []
+    shown = set()
+    slop = WALK_SLOP
+    date = None
+    while queue:
+        key, _, sha, parents = heapq.heappop(queue)
+        queued.discard(sha)
+        if sha not in uninteresting:
+            interesting -= 1
+        if sha in uninteresting:
+            parents_of[sha] = parents
+            for p in parents:
+                mark_uninteresting(p)
+                if p not in seen:
+                    push(p)
+            # Go on while there are interesting commits left, or
+            # commits newer than the last interesting one
+            if not queue:
+                break
+            if (date is not None and date <= -queue[0][0]) or interesting:
+                slop = WALK_SLOP
+            else:
+                slop -= 1
+                if not slop:
+                    break
+            continue
+
+        if first_parent:
+            parents = parents[:1]
+        if limit is None:
+            shown.add(sha)
+        else:
+            # Like git, the excluded commits themselves are relevant
+            changed, parents = _simplify(
+                repo, limit, sha, parents,
+                relevant=lambda p: p not in uninteresting or p in exclude)
+            if changed:
+                shown.add(sha)
+        parents_of[sha] = parents
+        for p in parents:
+            if p not in seen:
+                push(p)
+        date = -key
+        ret.append(sha)
+    ret = [sha for sha in ret if sha not in uninteresting]
+    return ret, parents_of, shown
+
+
+def _topo_sort(shas: list, parents_of: dict):
+    """Sort shas, newest first, so that commits come after all their
+    children (their parents_of), the way git's --topo-order does."""
+    # Number of children in the list, plus one for being in it
+    indegree = dict.fromkeys(shas, 1)
+    for sha in shas:
+        for p in parents_of[sha]:
+            if p in indegree:
+                indegree[p] += 1
+
+    # The tips, the first one on top
+    stack = [sha for sha in shas if indegree[sha] == 1]
+    stack.reverse()
+    while stack:
+        sha = stack.pop()
+        for p in parents_of[sha]:
+            if p in indegree:
+                indegree[p] -= 1
+                if indegree[p] == 1:
+                    stack.append(p)
+        yield sha
+
+
+def _walk_key(repo: Repository, graph: PitCommitGraph | None, sha: str,
+              order) -> tuple:
+    # Highest generation first, then newest
+    parents, date, gen = commit_links(repo, graph, sha)
+    return (-gen, -date, next(order), sha, parents)
+
+
+def commit_is_ancestor(repo: Repository, a: str, b: str) -> bool:
+    """Whether a is reachable from b.
+
+    A commit with a generation no larger than a's can't reach it, and
+    one in the commit-graph can't reach one outside of it: the walk
+    stops there, instead of going down to the root commits."""
+    return _is_ancestor(repo, commit_graph_get(repo), a, b)
+
+
+def _is_ancestor(repo: Repository, graph: PitCommitGraph | None, a: str,
+                 b: str) -> bool:
+    if a == b:
+        return True
+    _, _, min_gen = commit_links(repo, graph, a)
+    seen = {b}
+    stack = [b]
+    while stack:
+        parents, _, gen = commit_links(repo, graph, stack.pop())
+        if gen != GENERATION_INFINITY and gen <= min_gen:
+            continue
+        for p in parents:
+            if p == a:
+                return True
+            if p not in seen:
+                seen.add(p)
+                stack.append(p)
+    return False
+
+
+def merge_bases(repo: Repository, a: str, b: str) -> list[str]:
+    """The best common ancestors of a and b, none of them reachable from
+    another, newest first.
+
+    Like git, commits are painted with the sides they are reachable
+    from, highest generation (or newest) first.  Commits reachable from
+    both are candidates, and what's below them is stale: the walk stops
+    when only stale commits are left."""
+    if a == b:
+        return [a]
+    graph = commit_graph_get(repo)
+    order = itertools.count()
+    flags = {a: PARENT1, b: PARENT2}
+    queue = [_walk_key(repo, graph, a, order),
+             _walk_key(repo, graph, b, order)]
+    heapq.heapify(queue)
+    # How many times each commit is in the queue, and how many of those
+    # entries aren't stale: the walk is over when none are left.
+    queued = {a: 1, b: 1}
+    nonstale = 2
+    found = {}
+    while nonstale:
+        _, key, _, sha, parents = heapq.heappop(queue)
+        queued[sha] -= 1
+        paint = flags[sha]
+        if not paint & STALE:
+            nonstale -= 1
+        if paint == PARENT1 | PARENT2:
+            found[sha] = -key
+            paint |= STALE
+        for p in parents:
+            old = flags.get(p, 0)
+            if old & paint == paint:
+                continue
+            flags[p] = old | paint
+            if not old & STALE and paint & STALE:
+                # Its entries in the queue just went stale
+                nonstale -= queued.get(p, 0)
+            queued[p] = queued.get(p, 0) + 1
+            if not flags[p] & STALE:
+                nonstale += 1
+            heapq.heappush(queue, _walk_key(repo, graph, p, order))
+
+    found = sorted(found, key=found.get, reverse=True)
+    # Drop the ones reachable from another
+    return [sha for sha in found
+            if not any(other != sha and _is_ancestor(repo, graph, sha, other)
+                       for other in found)]
+
+
+def signature_parse(signature: bytes) -> tuple[str, datetime]:
+    """The name and email of an author or committer line, and its date
+    in its own time zone."""
+    person, _, date = signature.rpartition(b'> ')
+    timestamp, _, tz = date.partition(b' ')
+    tz = int(tz or b'0')
+    offset = timedelta(hours=abs(tz) // 100, minutes=abs(tz) % 100)
+    when = datetime.fromtimestamp(
+        int(timestamp), timezone(-offset if tz < 0 else offset))
+    return person.decode("utf8", "replace") + ">", when
+
+
+def log_format(repo: Repository, sha: str, commit: PitCommit,
+               oneline=False) -> str:
+    """A commit, the way git log shows it: its "medium" format or, with
+    oneline, the abbreviated SHA and the subject."""
+    message = commit.kvlm[None].decode("utf8", "replace")
+    lines = message.split("\n")
+    # Leading blank lines, and trailing ones, are dropped
+    while lines and not lines[0].strip():
+        lines.pop(0)
+    while lines and not lines[-1].strip():
+        lines.pop()
+    if oneline:
+        subject = []
+        for line in lines:
+            if not line.strip():
+                break
+            subject.append(line.strip())
+        return "{0} {1}".format(object_abbrev(repo, sha), " ".join(subject))
+
+    author, when = signature_parse(commit.header(b'author')[0])
+    ret = ["commit " + sha]
+    if len(commit.parents) > 1:
+        ret.append("Merge: " + " ".join(object_abbrev(repo, p)
+                                        for p in commit.parents))
+    ret.append("Author: " + author)
+    ret.append("Date:   {0} {1} {2}".format(
+        when.strftime("%a %b"), when.day,
+        when.strftime("%H:%M:%S %Y %z")))
+    ret.append("")
+    ret += ["    " + line.expandtabs(8) for line in lines]
+    return "\n".join(ret)
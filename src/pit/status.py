@@ -0,0 +1,386 @@
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from pit.repo import Repository
+from pit.refs import ref_resolve
+from pit.objects import (
+    PitIndex,
+    PitIndexEntry,
+    index_read,
+    index_write,
+    index_entry_from_stat,
+    object_hash_stream,
+    object_find,
+    tree_walk,
+)
+from pit.lockfile import PitLockError
+from pit.untracked import (
+    PitUntrackedCache,
+    PitUntrackedDir,
+    untracked_ident,
+    untracked_cache_parse,
+    untracked_cache_serialize,
+    stat_data,
+)
+from pit.fsmonitor import fsmonitor_get, fsmonitor_invalidate, fsmonitor_dirs
+
+
+class PitStatus:
+    """Differences between HEAD, the index and the worktree.
+
+    staged and unstaged map paths to "A" (added), "M" (modified) or
+    "D" (deleted); untracked is a sorted list of paths, directories
+    with nothing tracked in them being listed once, with a trailing
+    "/"."""
+
+    def __init__(self):
+        self.staged = {}
+        self.unstaged = {}
+        self.untracked = []
+
+
+def stat_matches(entry: PitIndexEntry, st: os.stat_result,
+                 racy_ns: int | None) -> bool:
+    """Whether the cached stat data of entry says the file is unchanged.
+
+    A file modified in the same instant the index was written could
+    still have the same mtime after a change: such racily clean
+    entries, as git calls them, have to be hashed anyway."""
+    fields = entry.fields
+    mtime_ns = st.st_mtime_ns
+    if fields[3] != mtime_ns % 1000000000 or \
+            fields[2] != (mtime_ns // 1000000000) & 0xFFFFFFFF:
+        return False
+    ctime_ns = st.st_ctime_ns
+    if fields[1] != ctime_ns % 1000000000 or \
+            fields[0] != (ctime_ns // 1000000000) & 0xFFFFFFFF:
+        return False
+    if fields[5] != st.st_ino & 0xFFFFFFFF or \
+            fields[9] != st.st_size & 0xFFFFFFFF:
+        return False
+    if stat.S_ISLNK(st.st_mode):
+        if fields[6] >> 12 != 0b1010:
+            return False
+    elif (fields[6] & 0o100) != (st.st_mode & 0o100):
+        return False
+    if racy_ns is not None and \
+            fields[2] * 1000000000 + fields[3] >= racy_ns:
+        return False
+    return True
+
+
+def file_hash(path: str, st: os.stat_result) -> str:
+    """Hash the file at path as a blob, without writing it."""
+    if stat.S_ISLNK(st.st_mode):
+        import io
+        return object_hash_stream(io.BytesIO(os.fsencode(os.readlink(path))))
+    with open(path, "rb") as fd:
+        return object_hash_stream(fd, size=st.st_size)
+
+
+def head_tree(repo: Repository) -> dict:
+    """Map the paths of HEAD's tree to (mode, sha), mode as an int like
+    in the index.  Empty if HEAD doesn't point to a commit yet."""
+    if not ref_resolve(repo, "HEAD"):
+        return {}
+    tree = object_find(repo, "HEAD", fmt=b'tree')
+    return {path: (int(mode, 8), sha)
+            for path, mode, sha in tree_walk(repo, tree)}
+
+
+def status_staged(head: dict, index: PitIndex) -> dict:
+    """Compare HEAD's tree with the index."""
+    ret = {}
+    seen = set()
+    for entry in index.entries:
+        if entry.flag_stage:
+            continue
+        name = entry.name
+        seen.add(name)
+        if entry.flag_intent_to_add:
+            continue
+        if name not in head:
+            ret[name] = "A"
+        elif head[name] != (entry.fields[6], entry.sha):
+            ret[name] = "M"
+    for name in head:
+        if name not in seen:
+            ret[name] = "D"
+    return ret
+
+
+def status_unstaged(repo: Repository, index: PitIndex, workers=None,
+                    valid=()):
+    """Compare the index with the worktree.
+
+    Files whose stat data match the one cached in the index are taken
+    as unchanged without being read; the others are hashed on a thread
+    pool (hashlib releases the GIL).  Entries in valid, which a
+    filesystem monitor vouches for, aren't even looked at.  Returns the
+    changes, and the entries found unchanged but with stale stat data,
+    refreshed."""
+    ret = {}
+    candidates = []
+    racy_ns = index.source[2] if index.source else None
+    worktree = str(repo.worktree) + os.sep
+    lstat = os.lstat
+
+    for entry in index.entries:
+        if entry.flag_stage or entry.flag_skip_worktree or entry in valid:
+            continue
+        name = entry.name
+        path = worktree + name
+        try:
+            st = lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            ret[name] = "D"
+            continue
+        if entry.mode_type == 0b1110:
+            # Submodules: we don't look inside
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            ret[name] = "D"
+        elif entry.flag_intent_to_add:
+            ret[name] = "A"
+        elif not stat_matches(entry, st, racy_ns):
+            candidates.append((entry, path, st))
+
+    refreshed = []
+    if candidates:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            shas = pool.map(lambda c: file_hash(c[1], c[2]), candidates)
+            for (entry, path, st), sha in zip(candidates, shas):
+                new = index_entry_from_stat(entry.name, st, sha)
+                if new.fields[6] != entry.fields[6] or sha != entry.sha:
+                    ret[entry.name] = "M"
+                else:
+                    refreshed.append((entry, st))
+    return ret, refreshed
+
+
+def status_untracked(repo: Repository, index: PitIndex,
+                     cache: PitUntrackedCache | None = None,
+                     changed=None) -> list[str]:
+    """Files of the worktree that aren't in the index.
+
+    Directories are read through cache, an untracked cache, updated as
+    we go: those whose stat data didn't change since they were last
+    read (and that are racily clean, see stat_matches) aren't read
+    again.  changed is what a filesystem monitor reported since the
+    cache was written, if anything: the directories it says nothing
+    happened in aren't even lstat'ed."""
+    tracked = set()
+    tracked_dirs = set()
+    # The tracked subdirectories of each tracked directory
+    children = {"": set()}
+    for entry in index.entries:
+        name = entry.name
+        tracked.add(name)
+        d = name.rpartition("/")[0]
+        while d and d not in tracked_dirs:
+            tracked_dirs.add(d)
+            parent, _, base = d.rpartition("/")
+            children.setdefault(parent, set()).add(base)
+            d = parent
+
+    if cache is None:
+        cache = PitUntrackedCache()
+    if cache.root is None:
+        cache.root = PitUntrackedDir(b'')
+    racy_ns = index.source[2] if index.source else None
+    parents, subtrees = fsmonitor_dirs(changed or ())
+    worktree = str(repo.worktree) + os.sep
+    ret = []
+
+    def fresh(d: PitUntrackedDir, prefix: str):
+        """Whether d's listing is still good, and its lstat if we had
+        to look."""
+        if not d.valid:
+            return False, None
+        if changed is not None and prefix not in parents \
+                and not prefix.startswith(subtrees):
+            return True, None
+        try:
+            st = os.lstat(worktree + prefix)
+        except OSError:
+            return False, None
+        if racy_ns is not None and st.st_mtime_ns >= racy_ns:
+            return False, st
+        return d.stat == stat_data(st), st
+
+    def scan(d: PitUntrackedDir, prefix: str, st, check_only: bool):
+        """Read the directory at prefix into d.  Returns False if it's
+        gone."""
+        try:
+            if st is None:
+                st = os.lstat(worktree + prefix)
+            it = os.scandir(worktree + prefix)
+        except OSError:
+            d.invalidate()
+            d.dirs = {}
+            return False
+        untracked = []
+        dirs = {}
+        with it:
+            for e in it:
+                name = os.fsencode(e.name)
+                path = prefix + e.name
+                if e.is_dir(follow_symlinks=False):
+                    if not prefix and e.name == ".git":
+                        continue
+                    if path in tracked_dirs and not check_only:
+                        sub = d.dirs.get(name)
+                        if sub is None or sub.check_only:
+                            sub = PitUntrackedDir(name)
+                    elif path in tracked:
+                        # A submodule, or a file turned into a directory
+                        continue
+                    else:
+                        sub = d.dirs.get(name)
+                        if sub is None or not sub.check_only:
+                            sub = PitUntrackedDir(name)
+                            sub.check_only = True
+                        if not check_only:
+                            untracked.append(name + b'/')
+                    dirs[name] = sub
+                elif path not in tracked:
+                    untracked.append(name)
+                    if check_only:
+                        # A file is all it takes
+                        break
+        d.untracked = sorted(untracked)
+        d.dirs = dict(sorted(dirs.items()))
+        d.valid = True
+        d.check_only = check_only
+        d.stat = stat_data(st)
+        cache.changed = True
+        return True
+
+    def consistent(d: PitUntrackedDir, prefix: str) -> bool:
+        """Whether what d says is tracked still is: files may have been
+        added to the index since."""
+        for name in d.untracked:
+            path = prefix + os.fsdecode(name.rstrip(b'/'))
+            if path in tracked or path in tracked_dirs:
+                return False
+        subdirs = {name for name, sub in d.dirs.items()
+                   if not sub.check_only}
+        expected = children.get(prefix[:-1], ())
+        return len(subdirs) == len(expected) and \
+            all(os.fsdecode(name) in expected for name in subdirs)
+
+    def nonempty(d: PitUntrackedDir, prefix: str) -> bool:
+        """Whether the untracked directory at prefix has files."""
+        ok, st = fresh(d, prefix)
+        if not ok and not scan(d, prefix, st, True):
+            return False
+        if d.untracked:
+            return True
+        return any(nonempty(sub, prefix + os.fsdecode(name) + "/")
+                   for name, sub in d.dirs.items())
+
+    def walk(d: PitUntrackedDir, prefix: str) -> None:
+        ok, st = fresh(d, prefix)
+        if not (ok and consistent(d, prefix)) and \
+                not scan(d, prefix, st, False):
+            return
+        for name in d.untracked:
+            path = prefix + os.fsdecode(name)
+            if not name.endswith(b'/'):
+                ret.append(path)
+            elif nonempty(d.dirs[name[:-1]], path):
+                # Nothing tracked below: shown as a whole, like git,
+                # as long as there's a file in there.
+                ret.append(path)
+        for name, sub in d.dirs.items():
+            if not sub.check_only:
+                walk(sub, prefix + os.fsdecode(name) + "/")
+
+    walk(cache.root, "")
+    return sorted(ret)
+
+
+def untracked_cache_get(repo: Repository, index: PitIndex):
+    """The untracked cache of index, if it is to be used.
+
+    core.untrackedCache turns it on or off; by default a cache already
+    in the index is kept up to date.  Caches made by git, or somewhere
+    else, are started over."""
+    setting = repo.conf.get("core", "untrackedcache",
+                            fallback="keep").strip().lower()
+    data = index.extensions.get(b"UNTR")
+    if setting in ("false", "no", "off", "0"):
+        index.extensions.pop(b"UNTR", None)
+        return None
+    if data is None and setting not in ("true", "yes", "on", "1"):
+        return None
+    ident = untracked_ident(repo)
+    cache = untracked_cache_parse(data) if data is not None else None
+    if cache is None or cache.ident != ident:
+        cache = PitUntrackedCache(ident)
+        cache.changed = True
+    return cache
+
+
+def status(repo: Repository, untracked=True, refresh=True,
+           workers=None, monitor=None) -> PitStatus:
+    """Compute the status of repo.
+
+    If refresh, what was learned is saved in the index for the next
+    status: the stat data of entries found unchanged despite a stat
+    mismatch, so they aren't hashed again, the untracked cache, and
+    the filesystem monitor's token (monitor defaults to the one
+    configured, see pit.fsmonitor).  This is skipped if the index is
+    locked."""
+    index = index_read(repo)
+    if monitor is None:
+        monitor = fsmonitor_get(repo)
+    had_token = index.fsmonitor_token
+    token = changed = None
+    if monitor is not None:
+        token, changed = monitor.query(had_token)
+        if token is None or had_token is None:
+            changed = None
+    if changed is None:
+        index.fsmonitor_valid = set()
+    else:
+        fsmonitor_invalidate(index, changed)
+
+    ret = PitStatus()
+    ret.staged = status_staged(head_tree(repo), index)
+    ret.unstaged, refreshed = status_unstaged(repo, index, workers,
+                                              index.fsmonitor_valid)
+    cache = untracked_cache_get(repo, index)
+    # With a monitor, the untracked cache has to keep up with the
+    # token, listed or not.
+    if untracked or (cache is not None and token is not None):
+        found = status_untracked(repo, index, cache, changed)
+        if untracked:
+            ret.untracked = found
+
+    if not refresh:
+        return ret
+    for entry, st in refreshed:
+        fields = index_entry_from_stat(entry.name, st, entry.sha).fields
+        # Keep the flags
+        entry.fields = fields[:11] + entry.fields[11:]
+        entry.span = None
+    if cache is not None and cache.changed:
+        index.extensions[b"UNTR"] = untracked_cache_serialize(cache)
+    index.fsmonitor_token = token
+    if token is not None:
+        # Everything we looked at and found unchanged; stages, skipped
+        # and intent-to-add entries are looked at every time.
+        index.fsmonitor_valid = set(index.entries).difference(
+            e for e in index.entries
+            if e.fields[11] & 0x3000 or e.xflags & 0x6000)
+        fsmonitor_invalidate(index, ret.unstaged)
+
+    if refreshed or (cache is not None and cache.changed) \
+            or token is not None or had_token is not None:
+        try:
+            index_write(repo, index)
+        except PitLockError:
+            # Someone else holds index.lock: we'll refresh next time
+            pass
+    return ret
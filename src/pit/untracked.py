@@ -0,0 +1,208 @@
+import os
+import platform
+import struct
+from pit.repo import Repository
+from pit.ewah import ewah_read, ewah_write
+
+# The untracked cache (the UNTR index extension) remembers, for each
+# directory scanned by status, its stat data and the untracked files
+# and directories found in it.  As long as a directory's stat data
+# doesn't change, no file was added to or removed from it, so it
+# doesn't have to be read again.
+#
+# git only trusts caches made at the same location, on the same
+# system, which the "ident" records.  pit doesn't apply .gitignore
+# files, so its caches must not be mistaken for git's: pit writes its
+# own ident, and starts over when it finds a cache made by git (and
+# git does the same with ours, if told to use an untracked cache).
+
+# Directory flags, from git's dir.h: untracked directories are shown
+# as a whole, and only when there's a file in them.
+DIR_SHOW_OTHER_DIRECTORIES = 1 << 1
+DIR_HIDE_EMPTY_DIRECTORIES = 1 << 2
+
+# ctime, mtime (seconds, nanoseconds), dev, ino, uid, gid and size
+STAT_DATA = struct.Struct(">9L")
+NULL_STAT = bytes(STAT_DATA.size)
+NULL_SHA = bytes(20)
+
+
+class PitUntrackedDir:
+    """A directory of the untracked cache.
+
+    untracked lists the names of the untracked files, and untracked
+    directories with something in them (ending with "/").  dirs holds
+    the subdirectories that were scanned as well, by name: those with
+    tracked files, and, with check_only set, empty untracked ones.
+    The cache is only good if valid is set and stat, the directory's
+    stat data, still matches."""
+
+    __slots__ = ("name", "untracked", "dirs", "valid", "check_only",
+                 "stat", "exclude_sha")
+
+    def __init__(self, name: bytes):
+        self.name = name
+        self.untracked = []
+        self.dirs = {}
+        self.valid = False
+        self.check_only = False
+        self.stat = NULL_STAT
+        # Hash of the directory's .gitignore, for git
+        self.exclude_sha = NULL_SHA
+
+    def invalidate(self) -> None:
+        self.valid = False
+        self.untracked = []
+
+
+class PitUntrackedCache:
+    def __init__(self, ident: bytes = b''):
+        self.ident = ident
+        # Stat data and hash of .git/info/exclude and core.excludesFile
+        self.info_exclude_stat = NULL_STAT
+        self.excludes_file_stat = NULL_STAT
+        self.dir_flags = DIR_SHOW_OTHER_DIRECTORIES | \
+            DIR_HIDE_EMPTY_DIRECTORIES
+        self.info_exclude_sha = NULL_SHA
+        self.excludes_file_sha = NULL_SHA
+        self.exclude_per_dir = b''
+        self.root = None
+        # Whether anything changed since the cache was read
+        self.changed = False
+
+
+def untracked_ident(repo: Repository) -> bytes:
+    return "Location {0}, system pit/{1}\0".format(
+        os.path.realpath(repo.worktree), platform.system()).encode("utf8")
+
+
+def stat_data(st: os.stat_result) -> bytes:
+    m = 0xFFFFFFFF
+    return STAT_DATA.pack(
+        (st.st_ctime_ns // 1000000000) & m, st.st_ctime_ns % 1000000000,
+        (st.st_mtime_ns // 1000000000) & m, st.st_mtime_ns % 1000000000,
+        st.st_dev & m, st.st_ino & m, st.st_uid & m, st.st_gid & m,
+        st.st_size & m)
+
+
+def _varint_read(data: bytes, pos: int) -> tuple[int, int]:
+    # Same varint as in version 4 indexes
+    c = data[pos]
+    pos += 1
+    n = c & 0x7f
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        n = ((n + 1) << 7) | (c & 0x7f)
+    return n, pos
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray([n & 0x7f])
+    n >>= 7
+    while n:
+        n -= 1
+        out.insert(0, 0x80 | (n & 0x7f))
+        n >>= 7
+    return bytes(out)
+
+
+def untracked_cache_parse(data: bytes) -> PitUntrackedCache:
+    """Parse the data of an UNTR extension."""
+    length, pos = _varint_read(data, 0)
+    ret = PitUntrackedCache(data[pos:pos+length])
+    pos += length
+    ret.info_exclude_stat = data[pos:pos+36]
+    ret.excludes_file_stat = data[pos+36:pos+72]
+    ret.dir_flags = int.from_bytes(data[pos+72:pos+76], "big")
+    ret.info_exclude_sha = data[pos+76:pos+96]
+    ret.excludes_file_sha = data[pos+96:pos+116]
+    pos += 116
+    end = data.index(b'\x00', pos)
+    ret.exclude_per_dir = data[pos:end]
+    count, pos = _varint_read(data, end + 1)
+    if not count:
+        return ret
+
+    # The directories, depth first.  Their flags, stat data and hashes
+    # come after all of them.
+    order = []
+    stack = []
+    while len(order) < count:
+        untracked, pos = _varint_read(data, pos)
+        subdirs, pos = _varint_read(data, pos)
+        end = data.index(b'\x00', pos)
+        d = PitUntrackedDir(data[pos:end])
+        pos = end + 1
+        for _ in range(untracked):
+            end = data.index(b'\x00', pos)
+            d.untracked.append(data[pos:end])
+            pos = end + 1
+        if stack:
+            parent = stack[-1]
+            parent[0].dirs[d.name] = d
+            parent[1] -= 1
+        order.append(d)
+        stack.append([d, subdirs])
+        while stack and not stack[-1][1]:
+            stack.pop()
+    ret.root = order[0]
+
+    valid, pos = ewah_read(data, pos)
+    check_only, pos = ewah_read(data, pos)
+    sha_valid, pos = ewah_read(data, pos)
+    for i in valid:
+        order[i].valid = True
+        order[i].stat = data[pos:pos+36]
+        pos += 36
+    for i in check_only:
+        order[i].check_only = True
+    for i in sha_valid:
+        order[i].exclude_sha = data[pos:pos+20]
+        pos += 20
+    return ret
+
+
+def untracked_cache_serialize(cache: PitUntrackedCache) -> bytes:
+    parts = [_varint(len(cache.ident)), cache.ident,
+             cache.info_exclude_stat, cache.excludes_file_stat,
+             cache.dir_flags.to_bytes(4, "big"),
+             cache.info_exclude_sha, cache.excludes_file_sha,
+             cache.exclude_per_dir, b'\x00']
+    if cache.root is None:
+        parts.append(_varint(0))
+        return b''.join(parts)
+
+    dirs = []
+    valid = []
+    check_only = []
+    sha_valid = []
+    stats = []
+    shas = []
+    count = 0
+    stack = [cache.root]
+    while stack:
+        d = stack.pop()
+        if d.valid:
+            valid.append(count)
+            stats.append(d.stat)
+            if d.check_only:
+                check_only.append(count)
+        if d.exclude_sha != NULL_SHA:
+            sha_valid.append(count)
+            shas.append(d.exclude_sha)
+        count += 1
+        untracked = d.untracked if d.valid else []
+        dirs += [_varint(len(untracked)), _varint(len(d.dirs)),
+                 d.name, b'\x00']
+        dirs += [name + b'\x00' for name in untracked]
+        stack.extend(reversed(d.dirs.values()))
+
+    parts.append(_varint(count))
+    parts += dirs
+    for bits in (valid, check_only, sha_valid):
+        parts.append(ewah_write(bits))
+    parts += stats
+    parts += shas
+    parts.append(b'\x00')
+    return b''.join(parts)
@@ -0,0 +1,19 @@
+import os
+import subprocess
+
+GIT_ENV = dict(os.environ,
+               GIT_AUTHOR_NAME="Pitter", GIT_AUTHOR_EMAIL="pit@example.com",
+               GIT_COMMITTER_NAME="Pitter",
+               GIT_COMMITTER_EMAIL="pit@example.com")
+
+
+def git(path, *args, input=None, check=True, date=None, env=None) -> bytes:
+    """Run git in path, and return what it printed.  With date (a
+    timestamp), commits are authored and committed then, in UTC.  env
+    has more variables to set."""
+    env = dict(GIT_ENV, **(env or {}))
+    if date is not None:
+        env.update(GIT_AUTHOR_DATE="{0} +0000".format(date),
+                   GIT_COMMITTER_DATE="{0} +0000".format(date))
+    return subprocess.run(["git", *args], cwd=path, env=env, input=input,
+                          check=check, capture_output=True).stdout
@@ -0,0 +1,75 @@
+import os
+from pathlib import Path
+
+import pit.objects
+from pit.repo import Repository
+from pit.objects import (
+    PitBlob,
+    abbrev_default,
+    object_abbrev,
+    object_prefix_lookup,
+    object_resolve,
+    object_write,
+)
+from conftest import git
+
+
+def setup_repo(path: Path) -> tuple[Repository, list[str]]:
+    """1000 blobs, half of them packed, half loose."""
+    git(path, "init", "-q")
+    (path / "f").mkdir()
+    for i in range(1000):
+        (path / "f" / str(i)).write_text(str(i))
+    names = ["f/{0}\n".format(i) for i in range(1000)]
+    shas = git(path, "hash-object", "-w", "--stdin-paths",
+               input="".join(names[:500]).encode()).decode().split()
+    git(path, "pack-objects", "-q", ".git/objects/pack/pack",
+        input="".join(sha + "\n" for sha in shas).encode())
+    git(path, "prune-packed")
+    shas += git(path, "hash-object", "-w", "--stdin-paths",
+                input="".join(names[500:]).encode()).decode().split()
+    return Repository(path), shas
+
+
+def test_prefix_lookup(tmp_path):
+    repo, shas = setup_repo(tmp_path)
+    for sha in shas[::50]:
+        assert object_prefix_lookup(repo, sha[:8]) == [sha]
+        assert object_resolve(repo, sha.upper()) == [sha]
+    # 1000 objects share their 4 first digits now and then
+    for prefix in {sha[:4] for sha in shas}:
+        assert sorted(object_prefix_lookup(repo, prefix)) == \
+            sorted(sha for sha in shas if sha.startswith(prefix))
+
+
+def test_abbrev_matches_git(tmp_path):
+    repo, shas = setup_repo(tmp_path)
+    # Those sharing 4 digits with another, and some more
+    prefixes = [sha[:4] for sha in shas]
+    sample = [sha for sha in shas if prefixes.count(sha[:4]) > 1] + \
+        shas[::25]
+    for sha in sample:
+        for length in (4, 7):
+            assert object_abbrev(repo, sha, length) == git(
+                tmp_path, "rev-parse", "--short={0}".format(length),
+                sha).decode().strip()
+    assert abbrev_default(repo) == 7
+    assert object_abbrev(repo, shas[0]) == \
+        git(tmp_path, "rev-parse", "--short", shas[0]).decode().strip()
+
+
+def test_loose_listing_cached(tmp_path, monkeypatch):
+    repo, shas = setup_repo(tmp_path)
+    listed = []
+    listdir = os.listdir
+    monkeypatch.setattr(pit.objects.os, "listdir",
+                        lambda path: listed.append(path) or listdir(path))
+    for sha in shas[500:]:
+        object_resolve(repo, sha[:6])
+    # Fanout directories, each listed once
+    fanout = [p for p in listed if len(os.path.basename(p)) == 2]
+    assert len(fanout) == len({sha[:2] for sha in shas[500:]})
+
+    # New objects are found
+    sha = object_write(PitBlob(b"new"), repo)
+    assert object_prefix_lookup(repo, sha[:6]) == [sha]
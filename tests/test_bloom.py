@@ -0,0 +1,144 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import pit.revision
+from pit.repo import Repository
+from pit.bloom import murmur3_seeded, bloom_path_keys, bloom_contains
+from pit.commitgraph import PitCommitGraph, commit_graph_get, \
+    commit_graph_write
+from pit.revision import rev_walk
+from conftest import git
+
+MAIN = Path(__file__).parent.parent / "src" / "main.py"
+
+
+def commit(path: Path, date: int, *names) -> None:
+    for name in names:
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_text("{0} {1}".format(name, date))
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "--allow-empty", "-m", str(date), date=date)
+
+
+def setup_repo(path: Path) -> Repository:
+    """Files in directories, a non-ASCII name, a commit changing more
+    paths than filters hold, an empty commit and merges, one of them
+    keeping a side's change and dropping the other's."""
+    git(path, "init", "-q", "-b", "main")
+    commit(path, 1700000000, "a/x", "a/b/y", "c", "é/ü")
+    commit(path, 1700000100, "a/b/y")
+    commit(path, 1700000200, *["many/{0}".format(i) for i in range(600)])
+    commit(path, 1700000300)
+    git(path, "checkout", "-q", "-b", "topic")
+    commit(path, 1700000400, "a/x", "é/ü")
+    commit(path, 1700000500, "c")
+    git(path, "checkout", "-q", "main")
+    commit(path, 1700000600, "a/b/z")
+    git(path, "merge", "-q", "--no-ff", "-m", "merge", "topic",
+        date=1700000700)
+    git(path, "checkout", "-q", "-b", "dropped", "main~1")
+    commit(path, 1700000800, "c")
+    git(path, "checkout", "-q", "main")
+    git(path, "merge", "-q", "-s", "ours", "-m", "ours", "dropped",
+        date=1700000900)
+    commit(path, 1700001000, "a/x")
+    return Repository(path)
+
+
+def test_murmur3():
+    assert murmur3_seeded(0, b'') == 0
+    assert murmur3_seeded(0, b'Hello world!') == 0x627b0c2c
+    assert murmur3_seeded(
+        0, b'The quick brown fox jumps over the lazy dog') == 0x2e4ff723
+    # Bytes above 0x7f: git's version 1 sign-extends them
+    assert murmur3_seeded(0, b'\x99\xaa\xbb\xcc', version=1) != \
+        murmur3_seeded(0, b'\x99\xaa\xbb\xcc', version=2)
+
+
+def test_filters_match_git(tmp_path):
+    repo = setup_repo(tmp_path)
+    git(tmp_path, "commit-graph", "write", "--reachable", "--changed-paths")
+    path = tmp_path / ".git/objects/info/commit-graph"
+    theirs = PitCommitGraph(path)
+    expected = {theirs.oid(i).hex(): theirs.bloom_filter(theirs.oid(i).hex())
+                for i in range(theirs.count)}
+    theirs.close()
+
+    os.remove(path)
+    commit_graph_write(repo, [git(tmp_path, "rev-parse", "main").decode()
+                              .strip()], changed_paths=True)
+    ours = commit_graph_get(repo)
+    assert ours.bloom_settings == (1, 7, 10)
+    assert {sha: ours.bloom_filter(sha) for sha in expected} == expected
+    assert git(tmp_path, "commit-graph", "verify") == b''
+
+    tip = git(tmp_path, "rev-parse", "main").decode().strip()
+    data = ours.bloom_filter(tip)
+    assert all(bloom_contains(data, k) for k in bloom_path_keys("a/x"))
+    assert not all(bloom_contains(data, k) for k in bloom_path_keys("c"))
+
+
+@pytest.mark.parametrize("graph", [None, False, True])
+def test_path_limited_walk(tmp_path, graph):
+    repo = setup_repo(tmp_path)
+    if graph is not None:
+        commit_graph_write(repo, [git(tmp_path, "rev-parse", "main")
+                                  .decode().strip()], changed_paths=graph)
+    rev = {name: git(tmp_path, "rev-parse", name).decode().strip()
+           for name in ("main", "main~3", "topic")}
+    for paths in (["a"], ["a/b"], ["a/b/y"], ["a/"], ["c"], ["é/ü"],
+                  ["many/7"], ["c", "a/b/z"], ["nowhere"]):
+        for args in (["main"], ["main", "--topo-order"],
+                     ["main", "--first-parent"], ["main", "^main~3"],
+                     ["topic", "^main~3"]):
+            expected = git(tmp_path, "rev-list", *args, "--",
+                           *paths).decode().split()
+            include = [rev[a] for a in args if a[0] not in "^-"]
+            exclude = [rev[a[1:]] for a in args if a[0] == "^"]
+            assert list(rev_walk(
+                repo, include, exclude, paths=paths,
+                topo_order="--topo-order" in args,
+                first_parent="--first-parent" in args)) == expected, \
+                (args, paths)
+
+
+def test_filters_skip_trees(tmp_path, monkeypatch):
+    repo = setup_repo(tmp_path)
+    main = git(tmp_path, "rev-parse", "main").decode().strip()
+    looked_up = []
+    tree_entry = pit.revision.tree_entry
+    monkeypatch.setattr(pit.revision, "tree_entry",
+                        lambda repo, tree, path: looked_up.append(tree) or
+                        tree_entry(repo, tree, path))
+
+    commit_graph_write(repo, [main], changed_paths=False)
+    list(rev_walk(repo, [main], paths=["é/ü"]))
+    without = len(looked_up)
+
+    del looked_up[:]
+    commit_graph_write(repo, [main], changed_paths=True)
+    assert list(rev_walk(repo, [main], paths=["é/ü"])) == \
+        git(tmp_path, "rev-list", "main", "--", "é/ü").decode().split()
+    # Only the commits changing é/ü, the root commit and the second
+    # parents of the merges are looked at
+    assert len(looked_up) < without / 2
+
+
+def test_paths_after_dashes(tmp_path):
+    setup_repo(tmp_path)
+
+    def pit(*args) -> bytes:
+        return subprocess.run([sys.executable, str(MAIN), *args],
+                              cwd=tmp_path, check=True,
+                              capture_output=True).stdout
+
+    assert pit("rev-list", "main", "--", "a/b") == \
+        git(tmp_path, "rev-list", "main", "--", "a/b")
+    # Other commands leave "--" to argparse
+    (tmp_path / "-dash").write_text("dash")
+    assert pit("hash-object", "--", "-dash", "c") == \
+        git(tmp_path, "hash-object", "--", "-dash", "c")
@@ -0,0 +1,42 @@
+from pit.cache import PitLRUCache
+from pit.repo import repo_create
+from pit.objects import object_read, object_write, PitBlob, PitTree
+
+
+def test_lru_eviction():
+    cache = PitLRUCache(max_bytes=100)
+    cache.put("a", 1, 20)
+    cache.put("b", 2, 20)
+    cache.put("c", 3, 20)
+    assert cache.get("a") == 1  # a is now the most recent
+    cache.put("d", 4, 20)
+    cache.put("e", 5, 20)
+    cache.put("f", 6, 20)
+
+    assert "b" not in cache and "a" in cache
+    assert cache.size == 100
+    # Too big for the cache at all
+    cache.put("g", 7, 60)
+    assert "g" not in cache
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["evictions"] == 1
+    assert cache.get("b") is None and cache.stats()["misses"] == 1
+
+
+def test_object_read_cached(tmp_path):
+    repo = repo_create(tmp_path)
+    blob = object_write(PitBlob(b"hello"), repo)
+    tree = PitTree()
+    tree_sha = object_write(tree, repo)
+
+    assert object_read(repo, blob).data == b"hello"
+    assert object_read(repo, blob).data == b"hello"
+    first = object_read(repo, tree_sha)
+    assert object_read(repo, tree_sha) is first
+
+    stats = repo.cache.stats()
+    assert stats["blobs"]["hits"] == 1
+    assert stats["objects"]["hits"] == 1
+    assert stats["objects"]["misses"] == 2
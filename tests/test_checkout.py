@@ -0,0 +1,137 @@
+import argparse
+import os
+import subprocess
+from pathlib import Path
+
+from pit.repo import Repository
+from pit.objects import object_find
+from pit.checkout import checkout_tree
+from conftest import git
+
+
+def setup_repo(path: Path) -> Repository:
+    path.mkdir(exist_ok=True)
+    git(path, "init", "-q")
+    (path / "dir" / "sub").mkdir(parents=True)
+    (path / "dir" / "sub" / "b.txt").write_text("b")
+    (path / "dir-a.txt").write_text("sorts between dir and dir/")
+    (path / "exec.sh").write_text("#!/bin/sh\n")
+    os.chmod(path / "exec.sh", 0o755)
+    os.symlink("dir/sub/b.txt", path / "link")
+    for i in range(1, 4):
+        (path / "numbers.txt").write_text(
+            "\n".join(str(n) for n in range(i * 1000)))
+        git(path, "add", ".")
+        git(path, "commit", "-q", "-m", "commit {0}".format(i))
+    # Deltas, to be rebuilt before they are written
+    git(path, "repack", "-adq")
+    return Repository(path)
+
+
+def ls_files(path: Path) -> list[tuple[str, str, str]]:
+    out = git(path, "ls-files", "-s").decode()
+    return [(line.split("\t")[1],) + tuple(line.split()[:2])
+            for line in out.split("\n") if line]
+
+
+def test_checkout_tree(tmp_path):
+    repo = setup_repo(tmp_path / "repo")
+    dest = tmp_path / "out"
+    dest.mkdir()
+    parent = git(repo.worktree, "rev-parse", "HEAD~1").decode().strip()
+    tree = object_find(repo, parent, fmt=b"tree")
+    # A tiny budget: files go one at a time
+    entries = checkout_tree(repo, tree, str(dest), max_inflight=100)
+
+    git(repo.worktree, "checkout", "-q", "HEAD~1")
+    files = ls_files(repo.worktree)
+    assert [(e.name, "{0:o}".format(e.fields[6]), e.sha)
+            for e in entries] == files
+    for name, mode, _ in files:
+        ours, theirs = dest / name, repo.worktree / name
+        if mode == "120000":
+            assert os.readlink(ours) == os.readlink(theirs)
+        else:
+            assert ours.read_bytes() == theirs.read_bytes()
+            assert os.access(ours, os.X_OK) == (mode == "100755")
+
+    # The stat data is the files'
+    st = os.lstat(dest / "numbers.txt")
+    entry = [e for e in entries if e.name == "numbers.txt"][0]
+    assert entry.mtime == (st.st_mtime_ns // 10**9, st.st_mtime_ns % 10**9)
+    assert entry.fsize == st.st_size
+
+
+def test_checkout_worktree(tmp_path, monkeypatch):
+    from pit.commands import cmd_checkout
+
+    repo = setup_repo(tmp_path)
+    for name in os.listdir(tmp_path):
+        if name != ".git":
+            subprocess.run(["rm", "-rf", str(tmp_path / name)], check=True)
+    os.remove(repo.gitdir / "index")
+
+    monkeypatch.chdir(tmp_path)
+    cmd_checkout(argparse.Namespace(commit="HEAD", path=".", jobs=2))
+    assert git(tmp_path, "status", "--porcelain") == b""
+    # Nothing is hashed again to find that out
+    assert git(tmp_path, "diff-files", "--name-only") == b""
+
+
+def test_checkout_switch(tmp_path, monkeypatch):
+    from pit.commands import cmd_checkout
+
+    repo = setup_repo(tmp_path)
+    git(tmp_path, "checkout", "-q", "-b", "other")
+    os.remove(tmp_path / "dir-a.txt")
+    (tmp_path / "dir-a.txt").mkdir()
+    (tmp_path / "dir-a.txt" / "inside").write_text("file to directory")
+    (tmp_path / "dir" / "sub" / "b.txt").write_text("changed")
+    (tmp_path / "new" / "deep").mkdir(parents=True)
+    (tmp_path / "new" / "deep" / "c.txt").write_text("c")
+    os.remove(tmp_path / "link")
+    os.chmod(tmp_path / "exec.sh", 0o644)
+    git(tmp_path, "add", "-A")
+    git(tmp_path, "commit", "-q", "-m", "other")
+    git(tmp_path, "checkout", "-q", "master")
+    monkeypatch.chdir(tmp_path)
+
+    def args(commit, force=False):
+        return argparse.Namespace(commit=commit, path=None, jobs=2,
+                                  force=force)
+
+    # Files the switch doesn't change aren't rewritten
+    untouched = os.stat(tmp_path / "numbers.txt").st_ino
+    cmd_checkout(args("other"))
+    assert (repo.gitdir / "HEAD").read_text() == "ref: refs/heads/other\n"
+    assert git(tmp_path, "status", "--porcelain") == b""
+    assert git(tmp_path, "diff-files", "--name-only") == b""
+    assert os.stat(tmp_path / "numbers.txt").st_ino == untouched
+    assert not (tmp_path / "link").exists()
+
+    # And back, detached this time
+    master = git(tmp_path, "rev-parse", "master").decode().strip()
+    cmd_checkout(args(master))
+    assert (repo.gitdir / "HEAD").read_text() == master + "\n"
+    assert git(tmp_path, "status", "--porcelain") == b""
+    assert not (tmp_path / "new").exists()
+    assert os.readlink(tmp_path / "link") == "dir/sub/b.txt"
+
+    # Local changes in the way stop it, before anything is touched
+    (tmp_path / "exec.sh").write_text("changed")
+    (tmp_path / "new").mkdir()
+    (tmp_path / "new" / "deep").write_text("untracked")
+    for message in ("local changes", "untracked"):
+        try:
+            cmd_checkout(args("other"))
+            assert False
+        except Exception as e:
+            assert message in str(e)
+            assert "exec.sh" in str(e) or "new/deep" in str(e)
+        assert (repo.gitdir / "HEAD").read_text() == master + "\n"
+        git(tmp_path, "checkout", "--", "exec.sh")
+
+    # Unless forced
+    (tmp_path / "exec.sh").write_text("changed")
+    cmd_checkout(args("other", force=True))
+    assert git(tmp_path, "status", "--porcelain") == b""
@@ -0,0 +1,94 @@
+from pathlib import Path
+
+from pit.repo import Repository
+from pit.objects import (
+    PitCommit, kvlm_parse, kvlm_serialize, object_read)
+from conftest import git
+
+DATES = dict(GIT_AUTHOR_DATE="1700000000 +0100",
+             GIT_COMMITTER_DATE="1700000100 -0500")
+
+SIGNATURE = b"""gpgsig -----BEGIN PGP SIGNATURE-----
+ 
+ iQEzBAABCAAdFiEE
+ =abcd
+ -----END PGP SIGNATURE-----
+"""
+
+
+def setup_repo(path: Path) -> tuple[Repository, dict]:
+    git(path, "init", "-q")
+    (path / "a").write_text("a")
+    git(path, "add", "a")
+    git(path, "commit", "-q", "-m", "root", env=DATES)
+    commits = {"root": git(path, "rev-parse", "HEAD").decode().strip()}
+    tree = git(path, "rev-parse", "HEAD^{tree}").decode().strip()
+
+    parents = []
+    for i in range(3):
+        parents += ["-p", git(path, "commit-tree", tree, "-m", str(i),
+                              input=b"", env=DATES).decode().strip()]
+    commits["octopus"] = git(path, "commit-tree", tree, *parents, "-m",
+                             "octopus\n\nwith a body\n",
+                             env=DATES).decode().strip()
+
+    # A signed commit, and no message at all
+    raw = git(path, "cat-file", "commit", commits["root"])
+    headers, _, _ = raw.partition(b"\n\n")
+    for name, data in (("signed", headers + b"\n" + SIGNATURE + b"\nsigned\n"),
+                       ("empty", headers + b"\n\n")):
+        commits[name] = git(path, "hash-object", "-t", "commit", "-w",
+                            "--stdin", input=data).decode().strip()
+
+    git(path, "tag", "-a", "-m", "a tag", "v1", commits["root"], env=DATES)
+    commits["tag"] = git(path, "rev-parse", "v1").decode().strip()
+    return Repository(path), commits
+
+
+def test_kvlm_roundtrip(tmp_path):
+    repo, commits = setup_repo(tmp_path)
+    for name, sha in commits.items():
+        fmt = "tag" if name == "tag" else "commit"
+        data = git(tmp_path, "cat-file", fmt, sha)
+        kvlm = kvlm_parse(data)
+        assert kvlm_serialize(kvlm) == data, name
+
+    kvlm = kvlm_parse(git(tmp_path, "cat-file", "commit", commits["signed"]))
+    assert list(kvlm) == [b"tree", b"author", b"committer", b"gpgsig", None]
+    assert kvlm[b"gpgsig"].startswith(b"-----BEGIN PGP SIGNATURE-----\n\n")
+    assert kvlm[None] == b"signed\n"
+    octopus = kvlm_parse(git(tmp_path, "cat-file", "commit",
+                             commits["octopus"]))
+    assert len(octopus[b"parent"]) == 3
+    assert octopus[None] == b"octopus\n\nwith a body\n"
+
+
+def test_kvlm_many_headers():
+    # Far more lines than Python frames
+    parents = [b"%040x" % i for i in range(5000)]
+    data = b"tree " + b"0" * 40 + b"\n" + b"".join(
+        b"parent " + p + b"\n" for p in parents) + b"\nmessage\n"
+    kvlm = kvlm_parse(data)
+    assert kvlm[b"parent"] == parents
+    assert kvlm_serialize(kvlm) == data
+    assert PitCommit(data).parents == [p.decode() for p in parents]
+
+
+def test_commit_lazy(tmp_path):
+    repo, commits = setup_repo(tmp_path)
+    commit = object_read(repo, commits["octopus"])
+    parents = git(tmp_path, "rev-parse", commits["octopus"] + "^@").split()
+    assert commit.parents == [p.decode() for p in parents]
+    assert commit.tree == git(tmp_path, "rev-parse",
+                              "HEAD^{tree}").decode().strip()
+    assert (commit.author_time, commit.committer_time) == \
+        (1700000000, 1700000100)
+    # All of that without parsing the whole commit
+    assert commit._kvlm is None
+    assert commit.serialize() == git(tmp_path, "cat-file", "commit",
+                                     commits["octopus"])
+
+    signed = object_read(repo, commits["signed"])
+    assert signed.parents == []
+    assert signed.kvlm[b"gpgsig"].endswith(b"-----END PGP SIGNATURE-----")
+    assert object_read(repo, commits["empty"]).kvlm[None] == b""
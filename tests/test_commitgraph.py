@@ -0,0 +1,128 @@
+import subprocess
+from pathlib import Path
+
+import pytest
+
+import pit.revision
+from pit.repo import Repository
+from pit.commitgraph import PitCommitGraph, commit_graph_get, \
+    commit_graph_write
+from pit.revision import commit_is_ancestor, merge_bases, rev_walk
+from conftest import git
+
+
+def commit(path: Path, name: str, date: int) -> None:
+    (path / name).write_text(name)
+    git(path, "add", name)
+    git(path, "commit", "-q", "-m", name, date=date)
+
+
+def merge(path: Path, date: int, *branches) -> None:
+    git(path, "merge", "-q", "--no-ff", "-m", "merge " + " ".join(branches),
+        *branches, date=date)
+
+
+def setup_repo(path: Path) -> Repository:
+    """main, with a criss-cross merge between main and topic (two merge
+    bases), and an octopus merge."""
+    git(path, "init", "-q", "-b", "main")
+    commit(path, "c1", 1700000000)
+    git(path, "branch", "topic")
+    git(path, "branch", "side1")
+    git(path, "branch", "side2")
+    commit(path, "c2", 1700000100)
+    git(path, "checkout", "-q", "topic")
+    commit(path, "t1", 1700000200)
+    git(path, "checkout", "-q", "main")
+    git(path, "branch", "x", "main")
+    merge(path, 1700000300, "topic")
+    git(path, "checkout", "-q", "topic")
+    merge(path, 1700000400, "x")
+    commit(path, "t2", 1700000500)
+    for i, side in enumerate(["side1", "side2"]):
+        git(path, "checkout", "-q", side)
+        commit(path, side, 1700000600 + i)
+    git(path, "checkout", "-q", "main")
+    commit(path, "c3", 1700000700)
+    merge(path, 1700000800, "side1", "side2")
+    return Repository(path)
+
+
+def rev(path: Path, name: str) -> str:
+    return git(path, "rev-parse", name).decode().strip()
+
+
+def test_write_verify(tmp_path):
+    repo = setup_repo(tmp_path)
+    count = commit_graph_write(repo, [rev(tmp_path, "main"),
+                                      rev(tmp_path, "topic")])
+    assert count == int(git(tmp_path, "rev-list", "--count", "--all"))
+    # git checks the order, the parents, the generations and the dates
+    assert git(tmp_path, "commit-graph", "verify") == b''
+    git(tmp_path, "-c", "core.commitGraph=true", "rev-list", "--all")
+
+
+def test_read_git_graph(tmp_path):
+    repo = setup_repo(tmp_path)
+    git(tmp_path, "commit-graph", "write", "--reachable")
+    graph = PitCommitGraph(tmp_path / ".git/objects/info/commit-graph")
+    for line in git(tmp_path, "rev-list", "--all", "--parents",
+                    "--format=%ct").decode().splitlines():
+        if line.startswith("commit "):
+            sha, *parents = line.split()[1:]
+            continue
+        found_parents, date, generation = graph.lookup(sha)
+        assert found_parents == parents
+        assert date == int(line)
+        assert generation >= 1
+    assert graph.lookup("0" * 40) is None
+
+
+def test_walks_use_graph(tmp_path, monkeypatch):
+    repo = setup_repo(tmp_path)
+    commit_graph_write(repo, [rev(tmp_path, "main"), rev(tmp_path, "topic")])
+    assert commit_graph_get(repo) is not None
+    monkeypatch.setattr(pit.revision, "_commit_read",
+                        lambda repo, sha: pytest.fail("read " + sha))
+
+    for args in (["main"], ["topic", "^main"], ["main", "--topo-order"]):
+        include = [rev(tmp_path, a) for a in args if a[0] not in "^-"]
+        exclude = [rev(tmp_path, a[1:]) for a in args if a[0] == "^"]
+        expected = git(tmp_path, "rev-list", *args).decode().split()
+        assert list(rev_walk(repo, include, exclude,
+                             topo_order="--topo-order" in args)) == expected
+
+
+def test_graph_reloaded(tmp_path):
+    repo = setup_repo(tmp_path)
+    assert commit_graph_get(repo) is None
+    commit_graph_write(repo, [rev(tmp_path, "topic")])
+    graph = commit_graph_get(repo)
+    assert graph.lookup(rev(tmp_path, "main")) is None
+    assert commit_graph_get(repo) is graph
+
+    commit_graph_write(repo, [rev(tmp_path, "main")])
+    assert commit_graph_get(repo) is not graph
+    assert commit_graph_get(repo).lookup(rev(tmp_path, "main")) is not None
+
+
+@pytest.mark.parametrize("graph", [False, True])
+def test_merge_base(tmp_path, graph):
+    repo = setup_repo(tmp_path)
+    names = ["main", "topic", "side1", "side2", "x", "main~1", "main^2",
+             "topic~1", "topic~2"]
+    if graph:
+        commit_graph_write(repo, [rev(tmp_path, "main"),
+                                  rev(tmp_path, "topic")])
+    shas = {name: rev(tmp_path, name) for name in names}
+    for a in names:
+        for b in names:
+            expected = git(tmp_path, "merge-base", "--all", a, b,
+                           check=False).decode().split()
+            assert merge_bases(repo, shas[a], shas[b]) == expected, (a, b)
+
+            is_ancestor = subprocess.run(
+                ["git", "merge-base", "--is-ancestor", a, b],
+                cwd=tmp_path).returncode == 0
+            assert commit_is_ancestor(repo, shas[a], shas[b]) == \
+                is_ancestor, (a, b)
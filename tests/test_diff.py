@@ -0,0 +1,91 @@
+import os
+import subprocess
+from pathlib import Path
+
+import pit.diff
+from pit.repo import Repository
+from pit.objects import object_find
+from pit.diff import tree_diff
+from conftest import git
+
+
+def commit(path: Path, message: str) -> str:
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", message)
+    return git(path, "rev-parse", "HEAD").decode().strip()
+
+
+def setup_repo(path: Path) -> tuple[Repository, list[str]]:
+    git(path, "init", "-q")
+    for d in range(20):
+        (path / "big" / str(d)).mkdir(parents=True)
+        for f in range(5):
+            (path / "big" / str(d) / "{0}.txt".format(f)).write_text(
+                "{0} {1}".format(d, f))
+    (path / "a").write_text("a")
+    (path / "a-b").write_text("sorts between a and a/")
+    (path / "x.sh").write_text("x")
+    (path / "deep" / "er").mkdir(parents=True)
+    (path / "deep" / "er" / "f").write_text("f")
+    commits = [commit(path, "first")]
+
+    (path / "big" / "7" / "3.txt").write_text("changed")
+    os.chmod(path / "x.sh", 0o755)
+    os.remove(path / "deep" / "er" / "f")
+    (path / "deep" / "er" / "g").write_text("g")
+    (path / "new").mkdir()
+    (path / "new" / "file").write_text("new")
+    commits.append(commit(path, "second"))
+
+    # File to tree, tree to file, file to symlink
+    os.remove(path / "a")
+    (path / "a").mkdir()
+    (path / "a" / "inside").write_text("inside")
+    subprocess.run(["rm", "-rf", str(path / "deep")], check=True)
+    (path / "deep").write_text("now a file")
+    os.remove(path / "a-b")
+    os.symlink("x.sh", path / "a-b")
+    commits.append(commit(path, "third"))
+    return Repository(path), commits
+
+
+def raw(changes) -> list[str]:
+    return [":{0:06o} {1:06o} {2} {3} {4}\t{5}".format(
+        c.old_mode, c.new_mode, c.old_sha or "0" * 40,
+        c.new_sha or "0" * 40, c.status, c.path) for c in changes]
+
+
+def test_tree_diff_matches_git(tmp_path):
+    repo, commits = setup_repo(tmp_path)
+    for a, b in ((0, 1), (1, 2), (0, 2), (2, 0)):
+        for recursive in (True, False):
+            ours = raw(tree_diff(
+                repo, object_find(repo, commits[a], fmt=b"tree"),
+                object_find(repo, commits[b], fmt=b"tree"), recursive))
+            theirs = git(tmp_path, "diff-tree", *(["-r"] if recursive
+                                                   else []),
+                         commits[a], commits[b]).decode().splitlines()
+            assert ours == theirs
+
+
+def test_tree_diff_prunes(tmp_path, monkeypatch):
+    repo, commits = setup_repo(tmp_path)
+    read = []
+    object_read = pit.diff.object_read
+    monkeypatch.setattr(pit.diff, "object_read",
+                        lambda repo, sha: read.append(sha) or
+                        object_read(repo, sha))
+
+    a = object_find(repo, commits[0], fmt=b"tree")
+    b = object_find(repo, commits[1], fmt=b"tree")
+    changes = tree_diff(repo, a, b)
+    assert [c.path for c in changes] == [
+        "big/7/3.txt", "deep/er/f", "deep/er/g", "new/file", "x.sh"]
+    # Both roots, then both sides of big, big/7, deep and deep/er, and
+    # the new tree: none of the 19 other directories of big
+    assert len(read) == 11
+
+    # Nothing is read before it's needed
+    read.clear()
+    first = next(tree_diff(repo, a, b))
+    assert first.path == "big/7/3.txt" and len(read) == 6
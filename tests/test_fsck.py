@@ -0,0 +1,159 @@
+import hashlib
+import io
+import os
+import zlib
+from pathlib import Path
+
+import pytest
+
+from pit.repo import Repository
+from pit.fsck import PitProgress, fsck
+from pit.pack import pack_list
+from conftest import git
+
+
+def setup_repo(path: Path) -> Repository:
+    """Packed history with deltas and an annotated tag, loose commits on
+    top, a dangling blob and a dangling commit out of the reflogs."""
+    git(path, "init", "-q", "-b", "main")
+    for i in range(1, 6):
+        (path / "numbers").write_text("\n".join(map(str, range(i * 500))))
+        (path / "d").mkdir(exist_ok=True)
+        (path / "d" / str(i)).write_text(str(i))
+        git(path, "add", "-A")
+        git(path, "commit", "-q", "-m", "commit {0}".format(i))
+    git(path, "tag", "-a", "-m", "a tag", "v1")
+    git(path, "gc", "-q")
+    (path / "loose").write_text("loose")
+    git(path, "add", "loose")
+    git(path, "commit", "-q", "-m", "loose")
+    git(path, "hash-object", "-w", "--stdin", input=b"dangling")
+    git(path, "checkout", "-q", "-b", "side", "main~1")
+    git(path, "commit", "-q", "--allow-empty", "-m", "side")
+    git(path, "checkout", "-q", "main")
+    git(path, "branch", "-q", "-D", "side")
+    git(path, "reflog", "expire", "--expire=now", "--all")
+    return Repository(path)
+
+
+def git_fsck(path: Path) -> set[str]:
+    """The missing and dangling lines of git fsck."""
+    out = git(path, "fsck", check=False).decode()
+    return {line for line in out.splitlines()
+            if line.startswith(("missing", "dangling"))}
+
+
+def lines(report) -> set[str]:
+    return {"{0} {1} {2}".format(kind, fmt.decode(), sha)
+            for kind, found in (("missing", report.missing),
+                                ("dangling", report.dangling))
+            for sha, fmt in found.items()}
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_fsck_like_git(tmp_path, workers):
+    repo = setup_repo(tmp_path)
+    report = fsck(repo, workers=workers)
+    assert report.errors == []
+    assert report.count == len(git(tmp_path, "cat-file",
+                                   "--batch-all-objects",
+                                   "--batch-check").splitlines())
+    assert len(report.dangling) == 2
+    assert lines(report) == git_fsck(tmp_path)
+
+    # A tag object nothing points to anymore
+    git(tmp_path, "tag", "-d", "v1")
+    report = fsck(repo, workers=workers)
+    assert len(report.dangling) == 3
+    assert lines(report) == git_fsck(tmp_path)
+
+
+def test_fsck_loose_corruption(tmp_path):
+    repo = setup_repo(tmp_path)
+    tree = git(tmp_path, "rev-parse", "main^{tree}").decode().strip()
+    other = git(tmp_path, "rev-parse", "main~1^{tree}").decode().strip()
+    # Another tree's content under the name of the tree
+    path = repo.gitdir / "objects" / tree[:2] / tree[2:]
+    original = path.read_bytes()
+    data = git(tmp_path, "cat-file", "tree", other)
+    os.chmod(path, 0o644)
+    path.write_bytes(zlib.compress(b"tree %d\x00%s" % (len(data), data)))
+
+    report = fsck(repo, workers=1)
+    assert report.errors == ["{0}: hash mismatch, content hashes to {1}"
+                             .format(tree, other)]
+    assert report.missing == {tree: b'tree'}
+    assert "missing tree {0}".format(tree) in git_fsck(tmp_path)
+
+    path.write_bytes(original)
+    blob = git(tmp_path, "rev-parse", "main:loose").decode().strip()
+    os.remove(repo.gitdir / "objects" / blob[:2] / blob[2:])
+    report = fsck(repo, workers=1)
+    assert report.errors == ["index: invalid sha1 pointer {0}".format(blob)]
+    assert report.missing == {blob: b'blob'}
+    assert "missing blob {0}".format(blob) in git_fsck(tmp_path)
+
+
+def test_fsck_pack_corruption(tmp_path):
+    repo = setup_repo(tmp_path)
+    pack = pack_list(repo)[0]
+    index = pack.index
+    offsets = sorted(index.offset_at(i) for i in range(len(index)))
+    path = pack.path
+    data = bytearray(path.read_bytes())
+    # The last byte of an entry in the middle
+    data[offsets[len(offsets) // 2 + 1] - 1] ^= 0xff
+    os.chmod(path, 0o644)
+    path.write_bytes(data)
+
+    errors = fsck(Repository(tmp_path), workers=2).errors
+    assert len(errors) == 2
+    assert errors[0].endswith("CRC mismatch in {0} at offset {1}".format(
+        path.name, offsets[len(offsets) // 2]))
+    assert errors[1] == "{0}: pack checksum mismatch".format(path.name)
+
+
+def test_fsck_bad_objects(tmp_path):
+    repo = setup_repo(tmp_path)
+    blob = bytes.fromhex(git(tmp_path, "rev-parse", "main:loose")
+                         .decode().strip())
+
+    def write(fmt: bytes, data: bytes) -> str:
+        raw = b"%s %d\x00%s" % (fmt, len(data), data)
+        sha = hashlib.sha1(raw).hexdigest()
+        path = repo.gitdir / "objects" / sha[:2] / sha[2:]
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(zlib.compress(raw))
+        return sha
+
+    unsorted = write(b'tree',
+                     b"100644 b\x00" + blob + b"100644 a\x00" + blob)
+    twice = write(b'tree', b"100644 a\x00" + blob + b"40000 a\x00" + blob)
+    mode = write(b'tree', b"100600 a\x00" + blob)
+    no_tree = write(b'commit', b"author A <a> 0 +0000\n"
+                    b"committer A <a> 0 +0000\n\nno tree\n")
+    bad_parent = write(b'commit', b"tree " + blob.hex().encode() +
+                       b"\nparent 1234\nauthor A <a> 0 +0000\n"
+                       b"committer A <a> 0 +0000\n\nbad parent\n")
+    assert sorted(fsck(repo, workers=1).errors) == sorted([
+        "tree {0}: treeNotSorted: not properly sorted".format(unsorted),
+        "tree {0}: duplicateEntries: contains duplicate file entries"
+        .format(twice),
+        "tree {0}: badFilemode: contains bad file modes".format(mode),
+        "commit {0}: missingTree: invalid format - expected 'tree' line"
+        .format(no_tree),
+        "commit {0}: badParentSha1: invalid 'parent' line format"
+        .format(bad_parent),
+    ])
+
+
+def test_progress():
+    out = io.StringIO()
+    progress = PitProgress("Checking objects", 3, out=out, interval=0)
+    progress.update(1, 2**20)
+    progress.update(2, 2**20)
+    progress.done()
+    shown = out.getvalue().split("\r")
+    assert shown[1].startswith("Checking objects:  33% (1/3), 1.00 MiB | ")
+    assert shown[-1].startswith("Checking objects: 100% (3/3), 2.00 MiB | ")
+    assert shown[-1].endswith(" MiB/s, done.\n")
@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+from pit.repo import Repository
+from pit.objects import index_read, index_write, _index_fsmonitor_extension
+from pit.status import status
+from pit.untracked import untracked_cache_parse, untracked_cache_serialize
+from pit.ewah import ewah_read, ewah_write
+from conftest import git
+
+
+def setup_repo(path: Path) -> Repository:
+    git(path, "init", "-q")
+    for name in ("a.txt", "folder/b.txt", "folder/sub/c.txt", "other/d.txt"):
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_text("This is " + name)
+    git(path, "add", ".")
+    git(path, "commit", "-q", "-m", "initial")
+    (path / "folder" / "untracked.txt").write_text("untracked")
+    (path / "newdir" / "empty").mkdir(parents=True)
+    return Repository(path)
+
+
+def git_untracked(path: Path) -> list[str]:
+    # Without touching the index, nor pit's untracked cache in it
+    out = git(path, "--no-optional-locks", "status", "--porcelain").decode()
+    return [line[3:] for line in out.split("\n") if line.startswith("??")]
+
+
+def test_ewah_roundtrip():
+    for bits in ([], [0], [3, 64, 65, 1000], list(range(200)) + [5000]):
+        data = ewah_write(bits)
+        assert ewah_read(data + b"tail") == (bits, len(data))
+
+
+def test_extensions_match_git(tmp_path):
+    setup_repo(tmp_path)
+    hook = tmp_path / ".git" / "fsmonitor-hook"
+    hook.write_text("#!/bin/sh\nprintf 'token\\0'\n")
+    os.chmod(hook, 0o755)
+    for _ in range(2):
+        git(tmp_path, "-c", "core.untrackedCache=true",
+            "-c", "core.fsmonitor=" + str(hook), "status")
+
+    index = index_read(Repository(tmp_path))
+    untr = index.extensions[b"UNTR"]
+    cache = untracked_cache_parse(untr)
+    assert cache.ident.startswith(b"Location ")
+    assert cache.root.dirs[b"folder"].untracked == [b"untracked.txt"]
+    assert untracked_cache_serialize(cache) == untr
+
+    raw = (tmp_path / ".git" / "index").read_bytes()
+    fsmn = raw.index(b"FSMN")
+    size = int.from_bytes(raw[fsmn + 4:fsmn + 8], "big")
+    assert index.fsmonitor_token == "token"
+    assert _index_fsmonitor_extension(index) == raw[fsmn + 8:fsmn + 8 + size]
+
+    # Both survive a write, and git still reads the index
+    index_write(Repository(tmp_path), index)
+    assert index_read(Repository(tmp_path)).extensions[b"UNTR"] == untr
+    git(tmp_path, "status")
+
+
+def test_untracked_cache(tmp_path, monkeypatch):
+    import pit.status
+
+    setup_repo(tmp_path)
+    git(tmp_path, "config", "core.untrackedCache", "true")
+    repo = Repository(tmp_path)
+
+    assert status(repo).untracked == git_untracked(tmp_path)
+    cache = untracked_cache_parse(index_read(repo).extensions[b"UNTR"])
+    assert b"system pit" in cache.ident
+    assert cache.root.valid
+
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(pit.status.os, "scandir",
+                        lambda path: scanned.append(path) or scandir(path))
+
+    # Nothing changed: no directory is read again
+    time.sleep(0.01)
+    os.utime(repo.gitdir / "index")
+    assert status(repo).untracked == git_untracked(tmp_path)
+    assert scanned == []
+
+    # Only the directories that changed are
+    (tmp_path / "other" / "new.txt").write_text("new")
+    (tmp_path / "newdir" / "empty" / "file").write_text("file")
+    os.remove(tmp_path / "folder" / "untracked.txt")
+    time.sleep(0.01)
+    assert status(repo).untracked == git_untracked(tmp_path)
+    assert sorted(scanned) == sorted(
+        str(tmp_path) + os.sep + d
+        for d in ("folder/", "other/", "newdir/empty/"))
+
+    # Files added to the index since are noticed
+    git(tmp_path, "add", "other/new.txt")
+    assert status(repo).untracked == git_untracked(tmp_path)
+
+
+class FakeMonitor:
+    def __init__(self):
+        self.token = 0
+        self.changed = []
+
+    def query(self, token):
+        paths = self.changed if token == str(self.token) else None
+        self.token += 1
+        self.changed = []
+        return str(self.token), paths
+
+
+def test_fsmonitor(tmp_path, monkeypatch):
+    import pit.status
+
+    setup_repo(tmp_path)
+    git(tmp_path, "config", "core.untrackedCache", "true")
+    repo = Repository(tmp_path)
+    monitor = FakeMonitor()
+    st = status(repo, monitor=monitor)
+    assert st.untracked == ["folder/untracked.txt"]
+    assert index_read(repo).fsmonitor_token == "1"
+
+    looked = []
+    lstat = os.lstat
+
+    def watch(path):
+        if str(path).startswith(str(tmp_path) + os.sep):
+            looked.append(path)
+        return lstat(path)
+    monkeypatch.setattr(pit.status.os, "lstat", watch)
+
+    # The monitor says nothing changed: nothing is looked at
+    st = status(repo, monitor=monitor)
+    assert (st.unstaged, st.untracked) == \
+        ({}, ["folder/untracked.txt"])
+    assert looked == []
+
+    # Unreported changes go unnoticed...
+    (tmp_path / "a.txt").write_text("changed")
+    (tmp_path / "other" / "e.txt").write_text("new")
+    assert status(repo, monitor=monitor).unstaged == {}
+
+    # ...until they are
+    monitor.changed = ["a.txt", "other/e.txt"]
+    st = status(repo, monitor=monitor)
+    assert st.unstaged == {"a.txt": "M"}
+    assert st.untracked == ["folder/untracked.txt", "other/e.txt"]
+    assert str(tmp_path / "a.txt") in looked
+    assert str(tmp_path / "folder" / "b.txt") not in looked
+
+    # Without a monitor, everything is checked again
+    st = status(repo)
+    assert st.unstaged == {"a.txt": "M"}
+    assert index_read(repo).fsmonitor_token is None
+
+
+def test_fsmonitor_daemon(tmp_path):
+    from pit.fsmonitor import (
+        PitFSMonitorDaemon, PitDaemonMonitor, fsmonitor_daemon_stop)
+
+    repo = setup_repo(tmp_path)
+    monitor = PitDaemonMonitor(repo)
+    assert monitor.query(None) == (None, None)
+
+    daemon = PitFSMonitorDaemon(repo)
+    thread = threading.Thread(target=daemon.serve)
+    thread.start()
+    try:
+        for _ in range(100):
+            if (repo.gitdir / "pit-fsmonitor.sock").exists():
+                break
+            time.sleep(0.01)
+        token, paths = monitor.query(None)
+        assert token is not None and paths is None
+        token, paths = monitor.query(token)
+        assert paths == []
+
+        (tmp_path / "a.txt").write_text("changed")
+        (tmp_path / "newdir" / "x" / "y").mkdir(parents=True)
+        (tmp_path / "newdir" / "x" / "y" / "z.txt").write_text("z")
+        (tmp_path / ".git" / "ignored").write_text("ignored")
+        new, paths = monitor.query(token)
+        assert {"a.txt", "newdir/x", "newdir/x/y/z.txt"} <= set(paths)
+        assert not any(p.startswith(".git") for p in paths)
+        assert monitor.query(new)[1] == []
+        assert monitor.query("pit:other:0")[1] is None
+    finally:
+        assert fsmonitor_daemon_stop(repo)
+        thread.join()
+    assert not (repo.gitdir / "pit-fsmonitor.sock").exists()
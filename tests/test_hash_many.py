@@ -0,0 +1,134 @@
+import os
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+import pit.objects
+from pit.repo import repo_create
+from pit.objects import hash_iter, hash_many, object_read
+from conftest import git
+
+MAIN = Path(__file__).parent.parent / "src" / "main.py"
+
+
+def setup_files(path: Path) -> list[str]:
+    """Small files, empty ones, big ones, and the same content under
+    several names."""
+    files = []
+    for i in range(300):
+        name = path / "drop" / "d{0}".format(i % 7) / "f{0}".format(i)
+        name.parent.mkdir(parents=True, exist_ok=True)
+        if i % 3 == 0:
+            name.write_bytes(b"same\n")
+        elif i % 50 == 1:
+            name.write_bytes(b"")
+        elif i % 50 == 2:
+            name.write_bytes(os.urandom(200 * 1024))
+        else:
+            name.write_bytes("file {0}\n".format(i).encode() * i)
+        files.append(str(name.relative_to(path)))
+    return files
+
+
+def test_hash_many_like_git(tmp_path, monkeypatch):
+    repo = repo_create(tmp_path)
+    files = setup_files(tmp_path)
+    expected = git(tmp_path, "hash-object", "--stdin-paths",
+                   input="\n".join(files).encode()).decode().split()
+
+    monkeypatch.chdir(tmp_path)
+    assert hash_many(None, files, write=False) == expected
+    assert not any(len(d) == 2 for d in os.listdir(repo.gitdir / "objects"))
+
+    # Big files are streamed
+    monkeypatch.setattr(pit.objects, "HASH_INLINE_MAX", 100 * 1024)
+    streamed = []
+    stream = pit.objects.object_hash_stream
+    monkeypatch.setattr(pit.objects, "object_hash_stream",
+                        lambda fd, *args, **kw: streamed.append(fd.name) or
+                        stream(fd, *args, **kw))
+    assert hash_many(repo, files, workers=4) == expected
+    assert streamed and sorted(streamed) == sorted(
+        name for name in files
+        if (tmp_path / name).stat().st_size > 100 * 1024)
+    for sha, name in zip(expected, files):
+        assert object_read(repo, sha).data == (tmp_path / name).read_bytes()
+    assert git(tmp_path, "fsck", "--no-dangling") == b''
+    assert not [p for p in (repo.gitdir / "objects").rglob("tmp*")]
+
+
+def test_hash_many_writes_once(tmp_path, monkeypatch):
+    repo = repo_create(tmp_path)
+    files = setup_files(tmp_path)
+    git(tmp_path, "hash-object", "-w", files[1])
+    written = []
+    mkstemp = pit.objects.mkstemp
+    monkeypatch.setattr(pit.objects, "mkstemp",
+                        lambda **kw: written.append(kw) or mkstemp(**kw))
+    made = []
+    makedirs = os.makedirs
+    monkeypatch.setattr(pit.objects.os, "makedirs",
+                        lambda path, **kw: made.append(path) or
+                        makedirs(path, **kw))
+
+    monkeypatch.chdir(tmp_path)
+    shas = hash_many(repo, files, workers=8)
+    # Neither the copies nor the object there already
+    assert len(written) == len(set(shas)) - 1
+    # One directory for each fanout, but the one there already
+    assert sorted(made) == sorted({
+        str(repo.gitdir / "objects" / sha[:2]) for sha in shas
+        if sha[:2] != shas[1][:2]})
+
+    del written[:]
+    assert hash_many(repo, files) == shas
+    assert written == []
+
+
+def test_hash_object_stdin_paths(tmp_path):
+    repo_create(tmp_path)
+    files = setup_files(tmp_path)
+    paths = "".join(name + "\n" for name in files).encode()
+    out = subprocess.run([sys.executable, str(MAIN), "hash-object", "-w",
+                          "--stdin-paths"], cwd=tmp_path, input=paths,
+                         check=True, capture_output=True).stdout
+    assert out == git(tmp_path, "hash-object", "--stdin-paths", input=paths)
+
+    out = subprocess.run([sys.executable, str(MAIN), "hash-object",
+                          *files[:3]], cwd=tmp_path, check=True,
+                         capture_output=True).stdout
+    assert out == git(tmp_path, "hash-object", *files[:3])
+
+
+def test_hash_iter(tmp_path, monkeypatch):
+    repo_create(tmp_path)
+    files = setup_files(tmp_path)
+    expected = git(tmp_path, "hash-object", "--stdin-paths",
+                   input="\n".join(files).encode()).decode().split()
+    monkeypatch.chdir(tmp_path)
+    assert list(hash_iter(None, iter(files), write=False,
+                          workers=4)) == expected
+
+
+def test_hash_object_stdin_paths_pipe(tmp_path):
+    """Each SHA comes out before the next path goes in."""
+    repo_create(tmp_path)
+    files = setup_files(tmp_path)[:10]
+    expected = git(tmp_path, "hash-object", *files).decode().split()
+    pit = subprocess.Popen([sys.executable, str(MAIN), "hash-object",
+                            "--stdin-paths"], cwd=tmp_path,
+                           stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    # Rather than hang if it waits for the end of its input
+    watchdog = threading.Timer(30, pit.kill)
+    watchdog.start()
+    try:
+        for name, sha in zip(files, expected):
+            pit.stdin.write(name.encode() + b"\n")
+            pit.stdin.flush()
+            assert pit.stdout.readline() == sha.encode() + b"\n"
+        pit.stdin.close()
+        assert pit.wait(timeout=30) == 0
+    finally:
+        watchdog.cancel()
+        pit.kill()
@@ -0,0 +1,226 @@
+import os
+from pathlib import Path
+
+from pit.repo import Repository
+from pit.objects import index_read, PitIndexEntry
+from conftest import git
+
+
+def setup_index(path: Path) -> Repository:
+    git(path, "init", "-q")
+    for i in range(20):
+        d = path / "dir{0}".format(i % 3)
+        d.mkdir(exist_ok=True)
+        (d / ("file" * (i + 1))).write_text("This is {0}".format(i))
+    (path / "exec.sh").write_text("#!/bin/sh\n")
+    os.chmod(path / "exec.sh", 0o755)
+    os.symlink("exec.sh", path / "link")
+    git(path, "add", ".")
+    return Repository(path)
+
+
+def test_index_read(tmp_path):
+    repo = setup_index(tmp_path)
+    index = index_read(repo)
+
+    staged = git(tmp_path, "ls-files", "--stage").decode().splitlines()
+    assert len(index.entries) == len(staged)
+    for e, line in zip(index.entries, staged):
+        info, name = line.split("\t")
+        mode, sha, stage = info.split()
+        assert e.name == name
+        assert e.sha == sha
+        assert "{0:o}".format(e.mode_type << 12 | e.mode_perms) == mode
+        st = os.lstat(tmp_path / name)
+        assert e.fsize == st.st_size
+        assert e.ino == st.st_ino
+        assert e.mtime[0] == int(st.st_mtime)
+
+
+def test_index_read_lazy(tmp_path, monkeypatch):
+    import pit.objects
+    from pit.objects import index_write
+
+    repo = setup_index(tmp_path)
+    # Names of 0xFFF bytes and more, with and without extended flags
+    blob = git(tmp_path, "hash-object", "-w", "exec.sh").decode().strip()
+    long = ["/".join(["d" * 200] * 20) + "/" + "x" * n
+            for n in (74, 75, 76, 300)]
+    git(tmp_path, "update-index", "--add", "--index-info",
+        input="".join("100644 {0}\t{1}\n".format(blob, name)
+                      for name in long).encode())
+    git(tmp_path, "update-index", "--skip-worktree", long[1])
+    expected = git(tmp_path, "ls-files", "-v", "--stage", "--debug")
+
+    built = []
+    entries = pit.objects._index_entries
+    monkeypatch.setattr(pit.objects, "_index_entries",
+                        lambda raw, offsets: built.append(len(offsets)) or
+                        entries(raw, offsets))
+    index = index_read(repo)
+    assert built == []
+    assert index.version == 3
+    names = [e.name for e in index.entries]
+    assert [n for n in names if len(n) > 4000] == long
+    assert by_name(index, long[1]).flag_skip_worktree
+    assert built == [len(index.entries) + 1]
+
+    # Unchanged and changed entries with long names are written back
+    index_write(repo, index)
+    assert git(tmp_path, "ls-files", "-v", "--stage", "--debug") == expected
+    index = index_read(repo)
+    by_name(index, long[2]).mtime = (1, 2)
+    index_write(repo, index)
+    assert by_name(index_read(repo), long[2]).mtime == (1, 2)
+
+
+def by_name(index, name: str) -> PitIndexEntry:
+    return [e for e in index.entries if e.name == name][0]
+
+
+def test_index_entry_fields():
+    e = PitIndexEntry(ctime=(1, 2), mtime=(3, 4), mode_type=0b1000,
+                      mode_perms=0o644, sha="ab" * 20, name="a/b")
+    assert e.raw_name == b"a/b"
+    assert e.binsha == bytes.fromhex("ab" * 20)
+    e.mtime = (5, 6)
+    e.mode_perms = 0o755
+    e.flag_assume_valid = True
+    assert e.ctime == (1, 2) and e.mtime == (5, 6)
+    assert e.mode_type == 0b1000 and e.mode_perms == 0o755
+    assert e.flag_assume_valid and e.flag_stage == 0
+
+
+def test_index_write_roundtrip(tmp_path):
+    from pit.objects import index_write
+
+    repo = setup_index(tmp_path)
+    before = git(tmp_path, "ls-files", "--stage", "--debug")
+    raw = (repo.gitdir / "index").read_bytes()
+
+    index = index_read(repo)
+    index_write(repo, index)
+    assert not (repo.gitdir / "index.lock").exists()
+    # Nothing changed: the entries are byte for byte the same, and the
+    # trailing checksum is right (git checks it)
+    written = (repo.gitdir / "index").read_bytes()
+    assert written[:-20] == raw[:len(written) - 20]
+    assert git(tmp_path, "ls-files", "--stage", "--debug") == before
+
+    # Change one entry, drop another: the rest is copied as is
+    index = index_read(repo)
+    index.entries[0].mtime = (12345, 678)
+    del index.entries[3]
+    index_write(repo, index)
+    again = index_read(repo)
+    assert len(again.entries) == len(index.entries)
+    assert again.entries[0].mtime == (12345, 678)
+    assert [e.name for e in again.entries] == [e.name for e in index.entries]
+    assert [e.fields for e in again.entries[1:]] == \
+        [e.fields for e in index.entries[1:]]
+    git(tmp_path, "ls-files", "--stage")
+
+
+def test_index_write_twice(tmp_path):
+    from pit.objects import index_write
+
+    repo = setup_index(tmp_path)
+    git(tmp_path, "update-index", "--skip-worktree", "dir1/filefile")
+    index = index_read(repo)
+    index_write(repo, index)
+    # The same index again: untouched entries are copied from where the
+    # first write put them
+    index.entries[1].mtime = (1, 2)
+    index_write(repo, index)
+    expected = [e.name for e in index.entries]
+    staged = git(tmp_path, "ls-files", "--stage").decode().splitlines()
+    assert [line.split("\t")[1] for line in staged] == expected
+    assert index_read(repo).entries[1].mtime == (1, 2)
+    assert [e.fields for e in index_read(repo).entries] == \
+        [e.fields for e in index.entries]
+
+
+def test_index_write_locked(tmp_path):
+    import pytest
+    from pit.objects import index_write
+
+    repo = setup_index(tmp_path)
+    (repo.gitdir / "index.lock").write_bytes(b"")
+    with pytest.raises(Exception, match="index.lock"):
+        index_write(repo, index_read(repo))
+    # Someone else's lock is left alone
+    assert (repo.gitdir / "index.lock").exists()
+
+
+def test_add(tmp_path):
+    from pit.commands import add
+
+    repo = setup_index(tmp_path)
+    git(tmp_path, "commit", "-q", "-m", "initial")
+    expected = git(tmp_path, "ls-files", "--stage")
+    os.remove(repo.gitdir / "index")
+
+    assert add(tmp_path, ["."]) == 0
+    assert git(tmp_path, "ls-files", "--stage") == expected
+    assert git(tmp_path, "status", "--porcelain") == b""
+
+    (tmp_path / "dir0" / "file").write_text("changed")
+    add(tmp_path, ["dir0/file"])
+    assert git(tmp_path, "status", "--porcelain") == b"M  dir0/file\n"
+
+
+def test_add_symlinks(tmp_path):
+    from pit.commands import add
+
+    repo = setup_index(tmp_path)
+    git(tmp_path, "commit", "-q", "-m", "initial")
+    os.symlink("/nowhere/outside", tmp_path / "outside")
+    os.symlink("dir0", tmp_path / "dirlink")
+    os.symlink(tmp_path / "exec.sh", tmp_path / "dir1" / "absolute")
+    names = ["outside", "dirlink", "dir1/absolute"]
+    git(tmp_path, "add", *names)
+    expected = git(tmp_path, "ls-files", "--stage")
+    git(tmp_path, "rm", "-q", "--cached", *names)
+
+    # Named one by one, from a subdirectory too
+    add(tmp_path, ["outside", "dirlink"])
+    add(tmp_path / "dir1", ["absolute"])
+    assert git(tmp_path, "ls-files", "--stage") == expected
+    assert b"120000" in git(tmp_path, "ls-files", "--stage", "dirlink")
+    os.remove(repo.gitdir / "index")
+    add(tmp_path, ["."])
+    assert git(tmp_path, "ls-files", "--stage") == expected
+
+
+def test_index_v3_v4(tmp_path):
+    from pit.objects import index_write
+
+    repo = setup_index(tmp_path)
+    git(tmp_path, "update-index", "--skip-worktree", "dir1/filefile")
+    (tmp_path / "new").write_text("new")
+    git(tmp_path, "add", "-N", "new")
+    expected = git(tmp_path, "ls-files", "-v", "--stage", "--debug")
+
+    for version in ("3", "4", "2"):
+        git(tmp_path, "update-index", "--index-version", version)
+        index = index_read(repo)
+        assert index.version == max(int(version), 3)
+        by_name = {e.name: e for e in index.entries}
+        assert by_name["dir1/filefile"].flag_skip_worktree
+        assert by_name["new"].flag_intent_to_add
+        assert not by_name["exec.sh"].xflags
+
+        # Forces the first entry to be serialized again
+        index.entries[0].mtime = index.entries[0].mtime
+        index_write(repo, index)
+        assert git(tmp_path, "ls-files", "-v", "--stage",
+                   "--debug") == expected
+
+    # Written back as version 4, git reads the same thing
+    index = index_read(repo)
+    index.version = 4
+    index_write(repo, index)
+    assert (repo.gitdir / "index").read_bytes()[4:8] == (4).to_bytes(4, "big")
+    assert git(tmp_path, "ls-files", "-v", "--stage", "--debug") == expected
+    assert [e.fields for e in index_read(repo).entries] == \
+        [e.fields for e in index.entries]
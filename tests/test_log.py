@@ -0,0 +1,109 @@
+import argparse
+from pathlib import Path
+
+import pytest
+
+from pit.repo import Repository
+from pit.revision import rev_parse_revisions, rev_walk
+from conftest import git
+
+
+def dated(date: int) -> dict:
+    # Authors and committers in time zones of their own
+    return dict(GIT_AUTHOR_DATE="{0} +0200".format(date),
+                GIT_COMMITTER_DATE="{0} -0130".format(date))
+
+
+def commit(path: Path, name: str, date: int, message=None) -> None:
+    (path / name).write_text(name)
+    git(path, "add", name)
+    git(path, "commit", "-q", "-m", message or name, env=dated(date))
+
+
+def setup_repo(path: Path) -> Repository:
+    git(path, "init", "-q", "-b", "main")
+    commit(path, "c1", 1700000000, "c1\n\nwith a body\n\n\tand a tab")
+    commit(path, "c2", 1700000100)
+    git(path, "checkout", "-q", "-b", "topic")
+    commit(path, "t1", 1700000200)
+    # Same second: ties come out in the order they were found
+    commit(path, "t2", 1700000200, "t2\nwrapped subject")
+    git(path, "checkout", "-q", "main")
+    commit(path, "c3", 1700000150)
+    git(path, "checkout", "-q", "-b", "side", "HEAD~2")
+    commit(path, "s1", 1700000050)
+    git(path, "checkout", "-q", "main")
+    git(path, "merge", "-q", "--no-ff", "-m", "merge", "topic", "side",
+        env=dated(1700000300))
+    # A clock going backwards
+    commit(path, "c4", 1700000250)
+    commit(path, "c5", 1700000400)
+    return Repository(path)
+
+
+CASES = [
+    ["main"],
+    ["topic", "side"],
+    ["topic..main"],
+    ["main", "^topic", "^side"],
+    ["side..topic"],
+    ["main~2..main"],
+    ["main", "--first-parent"],
+    ["main", "--topo-order"],
+    ["topic..main", "--topo-order"],
+    ["main", "--first-parent", "--topo-order"],
+    ["main", "-n", "3"],
+    ["main", "--topo-order", "-n", "4"],
+]
+
+
+def walk_args(args: list) -> dict:
+    revisions = [a for a in args if not a.startswith("-") and
+                 not a.isdigit()]
+    return dict(
+        revisions=revisions,
+        max_count=int(args[args.index("-n") + 1]) if "-n" in args else None,
+        first_parent="--first-parent" in args,
+        topo_order="--topo-order" in args)
+
+
+@pytest.mark.parametrize("args", CASES)
+def test_rev_list(tmp_path, args):
+    repo = setup_repo(tmp_path)
+    # main~2 isn't something pit parses
+    rev = git(tmp_path, "rev-parse", "main~2").decode().strip()
+    args = [a.replace("main~2", rev) for a in args]
+    expected = git(tmp_path, "rev-list", *args).decode().split()
+
+    kw = walk_args(args)
+    include, exclude = rev_parse_revisions(repo, kw.pop("revisions"))
+    assert list(rev_walk(repo, include, exclude, **kw)) == expected
+
+
+def test_log(tmp_path, monkeypatch, capsys):
+    from pit.commands import cmd_log
+
+    setup_repo(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    for oneline in (False, True):
+        cmd_log(argparse.Namespace(revisions=[], max_count=None,
+                                   first_parent=False, topo_order=False,
+                                   oneline=oneline))
+        args = ["--oneline", "--abbrev=7"] if oneline else []
+        assert capsys.readouterr().out == \
+            git(tmp_path, "log", *args).decode()
+
+
+def test_rev_walk_streams(tmp_path, monkeypatch):
+    import pit.revision
+
+    repo = setup_repo(tmp_path)
+    read = []
+    commit_read = pit.revision._commit_read
+    monkeypatch.setattr(pit.revision, "_commit_read",
+                        lambda repo, sha: read.append(sha) or
+                        commit_read(repo, sha))
+    walk = rev_walk(repo, rev_parse_revisions(repo, ["main"])[0])
+    next(walk)
+    # The tip, and its parent
+    assert len(read) == 2
@@ -0,0 +1,154 @@
+import os
+import subprocess
+from pathlib import Path
+
+from pit.repo import Repository
+from pit.objects import object_read, object_read_raw, object_find
+from pit.pack import pack_list, delta_apply
+from conftest import git
+
+
+def setup_packed(path: Path) -> Repository:
+    git(path, "init", "-q")
+    for i in range(1, 4):
+        with open(path / "numbers.txt", "w") as f:
+            f.write("\n".join(str(n) for n in range(i * 1000)))
+        (path / "folder").mkdir(exist_ok=True)
+        with open(path / "folder" / f"{i}.txt", "w") as f:
+            f.write("This is {0}".format(i))
+        git(path, "add", ".")
+        git(path, "commit", "-q", "-m", "commit {0}".format(i))
+    git(path, "tag", "-a", "-m", "a tag", "v1")
+    git(path, "gc", "-q")
+    return Repository(path)
+
+
+def test_read_packed_objects(tmp_path):
+    repo = setup_packed(tmp_path)
+    assert pack_list(repo)
+    assert not any(len(d) == 2 for d in os.listdir(repo.gitdir / "objects"))
+
+    listing = git(tmp_path, "cat-file", "--batch-all-objects",
+                  "--batch-check").decode().split("\n")
+    for line in filter(None, listing):
+        sha, fmt, size = line.split()
+        raw_fmt, data = object_read_raw(repo, sha)
+        assert raw_fmt == fmt.encode()
+        assert len(data) == int(size)
+        assert data == git(tmp_path, "cat-file", fmt, sha)
+
+
+def test_object_find_packed(tmp_path):
+    repo = setup_packed(tmp_path)
+    head = git(tmp_path, "rev-parse", "HEAD").decode().strip()
+    tree = git(tmp_path, "rev-parse", "HEAD^{tree}").decode().strip()
+
+    assert object_find(repo, head[:7]) == head
+    assert object_find(repo, head, fmt=b"tree") == tree
+    assert object_read(repo, tree).fmt == b"tree"
+    assert object_read(repo, "0" * 40) is None
+
+
+def test_delta_apply():
+    base = b"0123456789" * 10
+    # copy 10 bytes at offset 5, then insert b"xyz"
+    delta = bytes([100, 13, 0x91, 5, 10, 3]) + b"xyz"
+    assert delta_apply(base, delta) == b"5678901234xyz"
+
+
+def setup_loose(path: Path) -> Repository:
+    git(path, "init", "-q")
+    for i in range(1, 6):
+        with open(path / "numbers.txt", "w") as f:
+            f.write("\n".join(str(n) for n in range(i * 500)))
+        with open(path / "{0}.txt".format(i), "w") as f:
+            f.write("This is {0}".format(i))
+        git(path, "add", ".")
+        git(path, "commit", "-q", "-m", "commit {0}".format(i))
+    git(path, "tag", "-a", "-m", "a tag", "v1", "HEAD~2")
+    return Repository(path)
+
+
+def test_repack(tmp_path):
+    from pit.commands import repack
+
+    repo = setup_loose(tmp_path)
+    before = git(tmp_path, "rev-list", "--objects", "--all")
+    path = repack(repo, delete=True)
+
+    assert path.exists() and path.with_suffix(".idx").exists()
+    assert not any(len(d) == 2 for d in os.listdir(repo.gitdir / "objects"))
+
+    # git accepts the pack, and found deltas in it
+    verify = git(tmp_path, "verify-pack", "-v", str(path)).decode()
+    assert "chain length = 1" in verify
+    git(tmp_path, "fsck", "--strict")
+    assert git(tmp_path, "rev-list", "--objects", "--all") == before
+
+    # and so do we
+    head = git(tmp_path, "rev-parse", "HEAD").decode().strip()
+    assert object_read(repo, head).fmt == b"commit"
+    blob = git(tmp_path, "rev-parse", "HEAD:numbers.txt").decode().strip()
+    assert object_read(repo, blob).data == (tmp_path / "numbers.txt").read_bytes()
+
+
+def test_delta_create_roundtrip():
+    from pit.pack import delta_create
+
+    base = b"".join(b"line %d\n" % i for i in range(2000))
+    target = base[:5000] + b"inserted\n" + base[5100:] + b"appended"
+    delta = delta_create(base, target)
+    assert len(delta) < 100
+    assert delta_apply(base, delta) == target
+    assert delta_create(base, target, max_size=10) is None
+
+
+def test_object_read_header(tmp_path):
+    from pit.objects import object_read_header
+
+    loose = tmp_path / "loose"
+    packed = tmp_path / "packed"
+    loose.mkdir()
+    packed.mkdir()
+    for repo in (setup_loose(loose), setup_packed(packed)):
+        listing = git(repo.worktree, "cat-file", "--batch-all-objects",
+                      "--batch-check").decode().split("\n")
+        for line in filter(None, listing):
+            sha, fmt, size = line.split()
+            assert object_read_header(repo, sha) == (fmt.encode(), int(size))
+        # Nothing had to be inflated in full
+        assert len(repo.cache.blobs) == 0
+        assert object_read_header(repo, "0" * 40) is None
+
+
+def test_read_stream_packed(tmp_path):
+    from pit.objects import object_read_stream
+
+    repo = setup_packed(tmp_path)
+    for rev in ("HEAD~2:numbers.txt", "HEAD:numbers.txt", "HEAD"):
+        sha = git(tmp_path, "rev-parse", rev).decode().strip()
+        fmt, size, chunks = object_read_stream(repo, sha, chunk_size=100)
+        data = b"".join(chunks)
+        assert fmt == git(tmp_path, "cat-file", "-t", sha).strip()
+        assert size == len(data)
+        assert data == git(tmp_path, "cat-file", fmt.decode(), sha)
+
+
+def test_cat_file_batch(tmp_path):
+    import io
+    from pit.commands import cat_file_batch
+
+    repo = setup_packed(tmp_path)
+    names = git(tmp_path, "rev-list", "--objects", "--all").decode()
+    names = "".join(line.split()[0] + "\n"
+                    for line in names.split("\n") if line)
+    names += names[:8] + "\n" + "0" * 40 + "\n"
+
+    for contents, flag in ((False, "--batch-check"), (True, "--batch")):
+        out = io.BytesIO()
+        cat_file_batch(repo, io.BytesIO(names.encode()), out,
+                       contents=contents)
+        expected = subprocess.run(["git", "cat-file", flag], cwd=tmp_path,
+                                  input=names.encode(), capture_output=True,
+                                  check=True).stdout
+        assert out.getvalue() == expected
@@ -0,0 +1,86 @@
+import argparse
+import shutil
+from pathlib import Path
+
+from pit.repo import Repository
+from pit.commands import cmd_show_ref
+from pit.objects import object_find
+from pit.refs import (
+    packed_refs,
+    ref_dict,
+    ref_list,
+    ref_peeled,
+    ref_resolve,
+    refs_pack,
+)
+from conftest import git
+
+
+def setup_repo(path: Path) -> Repository:
+    """Branches, lightweight, annotated and nested tags, a remote ref;
+    some packed, some loose, one both."""
+    git(path, "init", "-q", "-b", "main")
+    git(path, "commit", "-q", "--allow-empty", "-m", "one")
+    for name in ("t1", "t2", "deep/t3"):
+        git(path, "tag", name)
+    git(path, "tag", "-a", "-m", "annotated", "ann")
+    git(path, "-c", "advice.nestedTag=false", "tag", "-a", "-m", "nested",
+        "nested", "ann")
+    git(path, "branch", "topic/a")
+    git(path, "update-ref", "refs/remotes/origin/main", "HEAD")
+    git(path, "pack-refs", "--all")
+    git(path, "commit", "-q", "--allow-empty", "-m", "two")
+    git(path, "tag", "t4")
+    git(path, "branch", "-f", "topic/a")
+    return Repository(path)
+
+
+def test_show_ref(tmp_path, monkeypatch, capsys):
+    repo = setup_repo(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    cmd_show_ref(argparse.Namespace())
+    assert capsys.readouterr().out == git(tmp_path, "show-ref").decode()
+
+    main = git(tmp_path, "rev-parse", "main").decode().strip()
+    # Packed, then overridden by a loose one
+    assert ref_resolve(repo, "refs/heads/topic/a") == main
+    assert ref_resolve(repo, "HEAD") == main
+    assert object_find(repo, "t1") == \
+        git(tmp_path, "rev-parse", "t1").decode().strip()
+    assert ref_peeled(repo, "refs/tags/nested") == \
+        git(tmp_path, "rev-parse", "nested^{}").decode().strip()
+    assert list(ref_list(repo)["tags"]) == ["ann", "deep", "nested", "t1",
+                                            "t2", "t4"]
+
+
+def test_pack_refs_like_git(tmp_path):
+    setup_repo(tmp_path)
+    theirs = tmp_path / "theirs"
+    ours = tmp_path / "ours"
+    shutil.copytree(tmp_path / ".git", theirs / ".git")
+    shutil.copytree(tmp_path / ".git", ours / ".git")
+
+    for all_refs in (False, True):
+        git(theirs, "pack-refs", *(["--all"] if all_refs else []))
+        refs_pack(Repository(ours), all_refs=all_refs)
+        assert (ours / ".git/packed-refs").read_bytes() == \
+            (theirs / ".git/packed-refs").read_bytes()
+        assert sorted(p.relative_to(ours) for p in ours.rglob("refs/**/*")) \
+            == sorted(p.relative_to(theirs)
+                      for p in theirs.rglob("refs/**/*"))
+    assert git(ours, "show-ref") == git(tmp_path, "show-ref")
+
+
+def test_packed_refs_cached(tmp_path):
+    repo = setup_repo(tmp_path)
+    packed = packed_refs(repo)
+    assert packed_refs(repo) is packed
+    names = list(ref_dict(repo))
+
+    git(tmp_path, "tag", "t5")
+    git(tmp_path, "pack-refs", "--all")
+    assert packed_refs(repo) is not packed
+    assert list(ref_dict(repo)) == sorted(names + ["refs/tags/t5"])
+
+    git(tmp_path, "branch", "-D", "topic/a")
+    assert ref_resolve(repo, "refs/heads/topic/a") is None
@@ -0,0 +1,200 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from pit.repo import Repository
+from pit.refs import ZERO_SHA, PitRefTransaction, packed_refs, ref_resolve
+from conftest import git
+
+
+MAIN = Path(__file__).parent.parent / "src" / "main.py"
+
+
+def setup_repo(path: Path) -> tuple[Repository, str, str]:
+    """Two commits, an annotated tag, a packed branch and a loose one."""
+    git(path, "init", "-q", "-b", "main")
+    git(path, "commit", "-q", "--allow-empty", "-m", "one")
+    git(path, "commit", "-q", "--allow-empty", "-m", "two")
+    git(path, "tag", "-a", "-m", "annotated", "ann")
+    git(path, "branch", "packed", "main~1")
+    git(path, "pack-refs", "--all")
+    git(path, "branch", "loose", "main~1")
+    one, two = git(path, "rev-parse", "main~1", "main").decode().split()
+    return Repository(path), one, two
+
+
+def locks(path: Path) -> list[Path]:
+    return list((path / ".git").rglob("*.lock"))
+
+
+def test_updates(tmp_path):
+    repo, one, two = setup_repo(tmp_path)
+    tx = PitRefTransaction(repo)
+    tx.create("refs/heads/new/branch", two)
+    tx.update("refs/heads/loose", two, one)
+    tx.update("refs/heads/packed", two, one)
+    tx.delete("refs/tags/ann")
+    tx.verify("refs/heads/main", two)
+    tx.commit()
+    assert git(tmp_path, "show-ref").decode().split() == [
+        two, "refs/heads/loose", two, "refs/heads/main",
+        two, "refs/heads/new/branch", two, "refs/heads/packed"]
+    assert b"refs/tags/ann" not in (tmp_path / ".git/packed-refs").read_bytes()
+    assert not (tmp_path / ".git/refs/tags/ann").exists()
+    assert locks(tmp_path) == []
+
+    # HEAD moves the branch it points to
+    tx = PitRefTransaction(repo)
+    tx.update("HEAD", one, two)
+    tx.commit()
+    assert ref_resolve(repo, "refs/heads/main") == one
+    assert (tmp_path / ".git/HEAD").read_text() == "ref: refs/heads/main\n"
+
+
+def test_all_or_nothing(tmp_path):
+    repo, one, two = setup_repo(tmp_path)
+    before = git(tmp_path, "show-ref")
+    for old, message in ((two, "is at"), (ZERO_SHA, "already exists")):
+        tx = PitRefTransaction(repo)
+        tx.create("refs/heads/other", two)
+        tx.delete("refs/heads/packed")
+        tx.update("refs/heads/loose", two, old)
+        with pytest.raises(Exception, match=message):
+            tx.commit()
+        assert git(tmp_path, "show-ref") == before
+        assert locks(tmp_path) == []
+
+    tx = PitRefTransaction(repo)
+    tx.update("refs/heads/nowhere", two, one)
+    with pytest.raises(Exception, match="unable to resolve"):
+        tx.commit()
+
+    tx = PitRefTransaction(repo)
+    tx.update("refs/heads/main", two)
+    with pytest.raises(Exception, match="Multiple updates"):
+        tx.update("HEAD", one)
+    with pytest.raises(Exception, match="not a valid ref name"):
+        tx.create("refs/heads/a..b", two)
+
+
+def test_held_lock(tmp_path):
+    repo, one, two = setup_repo(tmp_path)
+    (tmp_path / ".git/refs/heads/loose.lock").write_text("")
+    tx = PitRefTransaction(repo)
+    tx.create("refs/heads/other", two)
+    tx.update("refs/heads/loose", two)
+    with pytest.raises(Exception, match="File exists"):
+        tx.commit()
+    assert ref_resolve(repo, "refs/heads/other") is None
+    assert locks(tmp_path) == [tmp_path / ".git/refs/heads/loose.lock"]
+
+
+def test_directory_conflicts(tmp_path):
+    repo, one, two = setup_repo(tmp_path)
+    for name in ("refs/heads/loose/a", "refs/heads/packed/a", "refs/heads"):
+        tx = PitRefTransaction(repo)
+        tx.create(name, two)
+        with pytest.raises(Exception, match="exists; cannot create"):
+            tx.commit()
+    tx = PitRefTransaction(repo)
+    tx.create("refs/heads/x", two)
+    tx.create("refs/heads/x/y", two)
+    with pytest.raises(Exception, match="exists; cannot create"):
+        tx.commit()
+
+    # Unless the other one goes away in the same transaction, and has no
+    # loose file in the way
+    tx = PitRefTransaction(repo)
+    tx.delete("refs/heads/loose")
+    tx.create("refs/heads/loose/a", two)
+    with pytest.raises(Exception, match="exists; cannot create"):
+        tx.commit()
+    tx = PitRefTransaction(repo)
+    tx.delete("refs/heads/packed")
+    tx.create("refs/heads/packed/a", two)
+    tx.commit()
+    assert git(tmp_path, "rev-parse", "packed/a").decode().strip() == two
+    assert locks(tmp_path) == []
+
+
+def test_packed(tmp_path):
+    repo, one, two = setup_repo(tmp_path)
+    tag = git(tmp_path, "rev-parse", "ann").decode().strip()
+    tx = PitRefTransaction(repo, packed=True)
+    for i in range(100):
+        tx.create("refs/tags/t{0}".format(i), tag)
+    tx.update("refs/heads/loose", two, one)
+    tx.commit()
+    assert not (tmp_path / ".git/refs/heads/loose").exists()
+    assert not (tmp_path / ".git/refs/tags/t0").exists()
+    packed = packed_refs(repo)
+    assert packed.refs["refs/heads/loose"] == two
+    assert packed.peeled["refs/tags/t99"] == two
+    assert git(tmp_path, "rev-parse", "t42^{}").decode().strip() == two
+    assert git(tmp_path, "pack-refs", "--all") == b''
+    assert packed_refs(repo).refs == packed.refs
+
+
+def test_update_ref_stdin(tmp_path):
+    repo, one, two = setup_repo(tmp_path)
+    commands = "\n".join([
+        "create refs/heads/a loose",
+        "update refs/heads/loose {0} {1}".format(two, one),
+        "delete refs/heads/packed",
+        "verify refs/heads/none",
+    ]) + "\n"
+    subprocess.run([sys.executable, str(MAIN), "update-ref", "--stdin"],
+                   cwd=tmp_path, input=commands.encode(), check=True)
+    assert git(tmp_path, "show-ref", "--heads").decode().split() == [
+        one, "refs/heads/a", two, "refs/heads/loose", two, "refs/heads/main"]
+
+
+def test_racing_writers(tmp_path):
+    """Writers moving a ref from the value they saw: exactly one of those
+    starting from the same value wins."""
+    repo, one, two = setup_repo(tmp_path)
+    script = ("import sys\n"
+              "sys.path.insert(0, {0!r})\n"
+              "from pit.repo import Repository\n"
+              "from pit.refs import PitRefTransaction\n"
+              "tx = PitRefTransaction(Repository('.'))\n"
+              "tx.update('refs/heads/loose', sys.argv[1], sys.argv[2])\n"
+              "try:\n"
+              "    tx.commit()\n"
+              "except Exception:\n"
+              "    sys.exit(1)\n").format(str(MAIN.parent))
+    writers = [subprocess.Popen([sys.executable, "-c", script, new, one],
+                                cwd=tmp_path)
+               for new in (two, two, two, two)]
+    assert sorted(w.wait() for w in writers) == [0, 1, 1, 1]
+    assert ref_resolve(repo, "refs/heads/loose") == two
+    assert locks(tmp_path) == []
+
+
+def test_update_ref_bad_value(tmp_path):
+    repo, one, two = setup_repo(tmp_path)
+    before = git(tmp_path, "show-ref")
+    for args, stdin in ((["refs/heads/loose", "nowhere"], None),
+                        (["--stdin"], b"create refs/heads/a main\n"
+                                      b"update refs/heads/loose nowhere\n")):
+        done = subprocess.run([sys.executable, str(MAIN), "update-ref",
+                               *args], cwd=tmp_path, input=stdin,
+                              capture_output=True)
+        assert done.returncode == 128
+        assert done.stderr == b"fatal: nowhere: not a valid SHA1\n"
+        assert git(tmp_path, "show-ref") == before
+
+
+def test_no_directories_left(tmp_path):
+    repo, one, two = setup_repo(tmp_path)
+    tx = PitRefTransaction(repo)
+    tx.verify("refs/heads/some/where", ZERO_SHA)
+    tx.delete("refs/tags/other/tag")
+    tx.update("refs/heads/loose", two, one)
+    tx.commit()
+    assert not (tmp_path / ".git/refs/heads/some").exists()
+    assert not (tmp_path / ".git/refs/tags/other").exists()
+    assert ref_resolve(repo, "refs/heads/loose") == two
+    assert locks(tmp_path) == []
@@ -0,0 +1,94 @@
+import errno
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from pit.repo import Repository
+from pit.objects import index_read
+from pit.status import status
+from conftest import git
+
+
+def short_status(repo: Repository) -> str:
+    st = status(repo)
+    lines = ["{0}{1} {2}".format(st.staged.get(p, " "),
+                                 st.unstaged.get(p, " "), p)
+             for p in sorted(set(st.staged) | set(st.unstaged))]
+    lines += ["?? " + p for p in st.untracked]
+    return "".join(line + "\n" for line in lines)
+
+
+def setup_repo(path: Path) -> Repository:
+    git(path, "init", "-q")
+    for name in ("a.txt", "b.txt", "c.txt", "folder/d.txt", "folder/e.txt",
+                 "other/f.txt"):
+        (path / name).parent.mkdir(exist_ok=True)
+        (path / name).write_text("This is " + name)
+    git(path, "add", ".")
+    git(path, "commit", "-q", "-m", "initial")
+    return Repository(path)
+
+
+def test_status_clean(tmp_path):
+    repo = setup_repo(tmp_path)
+    assert short_status(repo) == ""
+
+
+def test_status_changes(tmp_path):
+    repo = setup_repo(tmp_path)
+    (tmp_path / "a.txt").write_text("changed")
+    (tmp_path / "b.txt").write_text("staged")
+    git(tmp_path, "add", "b.txt")
+    (tmp_path / "b.txt").write_text("staged, then changed")
+    os.remove(tmp_path / "c.txt")
+    git(tmp_path, "rm", "-q", "folder/d.txt")
+    (tmp_path / "new.txt").write_text("new")
+    git(tmp_path, "add", "new.txt")
+    (tmp_path / "untracked.txt").write_text("untracked")
+    (tmp_path / "newdir" / "sub").mkdir(parents=True)
+    (tmp_path / "newdir" / "sub" / "g.txt").write_text("g")
+    (tmp_path / "other" / "h.txt").write_text("h")
+    os.chmod(tmp_path / "folder" / "e.txt", 0o755)
+
+    expected = git(tmp_path, "status", "--porcelain").decode()
+    assert short_status(repo) == expected
+
+
+def test_status_uses_stat_cache(tmp_path, monkeypatch):
+    import pit.status
+
+    repo = setup_repo(tmp_path)
+    # Make sure no entry is racily clean
+    time.sleep(0.01)
+    os.utime(repo.gitdir / "index")
+
+    hashed = []
+    file_hash = pit.status.file_hash
+    monkeypatch.setattr(pit.status, "file_hash",
+                        lambda path, st: hashed.append(path) or
+                        file_hash(path, st))
+
+    assert short_status(repo) == ""
+    assert hashed == []
+
+    # Same content, new mtime: hashed once, then refreshed in the index
+    os.utime(tmp_path / "a.txt", (0, 0))
+    assert short_status(repo) == ""
+    assert hashed == [str(tmp_path / "a.txt")]
+    entry = [e for e in index_read(repo).entries if e.name == "a.txt"][0]
+    assert entry.mtime == (0, 0)
+
+    # Refreshing is skipped while someone else holds the index lock, but
+    # any other error when writing it isn't
+    os.utime(tmp_path / "b.txt", (0, 0))
+    (repo.gitdir / "index.lock").write_text("")
+    assert short_status(repo) == ""
+    os.remove(repo.gitdir / "index.lock")
+
+    def index_write(repo, index):
+        raise OSError(errno.ENOSPC, "No space left on device")
+    monkeypatch.setattr(pit.status, "index_write", index_write)
+    with pytest.raises(OSError, match="No space left"):
+        status(repo)
@@ -0,0 +1,48 @@
+import io
+import os
+
+from pit.repo import repo_create
+from pit.objects import (
+    object_hash,
+    object_hash_stream,
+    object_read,
+    object_read_stream,
+)
+
+
+def test_hash_stream_matches_git(tmp_path):
+    import subprocess
+
+    content = os.urandom(300 * 1024) + b"end"
+    path = tmp_path / "big.bin"
+    path.write_bytes(content)
+    expected = subprocess.run(["git", "hash-object", str(path)],
+                              capture_output=True, check=True)
+    expected = expected.stdout.decode().strip()
+
+    with open(path, "rb") as fd:
+        assert object_hash_stream(fd, chunk_size=4096) == expected
+    # Without a file descriptor, the content gets spooled first
+    assert object_hash_stream(io.BytesIO(content)) == expected
+
+
+def test_write_and_read_stream(tmp_path):
+    repo = repo_create(tmp_path / "repo")
+    content = os.urandom(100 * 1024)
+    path = tmp_path / "blob"
+    path.write_bytes(content)
+
+    with open(path, "rb") as fd:
+        sha = object_hash(fd, b"blob", repo)
+    # Written a second time: the existing object is kept
+    with open(path, "rb") as fd:
+        assert object_hash_stream(fd, repo=repo, chunk_size=1000) == sha
+
+    fmt, size, chunks = object_read_stream(repo, sha, chunk_size=1000)
+    chunks = list(chunks)
+    assert (fmt, size) == (b"blob", len(content))
+    assert max(len(c) for c in chunks) <= 1000
+    assert b"".join(chunks) == content
+    assert object_read(repo, sha).data == content
+    assert not [f for f in os.listdir(repo.gitdir / "objects")
+                if f.startswith("tmp")]
@@ -0,0 +1,94 @@
+import os
+import random
+from pathlib import Path
+
+from pit.repo import Repository
+from pit.objects import PitTree, PitTreeLeaf, object_find, object_read
+from conftest import git
+
+
+def setup_repo(path: Path) -> Repository:
+    git(path, "init", "-q")
+    for name in ("a", "a-b", "a.c", "b/c", "b-c", "z/y/x", "é"):
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_text(name)
+    os.symlink("a", path / "link")
+    git(path, "add", ".")
+    git(path, "commit", "-q", "-m", "initial")
+    return Repository(path)
+
+
+def test_tree_lookup(tmp_path):
+    repo = setup_repo(tmp_path)
+    sha = object_find(repo, "HEAD", fmt=b"tree")
+    data = git(tmp_path, "cat-file", "tree", sha)
+    tree = PitTree(data)
+
+    # Names are decoded only when asked for
+    assert tree._items is None
+    names = git(tmp_path, "ls-tree", "--name-only", "-z", sha).split(b'\0')
+    assert [name for _, name, _ in tree.entries()] == names[:-1]
+    assert len(tree) == 8
+
+    b = tree.find("b")
+    assert (b.mode, b.path) == (b" 40000", "b")
+    assert b.sha == git(tmp_path, "rev-parse", "HEAD:b").decode().strip()
+    assert tree.find("é").path == "é"
+    assert tree.find(b"link").mode == b"120000"
+    for missing in ("", "b/", "a-", "c", "zz"):
+        assert tree.find(missing) is None
+    assert tree._items is None
+    assert tree.serialize() == data
+
+    # The same, once the leaves are made
+    assert [leaf.path for leaf in tree.items][:5] == \
+        ["a", "a-b", "a.c", "b-c", "b"]
+    assert tree.find("b").sha == b.sha
+    assert tree.find("c") is None
+    assert tree.serialize() == data
+
+
+def test_tree_big(tmp_path):
+    git(tmp_path, "init", "-q")
+    # A flat directory, made without a worktree
+    blob = git(tmp_path, "hash-object", "-w", "--stdin", input=b"x").strip()
+    listing = b''.join(b"100644 blob " + blob + b"\tf%05d\n" % i
+                       for i in range(20000))
+    sha = git(tmp_path, "mktree", input=listing).decode().strip()
+
+    tree = object_read(Repository(tmp_path), sha)
+    assert len(tree) == 20000 and tree._items is None
+    assert tree.find("f12345").sha == blob.decode()
+    assert tree.find("f20000") is None
+
+
+MODES = ((b"100644", "blob"), (b"100755", "blob"), (b"120000", "blob"),
+         (b"40000", "tree"), (b"160000", "commit"))
+
+
+def test_tree_serialize_matches_git(tmp_path):
+    git(tmp_path, "init", "-q")
+    rng = random.Random(16)
+    for size in (1, 100, 20000):
+        # Few characters, so that names are often prefixes of others and
+        # "-", "." and "0" sort around the "/" ending trees
+        names = set()
+        while len(names) < size:
+            names.add("".join(rng.choice("ab-.0_é")
+                              for _ in range(rng.randint(1, 6))))
+        leaves = []
+        for name in names:
+            mode, _ = rng.choice(MODES)
+            leaves.append(PitTreeLeaf(mode, name, rng.randbytes(20)))
+
+        listing = "".join("{0} {1} {2}\t{3}\n".format(
+            leaf.mode.decode(), dict(MODES)[leaf.mode], leaf.sha, leaf.path)
+            for leaf in leaves)
+        sha = git(tmp_path, "mktree", "--missing",
+                  input=listing.encode()).decode().strip()
+        data = git(tmp_path, "cat-file", "tree", sha)
+
+        tree = PitTree()
+        tree.items = leaves
+        assert tree.serialize() == data
+        assert PitTree(data).serialize() == data